@@ -10,31 +10,54 @@ Initialize the GUI and other components.
 
 
 # Packages
-from PySide6.QtCore import Qt, QFile, QIODevice, QCoreApplication, QPoint, QTimer
-from PySide6.QtGui import QPixmap, QPainter, QPen, QColor, QFont
-from PySide6.QtWidgets import QApplication, QStatusBar
+from PySide6.QtCore import Qt, QFile, QIODevice, QCoreApplication, QTimer, QObject, QThread, Signal, Slot
+from PySide6.QtGui import QPixmap, QPen, QColor, QFont, QFontMetrics
+from PySide6.QtWidgets import QApplication, QStatusBar, QLabel, QGraphicsItemGroup, QGraphicsEllipseItem, QGraphicsSimpleTextItem
 from PySide6.QtUiTools import QUiLoader
 from scipy.interpolate import interp1d
 import ui.components as uic
+import routerdb
 import scanner
 import locator
+import tracker
+import fingerprint
+import scheduler
+import metrics
 import json
+import time
 import sys
 
 
 
+# Map pixels around the visible area in which routers are drawn,
+# so labels of routers just outside of it are not cut off
+ROUTER_MARGIN = 400
+
+# Meters around a fingerprint fix searched for a router to name the location
+FP_NAME_RADIUS = 15
+
+
+
 class MapRenderer(object):
     def __init__(self, window, routers):
         self.window = window
-        self.routers = routers # routers dictionary
+        self.routers = routers # RouterTable of all routers
 
         # Map details
         self.map_scale = 3
         self.img_w = cfg['IMG_W']
         self.img_h = cfg['IMG_H']
 
+        # Cache of decoded and scaled map images, and of map tiles
+        # (see init_scene), sharing MAP_CACHE_MB half each
+        self.maps = uic.MapCache(self.img_w, self.img_h, cfg['MAP_CACHE_MB'] / 2)
+
         # Font used to draw on map
         self.font = QFont('Arial', 38)
+        self.font_ascent = QFontMetrics(self.font).ascent()
+
+        # Long-lived scene, updated in place on every render
+        self.init_scene()
 
         # User location and router details
         self.user = {
@@ -98,69 +121,117 @@ class MapRenderer(object):
         return rc_x,rc_y
 
 
-    def render(self):
-        # Render the map
-        print('Rendering...')
-
-        # Use a simple/clean or full map
-        map_mode = '-c' if self.window.simpleMapView.isChecked() else ''
-        # Load map for the current floor
-        path = f'map/korrus-{self.user["floor"]}{map_mode}.png'
-        # Init a pixmap for the map
-        pix = QPixmap(path)
-        painter = QPainter(pix)
-        painter.setFont(self.font)
-
-        # Highlight all detected routers
-        for router in self.nearby_routers:
-            self.highlight_router(painter, self.routers[router['MAC']])
-
-        # Draw all routers on this floor
-        for mac,router in self.routers.items():
-            if router['floor'] == self.user['floor']:
-                self.draw_router(painter, router)
+    def init_scene(self):
+        # Create the scene and its layers (back to front):
+        # map, highlighted routers, routers of a floor, user,
+        # new router and the overlay.
+        # Maps and overlays are shown as tiles if make_tiles.py has
+        # been run, otherwise as a single scaled pixmap.
+        # All other layers use original map coordinates
+        # and are scaled to the current zoom as a whole.
 
-                # Draw router location name on map
-                painter.drawText(router['x'] - 40, router['y'] - 28, router['name'])
+        self.scene = uic.CGraphicsScene()
+        # Forward mouse click signals to update new router location info
+        self.scene.signalMousePos.connect(lambda pos: self.add_router_on_click(pos))
+
+        self.map_item = self.scene.addPixmap(QPixmap())
+        self.map_key = None
+
+        self.tiles = uic.TileCache('map/tiles', cfg['MAP_CACHE_MB'] / 2)
+        self.map_tiles = uic.TileLayer(self.scene, self.tiles, 0)
+        self.overlay_tiles = uic.TileLayer(self.scene, self.tiles, 5)
+        self.map_tiles_name = None
+        self.overlay_tiles_name = None
+
+        self.layers = QGraphicsItemGroup()
+        self.layers.setZValue(1)
+        self.scene.addItem(self.layers)
+
+        self.highlight_items = []
+        # Routers inside the visible area, row -> dot with its label
+        self.routers_group = QGraphicsItemGroup(self.layers)
+        self.routers_group.setZValue(2)
+        self.router_items = {}
+        self.drawn_routers = None
+        self.drawn_floor = None
+
+        pen = QPen(Qt.black, 1)
+        self.router_pen = pen
+        self.user_outer = QGraphicsEllipseItem(self.layers)
+        self.user_outer.setPen(pen)
+        self.user_outer.setBrush(QColor(0, 255, 40, 20))
+        self.user_outer.setZValue(3)
+        self.user_dot = QGraphicsEllipseItem(-32, -32, 64, 64, self.layers)
+        self.user_dot.setPen(pen)
+        self.user_dot.setBrush(QColor(0, 255, 40, 180))
+        self.user_dot.setZValue(3)
+
+        self.new_router_item = QGraphicsEllipseItem(-22, -22, 44, 44, self.layers)
+        self.new_router_item.setPen(pen)
+        self.new_router_item.setBrush(Qt.blue)
+        self.new_router_item.setZValue(4)
+        self.new_router_item.hide()
+
+        self.overlay_item = self.scene.addPixmap(QPixmap())
+        self.overlay_item.setZValue(5)
+        self.overlay_key = None
+
+        self.window.mapView.setScene(self.scene)
+
+        # Load the tiles and routers that scroll into view
+        self.window.mapView.horizontalScrollBar().valueChanged.connect(lambda _: self.update_view())
+        self.window.mapView.verticalScrollBar().valueChanged.connect(lambda _: self.update_view())
 
-        self.draw_user(painter)
 
-        # Init custom graphics scene
-        scene = uic.CGraphicsScene()
-        # Forward mouse click signals to update new router location info
-        scene.signalMousePos.connect(lambda pos: self.add_router_on_click(pos))
-        # If new router add mode is engaged, draw new router location
-        if self.add_new_router_mode:
-            painter.setPen(QPen(Qt.black, 1))
-            painter.setBrush(Qt.blue)
-            center = QPoint(self.new_router["x"], self.new_router["y"])
-            painter.drawEllipse(center, 22, 22)
+    def render(self):
+        # Render the map by updating the items that changed
+        print('Rendering...')
+        start = time.perf_counter()
 
-        painter.end()
+        floor = self.user['floor']
 
+        self.layers.setScale(1 / self.map_scale)
 
-        # Scale map based on current zoom
-        pix = pix.scaled(self.img_w / self.map_scale,
-                         self.img_h / self.map_scale, 
-                         Qt.AspectRatioMode.KeepAspectRatio,
-                         Qt.TransformationMode.SmoothTransformation)
-        
-        # Add the pixmap to a scene in the QGraphicsView
-        scene.addPixmap(pix)
+        # Use a simple/clean or full map
+        map_mode = '-c' if self.window.simpleMapView.isChecked() else ''
+        self.map_tiles_name = self.tiled(f'korrus-{floor}{map_mode}')
+        key = (floor, map_mode, self.map_scale)
+        if self.map_tiles_name:
+            key = None
+        if key != self.map_key:
+            pix = QPixmap.fromImage(self.maps.get(*key)) if key else QPixmap()
+            self.map_item.setPixmap(pix)
+            self.map_key = key
 
         # Load the additional info overlay image if selected
+        key = None
+        self.overlay_tiles_name = None
         if self.window.mapOverlayView.isChecked():
-            pix_overlay = QPixmap(f'map/korrus-{self.user["floor"]}-overlay.png')
-            pix_overlay = pix_overlay.scaled(self.img_w / self.map_scale,
-                                             self.img_h / self.map_scale, 
-                                             Qt.AspectRatioMode.KeepAspectRatio,
-                                             Qt.TransformationMode.SmoothTransformation)
-            scene.addPixmap(pix_overlay)
-
-        self.window.mapView.setScene(scene)
+            self.overlay_tiles_name = self.tiled(f'korrus-{floor}-overlay')
+            if not self.overlay_tiles_name:
+                key = (floor, '-overlay', self.map_scale)
+        if key != self.overlay_key:
+            pix = QPixmap.fromImage(self.maps.get(*key)) if key else QPixmap()
+            self.overlay_item.setPixmap(pix)
+            self.overlay_key = key
+
+        self.update_highlights()
+        self.update_user()
+
+        # If new router add mode is engaged, draw new router location.
+        # The same marker shows the survey point in survey mode.
+        marker = self.add_new_router_mode or self.window.surveyButton.isChecked()
+        self.new_router_item.setVisible(marker)
+        if marker:
+            self.new_router_item.setPos(self.new_router['x'], self.new_router['y'])
 
         # Move the map to give padding around all sides
-        self.window.mapView.setSceneRect(-100, -100, scene.width() + 200, scene.height() + 200)
+        if self.map_tiles_name:
+            w,h = self.map_tiles.size(self.map_tiles_name, self.map_scale)
+        else:
+            rect = self.map_item.boundingRect()
+            w,h = rect.width(), rect.height()
+        self.window.mapView.setSceneRect(-100, -100, w + 200, h + 200)
 
         # Remap center coordinates based on the current map scale
         rc_x,rc_y = self.remap_coords()
@@ -172,11 +243,45 @@ class MapRenderer(object):
             self.window.mapView.centerOn(center_x, center_y)
             
         self.window.mapView.show()
+        self.update_view()
 
         self.update_labels()
         # List all routers and their distances
         self.list_routers()
 
+        # Load the other floors in the background
+        self.prewarm()
+        metrics.record('render', time.perf_counter() - start)
+
+
+    def tiled(self, name):
+        # Name of the tiled map at the current scale, None if not tiled
+        if self.map_tiles.size(name, self.map_scale) is None:
+            return None
+        return name
+
+
+    def update_view(self):
+        # Show the tiles and routers inside the visible area
+        view = self.window.mapView
+        rect = view.mapToScene(view.viewport().rect()).boundingRect()
+        self.map_tiles.show(self.map_tiles_name, self.map_scale, rect)
+        self.overlay_tiles.show(self.overlay_tiles_name, self.map_scale, rect)
+        self.update_routers(self.user['floor'], rect)
+
+
+    def prewarm(self):
+        # Prewarm map cache with all floors for the current view settings
+        variants = ['-c' if self.window.simpleMapView.isChecked() else '']
+        if self.window.mapOverlayView.isChecked():
+            variants.append('-overlay')
+
+        # Tiled maps are loaded by the visible tiles instead
+        floors = range(cfg['MIN_FLOOR'], cfg['MAX_FLOOR'] + 1)
+        keys = [(f, v, self.map_scale) for f in floors for v in variants]
+        keys = [k for k in keys if not self.tiled(f'korrus-{k[0]}{k[1]}')]
+        self.maps.prewarm(keys)
+
 
     def add_router_on_click(self, new_pos):
         # Handle clicks on map in case "add new router" mode is engaged
@@ -189,51 +294,100 @@ class MapRenderer(object):
             self.nr.coords.setText(f'x: {self.new_router["x"]}, y: {self.new_router["y"]}')
             self.render()
 
+        # Survey mode: record a fingerprint at the clicked point
+        elif self.window.surveyButton.isChecked():
+            rc_x,rc_y = self.remap_coords(reverse=True)
+            self.new_router['x'] = int(rc_x(new_pos.x()).round())
+            self.new_router['y'] = int(rc_y(new_pos.y()).round())
+            self.new_router['floor'] = self.user['floor']
+            self.render()
+            begin_survey(self)
 
-    def draw_user(self, painter):
-        # Draw the user's location on map
-        
-        painter.setPen(QPen(Qt.black, 1))
-        painter.setBrush(QColor(0, 255, 40, 20))
 
-        center = QPoint(self.user['x'], self.user['y'])
-        rad = self.user['radius'] * cfg['PX_SCALE']
+    def update_routers(self, floor, rect):
+        # Show the routers of the given floor inside the visible scene
+        # rect. Items are only created for routers that come into view
+        # and removed once they leave it.
 
-        # Outer circle
-        painter.drawEllipse(center, rad, rad)
+        # All items are dropped if the floor changed or the routers were reloaded
+        if self.routers is not self.drawn_routers or floor != self.drawn_floor:
+            for item in self.router_items.values():
+                self.scene.removeItem(item)
+            self.router_items = {}
+            self.drawn_routers = self.routers
+            self.drawn_floor = floor
 
-        # Inner circle/dot
-        painter.setBrush(QColor(0, 255, 40, 180))
-        painter.drawEllipse(center, 32, 32)
+        # Visible area in map coordinates, with room for the labels
+        s = self.map_scale
+        margin = ROUTER_MARGIN
+        rows = self.routers.in_rect(floor, rect.left() * s - margin, rect.top() * s - margin,
+                                    rect.right() * s + margin, rect.bottom() * s + margin)
+        visible = set(rows.tolist())
 
+        for row in [r for r in self.router_items if r not in visible]:
+            self.scene.removeItem(self.router_items.pop(row))
+
+        for row in visible:
+            if row not in self.router_items:
+                self.router_items[row] = self.router_item(row)
+
+
+    def router_item(self, i):
+        # Router dot with its location name as a child item
 
-    def draw_router(self, painter, router):
         # Draw a router as a dot on map
+        dot = QGraphicsEllipseItem(-14, -14, 28, 28, self.routers_group)
+        dot.setPen(self.router_pen)
+        dot.setBrush(Qt.black)
+        dot.setPos(int(self.routers.x[i]), int(self.routers.y[i]))
 
-        painter.setPen(QPen(Qt.black, 1))
-        painter.setBrush(Qt.black)
+        # Draw router location name on map, baseline above the dot
+        label = QGraphicsSimpleTextItem(self.routers.name(i), dot)
+        label.setFont(self.font)
+        label.setPos(-40, -28 - self.font_ascent)
 
-        center = QPoint(router['x'], router['y'])
-        painter.drawEllipse(center, 14, 14)
+        return dot
 
 
-    def highlight_router(self, painter, router):
-        # Highlight active routers
-        
-        painter.setPen(QPen(Qt.black, 1))
-        painter.setBrush(Qt.red)
+    def update_highlights(self):
+        # Highlight active routers, reusing the existing items
+
+        rows = self.routers.index([router['MAC'] for router in self.nearby_routers])
+        xs = self.routers.x[rows].tolist()
+        ys = self.routers.y[rows].tolist()
+
+        while len(self.highlight_items) < len(xs):
+            item = QGraphicsEllipseItem(-22, -22, 44, 44, self.layers)
+            item.setPen(QPen(Qt.black, 1))
+            item.setBrush(Qt.red)
+            item.setZValue(1)
+            self.highlight_items.append(item)
 
-        center = QPoint(router['x'], router['y'])
-        painter.drawEllipse(center, 22, 22)
+        for i,item in enumerate(self.highlight_items):
+            if i < len(xs):
+                item.setPos(xs[i], ys[i])
+                item.show()
+            else:
+                item.hide()
+
+
+    def update_user(self):
+        # Move the user's location marker on map
+
+        rad = self.user['radius'] * cfg['PX_SCALE']
+        self.user_outer.setRect(-rad, -rad, 2 * rad, 2 * rad)
+        self.user_outer.setPos(self.user['x'], self.user['y'])
+        self.user_dot.setPos(self.user['x'], self.user['y'])
 
 
     def list_routers(self):
         # List all nearby routers and distances to them
 
         rl = ''
-        for router in self.nearby_routers:
+        rows = self.routers.index([router['MAC'] for router in self.nearby_routers])
+        for router,row in zip(self.nearby_routers, rows):
             mac = router['MAC']
-            loc = self.routers[router['MAC']]['name']
+            loc = self.routers.name(row)
             dist = router['DIST']
             # Formatted line
             rl +=  f'{loc}   ({round(dist, 1)*10} m)   {mac[-5:]}\n'
@@ -262,22 +416,108 @@ class MapRenderer(object):
 
 
 
-def begin_scan(renderer):
-    # Main Renderer object
-    # Custom adapter name to use in Linux, otherwise
+class ScanWorker(QObject):
+    # Runs scans and positioning in a background thread,
+    # so the UI thread only ever renders the results
 
-    # Check if trilateration or mean method is selected
-    trilatOrMean = renderer.window.trilatMethod.isChecked()
+    finished = Signal(object)
 
-    # Custom adapter name
-    adapter = cfg['ADAPTER']
+    @Slot(object)
+    def run(self, request):
+        # The task is locate_scan unless given in the request
+        task = request.pop('task', locate_scan)
+        try:
+            result = task(**request)
+        except Exception as e:
+            print('[!] Scan failed:', e)
+            result = {'error': 'Scan failed'}
+        self.finished.emit(result)
+
+
+
+class ScanController(QObject):
+    # Hands scan requests to the worker thread and delivers results to
+    # the renderer. Requests made while a scan is running are coalesced
+    # into a single follow-up scan with the latest parameters.
+
+    requested = Signal(object)
+
+    def __init__(self, renderer):
+        super(ScanController, self).__init__()
+        self.renderer = renderer
+        self.busy = False
+        self.pending = None
+        # Called with the result once the current scan is done, if set
+        self.follow = None
+
+        self.thread = QThread()
+        self.worker = ScanWorker()
+        self.worker.moveToThread(self.thread)
+        self.requested.connect(self.worker.run)
+        self.worker.finished.connect(self.on_finished)
+        self.thread.start()
+
+
+    def request(self, request):
+        # Start a scan, or queue it if one is already running
+        if self.busy:
+            self.pending = request
+            return
+
+        self.busy = True
+        self.started = time.perf_counter()
+        window.status.showMessage('Scanning...')
+        self.requested.emit(request)
+
+
+    @Slot(object)
+    def on_finished(self, result):
+        # Called in the UI thread with the result of a scan
+        self.busy = False
+
+        if 'error' in result:
+            window.status.showMessage(result['error'], 5000)
+        elif 'survey' in result:
+            window.status.showMessage(f'Saved fingerprint of {result["survey"]} networks', 5000)
+        else:
+            window.status.clearMessage()
+            # Pass data to renderer and draw
+            self.renderer.nearby_routers = result['nearby']
+            self.renderer.user = result['user']
+            self.renderer.render()
+            metrics.record('fix', time.perf_counter() - self.started)
+
+        if metrics.enabled:
+            window.metricsLabel.setText(metrics.status_text(['scan', 'locate', 'render', 'paint', 'fix']))
+
+        if self.pending is not None:
+            request, self.pending = self.pending, None
+            self.request(request)
+        elif self.follow is not None:
+            follow, self.follow = self.follow, None
+            follow(result)
+
+
+    def stop(self):
+        # Stop the worker thread, waiting for a running scan to finish
+        self.thread.quit()
+        self.thread.wait()
+
+
+
+def locate_scan(routers, method, prev, adapter, config, track=None, radio_map=None):
+    # Scan nearby networks, filter them and locate the user.
+    # If a tracker is given, it is updated instead of a single fix.
+    # If a radio map file is given, the fix is found by fingerprinting,
+    # with the selected method as fallback where the survey has no match.
+    # Runs in the scan worker thread, must not touch any widgets.
+    # Returns a dict with the nearby routers and the user, or an error.
 
     # Scan the network
     nearby = scanner.scan(adapter)
 
     if not nearby or len(nearby) == 0:
-        window.status.showMessage('No suitable nearby routers detected', 5000)
-        return
+        return {'error': 'No suitable nearby routers detected'}
 
     print('Nearby:')
     for item in nearby:
@@ -285,84 +525,151 @@ def begin_scan(renderer):
 
     print()
 
+    # Fingerprinting uses all scanned networks, known routers or not
+    fp_user = None
+    if radio_map is not None:
+        with metrics.stage('fingerprint'):
+            fp_user = radio_map.locate(nearby, config)
+
     # Filter out too weak and unknown routers
     print('Excluding:')
-    for router in reversed(nearby):
-        try:
-            if router['RSSI'] < cfg['RSSI_MIN'] or router['MAC'] not in renderer.routers.keys():
-                print(router)
-                nearby.remove(router)
-        except KeyError:
-            window.status.showMessage('Malformed routers list', 5000)
-            return
+    try:
+        with metrics.stage('filter'):
+            nearby,excluded = locator.filter_nearby(routers, nearby, config)
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return {'error': 'Malformed routers list'}
+
+    for router in excluded:
+        print(router)
     
     print()
 
     # Check if any routers are left after excluding
     if len(nearby) == 0:
-        window.status.showMessage('No suitable nearby routers detected', 5000)
-        return
+        return {'error': 'No suitable nearby routers detected'}
 
     # Predict user x, y, floor
     # NB! Nearby list gets mutated
-    user = locator.locate(renderer.routers, nearby, trilatOrMean)
+    # Previous fix is used to warm-start multilateration.
+    # A fingerprint fix is used as is, the selected method only runs
+    # without one, so the tracker only follows fixes that are shown.
+    with metrics.stage('locate'):
+        if fp_user is not None:
+            locator.annotate_nearby(routers, nearby, config)
+            user = fp_user
+        elif track is not None:
+            user = track.update(routers, nearby)
+        else:
+            user = locator.locate(routers, nearby, method, prev, config)
+    if user is None:
+        return {'error': 'Unable to locate with the selected method'}
+
+    # Set user location name based on nearest router.
+    # A fingerprint fix is not tied to the scanned routers, the closest
+    # router around it on the map is used instead if there is one.
+    user['location'] = routers.name(routers.index([nearby[0]['MAC']])[0])
+    if fp_user is not None:
+        rows = locator.routers_near(routers, user, FP_NAME_RADIUS, config)
+        if len(rows) > 0:
+            user['location'] = routers.name(rows[0])
+
+    return {'nearby': nearby, 'user': user}
 
-    # Set user location name based on nearest router
-    user['location'] = renderer.routers[nearby[0]['MAC']]['name']
 
-    # Pass data to renderer and draw
-    renderer.nearby_routers = nearby
-    renderer.user = user
-    renderer.render()
+def begin_scan(renderer):
+    # Main Renderer object
+    # Collect the scan parameters and start a background scan
+
+    # Check which positioning method is selected
+    # Tracking keeps its state between scans in the tracker
+    track = ptracker if renderer.window.trackMethod.isChecked() else None
+    if renderer.window.multilatMethod.isChecked():
+        method = locator.MULTILAT
+    elif renderer.window.trilatMethod.isChecked():
+        method = locator.TRILAT
+    else:
+        method = locator.MEAN
+
+    scans.request({
+        'routers': renderer.routers,
+        'method': method,
+        'prev': dict(renderer.user),
+        'adapter': cfg['ADAPTER'], # Custom adapter name to use in Linux
+        'config': lcfg,
+        'track': track,
+        'radio_map': radio_map if renderer.window.fingerprintMethod.isChecked() else None
+    })
+
+
+def survey_scan(point, adapter, path):
+    # Scan nearby networks at a known map point and append them to
+    # the radio map. Runs in the scan worker thread.
+
+    nearby = scanner.scan(adapter)
+    if not nearby:
+        return {'error': 'No networks detected'}
+
+    n = fingerprint.append_scan(path, point['x'], point['y'], point['floor'], nearby)
+    return {'survey': n}
+
+
+def begin_survey(renderer):
+    # Record a fingerprint at the selected survey point
+    scans.request({
+        'task': survey_scan,
+        'point': dict(renderer.new_router),
+        'adapter': cfg['ADAPTER'],
+        'path': cfg['RADIO_MAP_PATH']
+    })
 
 
 def auto_scan(renderer):
     # Main Renderer object
-    # Custom adapter name
-    # Automatic scan (auto-update)
+    # Automatic scan (auto-update), started and stopped by the button
 
     activated = renderer.window.autoScanButton.isChecked()
     msg = 'Auto scan started' if activated else 'Auto scan stopped'
     window.status.showMessage(msg, 5000)
 
+    auto_timer.stop()
+    scans.follow = None
     if activated:
-        # Do a scan
-        begin_scan(renderer)
-        # Repeat this method call in N seconds (will check if button still pressed too)
-        QTimer.singleShot(cfg['AUTO_SEC']*1000, lambda: auto_scan(renderer))
+        schedule.reset()
+        next_auto_scan(renderer)
+
+
+def next_auto_scan(renderer):
+    # Start an automatic scan. The next one is only scheduled once
+    # this one has finished, so scans never overlap.
+
+    if not renderer.window.autoScanButton.isChecked():
         return
 
+    schedule.begin()
+    begin_scan(renderer)
+    scans.follow = lambda result: auto_scan_done(renderer, result)
+
+
+def auto_scan_done(renderer, result):
+    # Schedule the next automatic scan based on the finished one
+    delay = schedule.end(result.get('user'))
+
+    if scanner.backend is not None:
+        # Replayed and event-driven scans are paced by their source
+        # (the recorded pace, or the radio reporting results),
+        # so the next one starts right away
+        if not scanner.backend.finished:
+            next_auto_scan(renderer)
+        return
+
+    window.status.showMessage(f'Next scan in {delay:.1f} s, {schedule.rate():.1f} fixes/min')
+    auto_timer.start(int(delay * 1000))
 
-def load_routers(path):
-    # Load data for all routers from storage
-
-    # Open and read file
-    with open(path, 'r') as f:
-        rows = f.read().splitlines()
-
-    # Skip first row
-    if rows[0].startswith('x'):
-        rows = rows[1:]
-
-    # Save router data into a dictionary
-    routers_dict = {}
-    for row in rows:
-        if len(row) == 0 or not row:
-            continue
-
-        row = row.split(',')
-
-        mac = row[2]
-        routers_dict[mac] = {
-            'x': int(row[0]),
-            'y': int(row[1]),
-            'SSID': row[3],
-            'floor': int(row[4]),
-            'freq': int(row[5]),
-            'name': row[6].strip()
-        }
 
-    return routers_dict
+def load_routers(path):
+    # Load data for all routers from storage into a RouterTable.
+    # The compiled database is rebuilt first if the CSV has changed.
+    return routerdb.load(path)
 
 
 def save_router(path, rr):
@@ -411,7 +718,7 @@ def save_new_router(result_ok, renderer, nr_dialog):
     # User clicked on 'OK' and all fields are correct
     if result_ok and data_ok:
         # Check if a router with the same MAC already exists
-        if data['MAC'] in renderer.routers.keys():
+        if data['MAC'] in renderer.routers:
             window.status.showMessage('A router with the desired MAC already exists', 5000)
             add_new_router(renderer, nr_dialog)
             return
@@ -446,6 +753,13 @@ if __name__ == "__main__":
     with open('config.json', 'r') as f:
         cfg = json.load(f)
 
+    # Positioning constants derived from the config
+    lcfg = locator.LocatorConfig.from_dict(cfg)
+    # Particle filter for the tracking method, used by the scan worker only
+    ptracker = tracker.ParticleTracker.from_dict(cfg, lcfg)
+    # Surveyed radio map for fingerprinting, reloaded when it changes
+    radio_map = fingerprint.RadioMapFile(cfg['RADIO_MAP_PATH'], lcfg.rssi_floor, cfg['FP_NEIGHBOURS'])
+
     # Initial attributes
     QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication(sys.argv)
@@ -460,6 +774,17 @@ if __name__ == "__main__":
     window.status = QStatusBar()
     window.setStatusBar(window.status)
 
+    # Stage latencies, shown next to the status messages
+    if cfg['METRICS']:
+        metrics.enable()
+        window.metricsLabel = QLabel()
+        window.status.addPermanentWidget(window.metricsLabel)
+        window.paintTimer = uic.PaintTimer(window.mapView)
+        if cfg['METRICS_PORT']:
+            metrics.serve(cfg['METRICS_PORT'])
+        if cfg['METRICS_FILE']:
+            app.aboutToQuit.connect(lambda: metrics.export(cfg['METRICS_FILE']))
+
     # Load all routers and locations
     routers = load_routers(cfg['ROUTERS_FILE_PATH'])
 
@@ -473,6 +798,23 @@ if __name__ == "__main__":
     # Save new router dialog window object to the map renderer class
     mr.nr = nr_dialog
 
+    # Record, replay or cache scans if configured
+    scanner.configure(cfg['SCAN_RECORD'], cfg['SCAN_REPLAY'], cfg['REPLAY_SPEED'],
+                      cache=cfg['SCAN_CACHE_SEC'], refresh=cfg['SCAN_REFRESH_SEC'],
+                      merge_by=cfg['SCAN_MERGE'], adapter_timeout=cfg['SCAN_TIMEOUT'],
+                      events=cfg['ADAPTER'] if cfg['SCAN_EVENTS'] else None)
+    app.aboutToQuit.connect(scanner.close)
+
+    # Init the background scan worker
+    scans = ScanController(mr)
+    app.aboutToQuit.connect(scans.stop)
+
+    # Auto scan, adapting its pace to the user's movement
+    schedule = scheduler.AdaptiveSchedule.from_dict(cfg, lcfg.px_scale)
+    auto_timer = QTimer()
+    auto_timer.setSingleShot(True)
+    auto_timer.timeout.connect(lambda: next_auto_scan(mr))
+
     # Connect button controls
     window.quitButton.clicked.connect(sys.exit)
     window.scanButton.clicked.connect(lambda: begin_scan(mr))
@@ -481,13 +823,16 @@ if __name__ == "__main__":
     window.scalePlusButton.clicked.connect(lambda: mr.scale_map(True))
     window.scaleMinusButton.clicked.connect(lambda: mr.scale_map(False))
     window.simpleMapView.clicked.connect(lambda: mr.render())
+    window.surveyButton.clicked.connect(lambda: mr.render())
     window.mapOverlayView.clicked.connect(lambda: mr.render())
 
     # Display window and start app
     window.status.showMessage('Ready', 5000)
 
-    if not cfg['ADAPTER']:
+    if not cfg['ADAPTER'] and not cfg['SCAN_REPLAY']:
         window.status.showMessage('Wireless adapter name is not configured!', 5000)
 
     window.show()
+    # Load floor maps in the background once the window is up
+    QTimer.singleShot(0, mr.prewarm)
     sys.exit(app.exec())
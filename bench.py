@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+
+"""
+bench.py
+Anton Slavin
+
+Benchmark suite for the hot paths of the app. No Wi-Fi adapter or
+display is needed: scanner output is synthesized (or read from captured
+files) and the map is rendered with the offscreen Qt platform.
+
+Benchmarks:
+    parse_*         scanner parsers on scan output
+    load_*          routers database from CSV and compiled binary file,
+                    for the real and a synthetic large CSV
+    locate_*        single scan positioning per method and AP count,
+                    and the particle filter tracker
+    locate_batch_*  vectorized positioning of many scans per method
+    render_*        MapRenderer.render on the same and changing floors
+
+Usage:
+    python3 bench.py run [--out FILE] [--only PREFIX] [--captures DIR]
+    python3 bench.py compare BASELINE [CURRENT] [--tolerance 0.2]
+
+Captured outputs are read from DIR/iw.txt, DIR/netsh.txt and
+DIR/airport.txt when given. compare exits with status 1 if any
+benchmark is slower than the baseline by more than the tolerance.
+"""
+
+
+# Packages
+import contextlib
+import statistics
+import platform
+import argparse
+import tempfile
+import json
+import time
+import sys
+import os
+
+import numpy as np
+
+import routerdb
+import scanner
+import locator
+import tracker
+import loadgen
+
+
+# Timing
+SAMPLES = 7             # timed samples per benchmark
+SAMPLE_SEC = 0.05       # minimum duration of one sample
+
+LARGE_CSV_ROWS = 50000
+LOCATE_APS = [3, 8, 16, 32]
+LOCATE_SCANS = 50
+BATCH_SCANS = 2000
+PARSE_NETWORKS = 60
+
+METHODS = {
+    'mean': locator.MEAN,
+    'trilat': locator.TRILAT,
+    'multilat': locator.MULTILAT
+}
+
+
+def measure(fn, per_call=1):
+    # Time fn, calling it as many times per sample as needed to
+    # reach SAMPLE_SEC. Returns seconds per operation, where one call
+    # performs per_call operations.
+
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= SAMPLE_SEC:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(SAMPLE_SEC / elapsed) + 1))
+
+    times = [elapsed / number]
+    for _ in range(SAMPLES - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+
+    times = [t / per_call for t in times]
+    return {
+        'median': statistics.median(times),
+        'min': min(times),
+        'max': max(times),
+        'samples': len(times),
+        'number': number
+    }
+
+
+
+def make_iw_output(rng, n, adapter='wlan0'):
+    # Synthetic output of iw <adapter> scan
+    lines = []
+    for _ in range(n):
+        mac = routerdb.int_to_mac(int(rng.integers(2**48)))
+        lines += [
+            f'BSS {mac}(on {adapter})',
+            '\tlast seen: 1034.112s [boottime]',
+            '\tTSF: 3912038171 usec (0d, 01:05:12)',
+            f'\tfreq: {rng.choice([2412, 2437, 5180, 5500])}',
+            '\tbeacon interval: 100 TUs',
+            '\tcapability: ESS Privacy SpectrumMgmt (0x0111)',
+            f'\tsignal: {-rng.integers(30, 95)}.00 dBm',
+            '\tlast seen: 60 ms ago',
+            f'\tSSID: {rng.choice(["eduroam", "ut-public", "Delta"])}',
+            '\tSupported rates: 6.0* 9.0 12.0* 18.0 24.0* 36.0 48.0 54.0',
+            '\tRSN:\t * Version: 1',
+            '\t\t * Group cipher: CCMP',
+            '\t\t * Pairwise ciphers: CCMP',
+            '\t\t * Authentication suites: IEEE 802.1X'
+        ]
+    return lines
+
+
+def make_netsh_output(rng, n, per_ssid=8):
+    # Synthetic output of netsh wlan show networks mode=bssid
+    lines = ['', 'Interface name : Wi-Fi', f'There are {n} networks currently visible.', '']
+    for s in range(0, n, per_ssid):
+        lines += [
+            f'SSID {s // per_ssid + 1} : {rng.choice(["eduroam", "ut-public", "Delta"])}',
+            '    Network type            : Infrastructure',
+            '    Authentication          : WPA2-Enterprise',
+            '    Encryption              : CCMP'
+        ]
+        for b in range(min(per_ssid, n - s)):
+            mac = routerdb.int_to_mac(int(rng.integers(2**48)))
+            lines += [
+                f'    BSSID {b + 1}                 : {mac}',
+                f'         Signal             : {rng.integers(5, 100)}%',
+                '         Radio type         : 802.11ac',
+                '         Channel            : 36',
+                '         Basic rates (Mbps) : 6 12 24'
+            ]
+        lines.append('')
+    return lines
+
+
+def make_airport_output(rng, n):
+    # Synthetic output of airport -s
+    lines = ['                            SSID BSSID             RSSI CHANNEL HT CC SECURITY (auth/unicast/group)']
+    for _ in range(n):
+        mac = routerdb.int_to_mac(int(rng.integers(2**48)))
+        ssid = rng.choice(['eduroam', 'ut-public', 'Delta'])
+        lines.append(f'{ssid:>32} {mac} {-rng.integers(30, 95)}  36      Y  EE WPA2(802.1x/AES/AES)')
+    return lines
+
+
+def read_capture(captures, name):
+    # Lines of a captured scan output, None if not available
+    if not captures:
+        return None
+    path = os.path.join(captures, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read().splitlines()
+
+
+def make_large_csv(path, rows, seed=0):
+    # Synthetic routers CSV with the same format as data/routers.csv
+    rng = np.random.default_rng(seed)
+    macs = rng.choice(2**48, rows, replace=False)
+    with open(path, 'w') as f:
+        f.write('x,y,mac,ssid,floor,frequency,name\n')
+        for m in macs:
+            f.write(f'{rng.integers(5300)},{rng.integers(5553)},{routerdb.int_to_mac(m)},'
+                    f'eduroam,{rng.integers(1, 5)},{rng.choice([2400, 5000])},'
+                    f'{rng.integers(1000, 5000)}\n')
+
+
+
+def bench_parsers(captures):
+    rng = np.random.default_rng(0)
+    iw = read_capture(captures, 'iw.txt') or make_iw_output(rng, PARSE_NETWORKS)
+    netsh = read_capture(captures, 'netsh.txt') or make_netsh_output(rng, PARSE_NETWORKS)
+    airport = read_capture(captures, 'airport.txt') or make_airport_output(rng, PARSE_NETWORKS)
+
+    # Adapter name as given in the captured output
+    adapter = 'wlan0'
+    for line in iw:
+        if line.startswith('BSS ') and '(on ' in line:
+            adapter = line.split('(on ', 1)[1].split(')', 1)[0]
+            break
+
+    yield 'parse_iw', lambda: list(scanner.parse_iw(iter(iw), adapter)), 1
+    yield 'parse_netsh', lambda: list(scanner.parse_netsh(iter(netsh))), 1
+    yield 'parse_airport', lambda: list(scanner.parse_airport(iter(airport))), 1
+
+
+def bench_loading(cfg, tmp):
+    small = os.path.join(tmp, 'routers.csv')
+    with open(cfg['ROUTERS_FILE_PATH'], 'r') as src, open(small, 'w') as dst:
+        dst.write(src.read())
+
+    large = os.path.join(tmp, 'routers-large.csv')
+    make_large_csv(large, LARGE_CSV_ROWS)
+
+    for name,path in [('small', small), ('large', large)]:
+        routerdb.compile_db(path)
+        yield f'load_csv_{name}', lambda path=path: routerdb.load_csv(path), 1
+        yield f'load_db_{name}', lambda path=path: routerdb.load(path), 1
+        yield f'compile_db_{name}', lambda path=path: routerdb.compile_db(path), 1
+
+
+def bench_locate(routers, config):
+    for aps in LOCATE_APS:
+        scans = loadgen.make_scans(routers, config, LOCATE_SCANS, aps=aps, seed=aps)
+        # The full scan is kept, as with a low RSSI_MIN
+        scans = [locator.filter_nearby(routers, s, config.replace(rssi_min=config.rssi_floor))[0]
+                 for s in scans]
+
+        for name,method in METHODS.items():
+            def run(scans=scans, method=method):
+                for nearby in scans:
+                    locator.locate(routers, nearby, method, None, config)
+            yield f'locate_{name}_{aps}', run, len(scans)
+
+        # Particle filter following consecutive scans, one second apart
+        track = tracker.ParticleTracker(config, seed=0)
+        clock = {'t': 0.0}
+        def run_track(scans=scans, track=track, clock=clock):
+            for nearby in scans:
+                clock['t'] += 1.0
+                track.update(routers, nearby, clock['t'])
+        yield f'locate_track_{aps}', run_track, len(scans)
+
+
+def bench_locate_batch(routers, config):
+    scans = loadgen.make_scans(routers, config, BATCH_SCANS, aps=12)
+    packed = locator.pack_scans(routers, scans)
+    for name,method in METHODS.items():
+        yield (f'locate_batch_{name}',
+               lambda method=method: locator.locate_batch(*packed, method, config=config),
+               len(scans))
+
+
+def bench_render(cfg, routers, config):
+    # Offscreen Qt, imported only when rendering is benchmarked
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PySide6.QtWidgets import QApplication, QStatusBar
+        import ui.components as uic
+        import app
+    except ImportError as e:
+        print('[!] Skipping render benchmarks:', e)
+        return
+
+    qapp = QApplication.instance() or QApplication([])
+    app.cfg = cfg
+    window = app.load_UI(cfg['UI_FILE_PATH'])
+    window.status = QStatusBar()
+    window.setStatusBar(window.status)
+    mr = app.MapRenderer(window, routers)
+    mr.nr = uic.NewRouterDialog()
+    window.show()
+
+    # A located user with the strongest routers of a scan highlighted
+    nearby = locator.filter_nearby(routers, loadgen.make_scans(routers, config, 1)[0], config)[0]
+    user = locator.locate(routers, nearby, locator.MEAN, None, config)
+    mr.nearby_routers = nearby
+    mr.user.update(user)
+    mr.user['location'] = routers.name(routers.index([nearby[0]['MAC']])[0])
+
+    floors = list(range(cfg['MIN_FLOOR'], cfg['MAX_FLOOR'] + 1))
+    state = {'i': 0}
+
+    def render_floors():
+        mr.user['floor'] = floors[state['i'] % len(floors)]
+        state['i'] += 1
+        mr.render()
+
+    def render_same():
+        mr.user['floor'] = user['floor']
+        mr.render()
+
+    # Decode every floor once, the benchmarks measure the warm path
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        for _ in floors:
+            render_floors()
+        qapp.processEvents()
+
+    yield 'render_same', render_same, 1
+    yield 'render_floors', render_floors, 1
+
+
+
+def run_benchmarks(cfg, only=None, captures=None):
+    config = locator.LocatorConfig.from_dict(cfg)
+    routers = routerdb.load(cfg['ROUTERS_FILE_PATH'])
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Name prefixes of every group, so filtered out groups
+        # are not set up at all
+        groups = [
+            (['parse_'], lambda: bench_parsers(captures)),
+            (['load_', 'compile_db_'], lambda: bench_loading(cfg, tmp)),
+            (['locate_'], lambda: bench_locate(routers, config)),
+            (['locate_batch_'], lambda: bench_locate_batch(routers, config)),
+            (['render_'], lambda: bench_render(cfg, routers, config))
+        ]
+
+        for prefixes,group in groups:
+            if only and not any(p.startswith(only) or only.startswith(p) for p in prefixes):
+                continue
+            for name,fn,per_call in group():
+                if only and not name.startswith(only):
+                    continue
+                # render() prints on every call
+                with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                    res = measure(fn, per_call)
+                results[name] = res
+                print(f'{name:28} {format_time(res["median"]):>10}  (min {format_time(res["min"])})')
+
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine()
+        },
+        'results': results
+    }
+
+
+def format_time(sec):
+    for unit,scale in [('s', 1), ('ms', 1e3), ('us', 1e6)]:
+        if sec * scale >= 1:
+            return f'{sec * scale:.2f} {unit}'
+    return f'{sec * 1e9:.0f} ns'
+
+
+
+def compare(baseline, current, tolerance):
+    # Print the change of every benchmark against the baseline.
+    # Returns the names of the regressed benchmarks.
+
+    base = baseline['results']
+    cur = current['results']
+    regressed = []
+
+    print(f'{"benchmark":28} {"baseline":>10} {"current":>10} {"change":>8}')
+    for name in sorted(set(base) | set(cur)):
+        if name not in base or name not in cur:
+            side = 'new' if name not in base else 'missing'
+            print(f'{name:28} {side:>32}')
+            continue
+
+        # The minimum is the least noisy estimate of the best case,
+        # the median has to agree before a change is a regression
+        ratio = cur[name]['min'] / base[name]['min']
+        slower = ratio > 1 + tolerance and cur[name]['median'] > base[name]['median'] * (1 + tolerance)
+        flag = '  <- regression' if slower else ''
+        if slower:
+            regressed.append(name)
+
+        print(f'{name:28} {format_time(base[name]["min"]):>10} '
+              f'{format_time(cur[name]["min"]):>10} {(ratio - 1) * 100:+7.1f}%{flag}')
+
+    return regressed
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the positioning and rendering hot paths')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--config', default='config.json')
+    run_parser.add_argument('--out', default='bench.json', help='results file')
+    run_parser.add_argument('--only', help='only run benchmarks starting with this prefix')
+    run_parser.add_argument('--captures', help='folder with captured iw.txt, netsh.txt and airport.txt')
+
+    cmp_parser = sub.add_parser('compare', help='compare results against a baseline')
+    cmp_parser.add_argument('baseline')
+    cmp_parser.add_argument('current', nargs='?', default='bench.json')
+    cmp_parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='allowed slowdown as a fraction, 0.2 by default')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        # Load config file
+        with open(args.config, 'r') as f:
+            cfg = json.load(f)
+
+        results = run_benchmarks(cfg, args.only, args.captures)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Saved results to', args.out)
+
+    else:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        with open(args.current, 'r') as f:
+            current = json.load(f)
+
+        regressed = compare(baseline, current, args.tolerance)
+        if regressed:
+            print(f'[!] {len(regressed)} benchmark(s) regressed by more than {args.tolerance:.0%}')
+            sys.exit(1)
+        print('No regressions.')
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+
+"""
+calibrate.py
+Anton Slavin
+
+Calibration sweep of the positioning constants.
+
+Takes a labelled set of scans with known positions: the fingerprints
+recorded in survey mode, or synthetic scans generated from the routers
+database. Candidate values of POWER, PATH_LOSS, DIST_THRESHOLD,
+RAD_NORM and RSSI_MIN are searched on a grid or at random, for every
+selected method. Each candidate locates the whole set at once with
+locate_batch, and candidates are spread over a process pool.
+
+The scans are filtered and packed once. A candidate's RSSI_MIN is then
+applied by masking the packed RSSI values, as filtering keeps a prefix
+of the RSSI-sorted routers. With mean AP fusion this is approximate, as
+the packed values are fused over BSSIDs above the lowest RSSI_MIN.
+
+Routers with a fitted path-loss model (see fit_pathloss.py) keep it for
+every candidate, as in the locator. The POWER and PATH_LOSS candidates
+only apply to the other routers.
+
+Candidates are scored by median and 90th percentile position error (in
+meters, scans that cannot be located count as infinitely far off), by
+how well the radius matches the error, and by the compute time per fix.
+The Pareto-best candidates for error versus compute are printed, best
+error first, with the config file values of the best one.
+
+Usage:
+    python3 calibrate.py [--labelled FILE | --synthetic N]
+                         [--grid STEPS | --random N] [--methods mean,trilat,multilat]
+                         [--range KEY=LO:HI] [--workers N] [--out FILE] [--top N]
+"""
+
+
+# Packages
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import argparse
+import json
+import time
+import os
+
+import numpy as np
+
+import fingerprint
+import routerdb
+import locator
+
+
+# Default search space, in config file units
+RANGES = {
+    'POWER': (-15.0, 10.0),
+    'PATH_LOSS': (1.5, 4.0),
+    'DIST_THRESHOLD': (20, 600),
+    'RAD_NORM': (0.1, 1.0),
+    'RSSI_MIN': (-95, -60)
+}
+INTEGER_KEYS = {'DIST_THRESHOLD', 'RSSI_MIN'}
+
+METHODS = {
+    'mean': locator.MEAN,
+    'trilat': locator.TRILAT,
+    'multilat': locator.MULTILAT
+}
+
+REPEATS = 3             # timed runs per candidate, the fastest counts
+COST_TOL = 0.1          # compute times within 10% are considered equal
+SYNTH_NOISE = 4.0       # dB, RSSI noise of synthetic scans
+
+# Labelled set of the worker processes, set by init_worker
+labelled = None
+
+
+
+def read_labelled(path):
+    # Scans and true positions from a radio map file.
+    # Returns (scans, x, y, floor) with one scan (list of network
+    # dicts) per surveyed point.
+
+    rows = fingerprint.read_rows(path)
+    pids, first, inverse = np.unique(rows['point'], return_index=True, return_inverse=True)
+
+    scans = [[] for _ in pids]
+    for i,row in zip(inverse.tolist(), rows[['mac', 'rssi']].tolist()):
+        scans[i].append({'MAC': routerdb.int_to_mac(row[0]), 'RSSI': int(row[1])})
+
+    return (scans, rows['x'][first].astype(float), rows['y'][first].astype(float),
+            rows['floor'][first].astype(int))
+
+
+def make_labelled(routers, config, count, seed=0, power=None, path_loss=None):
+    # Synthetic scans at random positions next to random routers, with
+    # the RSSI of every router on the same floor from the path-loss
+    # model plus noise. The model is the config's unless per-router
+    # power and path_loss arrays are given.
+
+    rng = np.random.default_rng(seed)
+    power = np.full(len(routers), float(config.power)) if power is None else power
+    path_loss = np.full(len(routers), float(config.path_loss)) if path_loss is None else path_loss
+    macs = [routerdb.int_to_mac(m) for m in routers.macs]
+    scans = []
+    tx = np.zeros(count)
+    ty = np.zeros(count)
+    tfloor = np.zeros(count, dtype=int)
+
+    for k in range(count):
+        i = rng.integers(len(routers))
+        same = routers.on_floor(routers.floor[i])
+        tx[k] = routers.x[i] + rng.normal(0, 150)
+        ty[k] = routers.y[i] + rng.normal(0, 150)
+        tfloor[k] = routers.floor[i]
+
+        d = np.maximum(np.hypot(routers.x[same] - tx[k], routers.y[same] - ty[k]), 1.0)
+        rssi = power[same] - 10 * path_loss[same] * np.log10(d) + rng.normal(0, SYNTH_NOISE, len(d))
+        heard = rssi >= config.rssi_floor
+        scans.append([{'MAC': macs[r], 'RSSI': int(v)}
+                      for r,v in zip(same[heard], np.round(rssi[heard]))])
+
+    return scans, tx, ty, tfloor
+
+
+def pack_labelled(routers, scans, tx, ty, tfloor, config):
+    # Filter every scan with the lowest RSSI_MIN and pack the set for
+    # locate_batch, routers sorted by decreasing RSSI, along with the
+    # fitted path-loss models of the routers (NaN without a fit).
+    # Scans without any known router are dropped.
+
+    keep_all = config.replace(rssi_min=config.rssi_floor)
+    nearby = []
+    keep = []
+    for i,scan in enumerate(scans):
+        kept,_ = locator.filter_nearby(routers, scan, keep_all)
+        if kept:
+            kept.sort(key=lambda r: r['RSSI'], reverse=True)
+            nearby.append(kept)
+            keep.append(i)
+
+    x, y, floors, rssi, rows = locator.pack_scans(routers, nearby, with_rows=True)
+    power = path_loss = None
+    if routers.power is not None:
+        power = np.where(rows >= 0, routers.power[rows], np.nan)
+        path_loss = np.where(rows >= 0, routers.path_loss[rows], np.nan)
+
+    return {
+        'x': x, 'y': y, 'floors': floors, 'rssi': rssi,
+        'power': power, 'path_loss': path_loss,
+        'tx': tx[keep], 'ty': ty[keep], 'tfloor': tfloor[keep]
+    }
+
+
+def make_candidates(ranges, methods, grid=None, random=None, seed=0):
+    # Parameter dicts (config file keys plus 'method') on a grid with
+    # `grid` steps per parameter, or `random` uniform samples
+
+    keys = list(ranges)
+    if random:
+        rng = np.random.default_rng(seed)
+        combos = list(zip(*[rng.uniform(*ranges[key], random) for key in keys]))
+        combos = [(m,) + combo for m in methods for combo in combos]
+    else:
+        axes = [np.linspace(*ranges[key], grid) for key in keys]
+        combos = list(itertools.product(methods, *axes))
+
+    candidates = []
+    for method,*values in combos:
+        params = {'method': method}
+        for key,value in zip(keys, values):
+            params[key] = int(round(value)) if key in INTEGER_KEYS else round(float(value), 4)
+        candidates.append(params)
+    return candidates
+
+
+
+def init_worker(data, config):
+    global labelled
+    labelled = dict(data, config=config)
+
+
+def evaluate(params):
+    # Score one candidate on the labelled set of this worker
+    data = labelled
+    names = {key: name for name,key in locator.LocatorConfig.KEYS.items()}
+    config = data['config'].replace(**{names[k]: v for k,v in params.items() if k != 'method'})
+
+    with np.errstate(invalid='ignore'):
+        rssi = np.where(data['rssi'] >= config.rssi_min, data['rssi'], np.nan)
+
+    best = float('inf')
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        dist = model_dist(data, rssi, config)
+        fix = locator.locate_batch(data['x'], data['y'], data['floors'], rssi,
+                                   METHODS[params['method']], config=config, dist=dist)
+        best = min(best, time.perf_counter() - start)
+
+    # Scans left without routers by RSSI_MIN cannot be located
+    located = fix['valid'] & ~np.isnan(rssi).all(axis=1)
+    with np.errstate(invalid='ignore'):
+        err = np.hypot(fix['x'] - data['tx'], fix['y'] - data['ty']) / config.px_scale
+    err = np.where(located, err, np.inf)
+
+    n = len(err)
+    return dict(params, **{
+        'median_m': float(np.median(err)) if n else float('inf'),
+        'p90_m': float(np.percentile(err, 90, method='higher')) if n else float('inf'),
+        'radius_err_m': float(np.median(np.abs(fix['radius'] - err)[located])) if located.any() else float('inf'),
+        'floor_ok': float(np.mean(fix['floor'] == data['tfloor'])) if n else 0.0,
+        'located': float(np.mean(located)) if n else 0.0,
+        'us_per_fix': best / max(n, 1) * 1e6
+    })
+
+
+def model_dist(data, rssi, config):
+    # Distances with the fitted path-loss models, as router_dist gives
+    # them, the candidate's POWER and PATH_LOSS for routers without one.
+    # None if nothing was fitted.
+
+    if data['power'] is None:
+        return None
+
+    fitted = ~np.isnan(data['power'])
+    power = np.where(fitted, data['power'], config.power)
+    path_loss = np.where(fitted, data['path_loss'], config.path_loss)
+    return 10 ** ((power - rssi) / (10 * path_loss)) / config.px_scale
+
+
+def pareto(results):
+    # Results not dominated in median error, radius error and compute.
+    # Compute times within COST_TOL count as equal, as timing is noisy,
+    # and of results with equal errors only the first is kept.
+
+    def dominates(a, b):
+        better = (a['median_m'] <= b['median_m'] and a['radius_err_m'] <= b['radius_err_m']
+                  and a['us_per_fix'] <= b['us_per_fix'] * (1 + COST_TOL))
+        equal = a['median_m'] == b['median_m'] and a['radius_err_m'] == b['radius_err_m']
+        strictly = (a['median_m'] < b['median_m'] or a['radius_err_m'] < b['radius_err_m']
+                    or a['us_per_fix'] < b['us_per_fix'] * (1 - COST_TOL))
+        return better and (strictly or equal)
+
+    # Sorted by error, only earlier results can dominate a later one
+    ranked = sorted(results, key=lambda r: (r['median_m'], r['radius_err_m'], r['us_per_fix']))
+    front = []
+    for r in ranked:
+        if not any(dominates(f, r) for f in front):
+            front.append(r)
+    return front
+
+
+def sweep(data, config, candidates, workers=None):
+    # Evaluate all candidates over a process pool
+    chunk = max(1, len(candidates) // ((workers or os.cpu_count() or 1) * 8))
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(data, config)) as pool:
+        return list(pool.map(evaluate, candidates, chunksize=chunk))
+
+
+def print_results(front, top):
+    keys = ['method'] + list(RANGES)
+    print(f'{"method":9}' + ''.join(f'{k:>15}' for k in keys[1:]) +
+          f'{"median m":>10}{"p90 m":>8}{"radius":>8}{"floor":>7}{"us/fix":>8}')
+    for r in front[:top]:
+        print(f'{r["method"]:9}' + ''.join(f'{r[k]:>15}' for k in keys[1:]) +
+              f'{r["median_m"]:>10.2f}{r["p90_m"]:>8.2f}{r["radius_err_m"]:>8.2f}'
+              f'{r["floor_ok"]:>7.0%}{r["us_per_fix"]:>8.1f}')
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calibration sweep of the positioning constants')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--labelled', help='radio map file with the labelled scans, RADIO_MAP_PATH by default')
+    parser.add_argument('--synthetic', type=int, help='use this many synthetic scans instead')
+    parser.add_argument('--grid', type=int, default=5, help='grid steps per parameter')
+    parser.add_argument('--random', type=int, help='random candidates per method instead of a grid')
+    parser.add_argument('--methods', default='mean,trilat,multilat')
+    parser.add_argument('--range', action='append', default=[], metavar='KEY=LO:HI',
+                        help='search range of a parameter, e.g. PATH_LOSS=2:3')
+    parser.add_argument('--workers', type=int, help='worker processes, one per CPU by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--top', type=int, default=20, help='Pareto-best candidates to print')
+    parser.add_argument('--out', help='write all results to this JSON file')
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config, 'r') as f:
+        cfg = json.load(f)
+
+    config = locator.LocatorConfig.from_dict(cfg)
+    routers = routerdb.load(cfg['ROUTERS_FILE_PATH'])
+
+    ranges = dict(RANGES)
+    for item in args.range:
+        key, bounds = item.split('=', 1)
+        if key not in RANGES:
+            parser.error(f'unknown parameter {key}, choose from {", ".join(RANGES)}')
+        lo, hi = bounds.split(':')
+        ranges[key] = (float(lo), float(hi))
+
+    methods = args.methods.split(',')
+    for method in methods:
+        if method not in METHODS:
+            parser.error(f'unknown method {method}')
+
+    if args.synthetic:
+        labelled_set = make_labelled(routers, config, args.synthetic, args.seed)
+    else:
+        path = args.labelled or cfg['RADIO_MAP_PATH']
+        if not os.path.exists(path):
+            parser.error(f'no labelled scans at {path}, survey some or use --synthetic N')
+        labelled_set = read_labelled(path)
+
+    data = pack_labelled(routers, *labelled_set, config)
+    candidates = make_candidates(ranges, methods, args.grid, args.random, args.seed)
+    print(f'{len(data["tx"])} labelled scans, {len(candidates)} candidates')
+
+    start = time.perf_counter()
+    results = sweep(data, config, candidates, args.workers)
+    print(f'Evaluated in {time.perf_counter() - start:.1f} s\n')
+
+    front = pareto(results)
+    print_results(front, args.top)
+
+    best = front[0]
+    print('\nBest config file values:')
+    print(json.dumps({k: best[k] for k in RANGES}, indent=4))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'ranges': ranges, 'results': results, 'pareto': front}, f, indent=2)
+        print('Saved results to', args.out)
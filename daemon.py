@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""
+daemon.py
+Anton Slavin
+
+Headless positioning daemon.
+
+Runs the scan -> filter -> locate pipeline on a fixed schedule without
+the GUI and streams every fix as a JSON line, either to stdout or to
+all clients connected to a TCP port. Does not import Qt or scipy.
+
+Usage:
+    python3 daemon.py [--method mean|trilat|multilat|track] [--interval SEC]
+                      [--listen HOST:PORT] [--count N] [--config PATH]
+                      [--record LOG | --replay LOG [--speed X]]
+"""
+
+
+# Packages
+import contextlib
+import argparse
+import threading
+import socket
+import json
+import time
+import sys
+
+import routerdb
+import scanner
+import locator
+import scheduler
+import tracker
+import metrics
+
+
+METHODS = {
+    'mean': locator.MEAN,
+    'trilat': locator.TRILAT,
+    'multilat': locator.MULTILAT
+}
+
+
+def fix_once(routers, method, prev, adapter, config, track=None):
+    # Run one scan and return the fix as a dict, or None if the
+    # scan did not contain enough usable routers.
+    # If a tracker is given, it is updated instead of a single fix.
+
+    nearby = scanner.scan(adapter)
+    try:
+        with metrics.stage('filter'):
+            nearby,_ = locator.filter_nearby(routers, nearby, config)
+    except (KeyError, TypeError, ValueError, OverflowError):
+        # Malformed scan, e.g. from a damaged scan log
+        return None
+
+    if len(nearby) == 0:
+        return None
+
+    with metrics.stage('locate'):
+        if track is not None:
+            user = track.update(routers, nearby)
+        else:
+            user = locator.locate(routers, nearby, method, prev, config)
+    if user is None:
+        return None
+
+    return {
+        'x': round(float(user['x']), 1),
+        'y': round(float(user['y']), 1),
+        'floor': int(user['floor']),
+        'radius': round(float(user['radius']), 2),
+        'location': routers.name(routers.index([nearby[0]['MAC']])[0]),
+        'aps': len(nearby)
+    }
+
+
+
+class LineBroadcaster(object):
+    # Accepts TCP clients in a background thread and sends every
+    # line to all of them. Slow or closed clients are dropped.
+
+    def __init__(self, host, port):
+        self.server = socket.create_server((host, port))
+        self.clients = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            conn,_ = self.server.accept()
+            conn.settimeout(1.0)
+            with self.lock:
+                self.clients.append(conn)
+
+    def write(self, line):
+        data = line.encode('utf-8')
+        with self.lock:
+            for conn in list(self.clients):
+                try:
+                    conn.sendall(data)
+                except OSError:
+                    self.clients.remove(conn)
+                    conn.close()
+
+    def flush(self):
+        pass
+
+
+
+def run(routers, method, adapter, config, schedule, out, count=None, track=None):
+    # Produce fixes at the pace of the AdaptiveSchedule `schedule` and
+    # write them to `out` as JSON lines. Stops after `count` fixes if given.
+
+    prev = None
+    done = 0
+    while count is None or done < count:
+        if scanner.backend is not None and scanner.backend.finished:
+            break
+        schedule.begin()
+
+        # Diagnostic prints go to stderr, keeping the stream clean
+        with contextlib.redirect_stdout(sys.stderr), metrics.stage('fix'):
+            user = fix_once(routers, method, prev, adapter, config, track)
+        if user is not None:
+            prev = user
+            user['t'] = round(time.time(), 3)
+            out.write(json.dumps(user, separators=(',', ':')) + '\n')
+            out.flush()
+            done += 1
+
+        # Keep the schedule regardless of how long the scan took.
+        # Replayed and event-driven scans are paced by their source.
+        delay = schedule.end(user)
+        if scanner.backend is None:
+            time.sleep(delay)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless Wi-Fi positioning')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--method', choices=list(METHODS) + ['track'], default='mean')
+    parser.add_argument('--interval', type=float, help='seconds between fixes (at the start if AUTO_ADAPTIVE), AUTO_SEC by default')
+    parser.add_argument('--listen', help='HOST:PORT to stream fixes to TCP clients instead of stdout')
+    parser.add_argument('--count', type=int, help='stop after this many fixes')
+    parser.add_argument('--adapter', help='Wi-Fi adapter name, ADAPTER by default')
+    parser.add_argument('--record', help='append every scan to this log, SCAN_RECORD by default')
+    parser.add_argument('--replay', help='replay scans from this log instead of scanning, SCAN_REPLAY by default')
+    parser.add_argument('--speed', type=float, help='replay speed, 0 for as fast as possible, REPLAY_SPEED by default')
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config, 'r') as f:
+        cfg = json.load(f)
+
+    config = locator.LocatorConfig.from_dict(cfg)
+    routers = routerdb.load(cfg['ROUTERS_FILE_PATH'])
+    interval = args.interval if args.interval is not None else cfg['AUTO_SEC']
+    adapter = args.adapter or cfg['ADAPTER']
+    speed = args.speed if args.speed is not None else cfg['REPLAY_SPEED']
+    scanner.configure(args.record or cfg['SCAN_RECORD'], args.replay or cfg['SCAN_REPLAY'], speed,
+                      cache=cfg['SCAN_CACHE_SEC'], refresh=cfg['SCAN_REFRESH_SEC'],
+                      merge_by=cfg['SCAN_MERGE'], adapter_timeout=cfg['SCAN_TIMEOUT'],
+                      events=adapter if cfg['SCAN_EVENTS'] else None)
+
+    out = sys.stdout
+    if args.listen:
+        host, port = args.listen.rsplit(':', 1)
+        out = LineBroadcaster(host, int(port))
+
+    # Stage latencies, served while running and written on exit
+    if cfg['METRICS']:
+        metrics.enable()
+        if cfg['METRICS_PORT']:
+            metrics.serve(cfg['METRICS_PORT'])
+
+    try:
+        track = tracker.ParticleTracker.from_dict(cfg, config) if args.method == 'track' else None
+        schedule = scheduler.AdaptiveSchedule.from_dict(dict(cfg, AUTO_SEC=interval), config.px_scale)
+        run(routers, METHODS.get(args.method, locator.MEAN), adapter, config, schedule, out,
+            args.count, track)
+        print(f'Effective fix rate: {schedule.rate():.1f} fixes/min', file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scanner.close()
+
+    if cfg['METRICS'] and cfg['METRICS_FILE']:
+        metrics.export(cfg['METRICS_FILE'])
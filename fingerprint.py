@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+"""
+fingerprint.py
+Anton Slavin
+
+Fingerprinting positioning over a surveyed radio map.
+
+During a survey, every scan taken at a known map point is appended to
+the radio map file as one fixed-width row per heard network, so the
+whole file is loaded with a single np.frombuffer call. On load, the
+reference points of every floor are turned into RSSI vectors aligned
+by BSSID, with unheard networks set to the RSSI floor.
+
+A scan is resolved by weighted k-nearest-neighbour search on the floor
+it matches best. Vectors are projected onto their main principal
+components and indexed with a cKDTree; the nearest candidates in the
+projected space are then re-ranked by their exact distance, which keeps
+queries fast with hundreds of thousands of reference points.
+Scans appended during a survey are read from the end of the file, and
+only the index of their floor is rebuilt, on the next query.
+
+File layout (little-endian):
+    header       magic, version
+    rows         point id, x, y, floor, MAC, RSSI
+"""
+
+
+# Packages
+from scipy.spatial import cKDTree
+import numpy as np
+import struct
+import os
+
+import routerdb
+import locator
+
+
+# Radio map format
+FP_MAGIC = b'DWFP'
+FP_VERSION = 1
+FP_HEADER = struct.Struct('<4sH')
+FP_ROW = np.dtype([
+    ('point', '<u4'),
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('floor', '<i2'),
+    ('mac', '<u8'),
+    ('rssi', 'i1')
+])
+
+# Search
+K = 4                   # neighbours averaged per fix
+PCA_DIMS = 16           # dimensions of the KD-tree
+CANDIDATES = 16         # candidates re-ranked per neighbour
+
+
+
+def append_scan(path, x, y, floor, networks):
+    # Append a survey scan (list of network dicts) taken at map point
+    # x, y on the given floor. Returns the number of networks saved.
+
+    macs = [routerdb.mac_to_int(nw['MAC']) for nw in networks]
+    rows = [(mac, nw['RSSI']) for mac,nw in zip(macs, networks) if mac >= 0]
+    if not rows:
+        return 0
+
+    point = 0
+    new = not os.path.exists(path) or os.path.getsize(path) == 0
+    if not new:
+        # Point ids continue from the last row in the file
+        n = (os.path.getsize(path) - FP_HEADER.size) // FP_ROW.itemsize
+        with open(path, 'rb') as f:
+            f.seek(FP_HEADER.size + (n - 1) * FP_ROW.itemsize)
+            point = int(np.frombuffer(f.read(FP_ROW.itemsize), dtype=FP_ROW)['point'][0]) + 1
+
+    data = np.zeros(len(rows), dtype=FP_ROW)
+    data['point'] = point
+    data['x'] = x
+    data['y'] = y
+    data['floor'] = floor
+    data['mac'] = [mac for mac,_ in rows]
+    data['rssi'] = np.clip(np.round([rssi for _,rssi in rows]), -128, 0)
+
+    with open(path, 'ab') as f:
+        if new:
+            f.write(FP_HEADER.pack(FP_MAGIC, FP_VERSION))
+        f.write(data.tobytes())
+
+    return len(rows)
+
+
+def read_rows(path, start=0):
+    # Rows of a radio map file from row start on as a structured array
+    with open(path, 'rb') as f:
+        header = f.read(FP_HEADER.size)
+        f.seek(FP_HEADER.size + start * FP_ROW.itemsize)
+        data = f.read()
+
+    if len(header) < FP_HEADER.size:
+        return np.zeros(0, dtype=FP_ROW)
+
+    magic, version = FP_HEADER.unpack(header)
+    if magic != FP_MAGIC or version != FP_VERSION:
+        print('[!] Not a radio map or unsupported version:', path)
+        return np.zeros(0, dtype=FP_ROW)
+
+    # A partially written last row is ignored
+    n = len(data) // FP_ROW.itemsize
+    return np.frombuffer(data, dtype=FP_ROW, count=n)
+
+
+
+class FloorIndex(object):
+    # Reference points of one floor and their search index
+
+    def __init__(self, macs, vectors, x, y, missing):
+        # macs: sorted uint64 BSSIDs, one per vector column
+        # vectors: (points, macs) float32 RSSI, missing where not heard
+
+        self.macs = macs
+        self.vectors = vectors
+        self.x = x
+        self.y = y
+        self.missing = missing
+
+        # Search index, built on the first query
+        self.tree = None
+
+
+    @classmethod
+    def from_rows(cls, rows, missing):
+        # Index of the rows of one floor, one reference point per point id
+        pids, first, inverse = np.unique(rows['point'], return_index=True, return_inverse=True)
+        macs, cols = np.unique(rows['mac'], return_inverse=True)
+
+        vectors = np.full((len(pids), len(macs)), missing, dtype=np.float32)
+        vectors[inverse.reshape(-1), cols.reshape(-1)] = rows['rssi']
+        return cls(macs, vectors, rows['x'][first].astype(float), rows['y'][first].astype(float), missing)
+
+
+    def build(self):
+        # Principal components of the vectors, at most PCA_DIMS
+        self.mean = self.vectors.mean(axis=0)
+        sample = self.vectors[::max(1, len(self.vectors) // 20000)] - self.mean
+        _, _, vt = np.linalg.svd(sample, full_matrices=False)
+        self.basis = np.ascontiguousarray(vt[:PCA_DIMS].T)
+        self.tree = cKDTree((self.vectors - self.mean) @ self.basis)
+
+
+    def vector(self, macs, rssi):
+        # Query vector aligned with the columns of this floor
+        vec = np.full(len(self.macs), self.missing, dtype=np.float32)
+        cols = np.searchsorted(self.macs, macs)
+        cols = np.minimum(cols, len(self.macs) - 1)
+        found = self.macs[cols] == macs
+        vec[cols[found]] = rssi[found]
+        return vec
+
+
+    def score(self, macs, rssi):
+        # How well a scan matches this floor: signal strength of the
+        # scanned networks that were also heard during the survey
+        cols = np.minimum(np.searchsorted(self.macs, macs), len(self.macs) - 1)
+        found = self.macs[cols] == macs
+        return float(np.sum(rssi[found] - self.missing))
+
+
+    def query(self, vec, k):
+        # Indices and exact distances of the k nearest reference points
+        if self.tree is None:
+            self.build()
+
+        k = min(k, len(self.vectors))
+        m = min(k * CANDIDATES, len(self.vectors))
+        _, cand = self.tree.query((vec - self.mean) @ self.basis, m)
+        cand = np.atleast_1d(cand)
+
+        diff = self.vectors[cand] - vec
+        dist = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+        best = np.argsort(dist)[:k]
+        return cand[best], dist[best]
+
+
+
+class RadioMap(object):
+    def __init__(self, rows, missing=-100):
+        # rows: structured array of FP_ROW
+        # missing: RSSI of networks that were not heard
+
+        self.missing = missing
+        self.floors = {}
+        self.points = 0
+
+        # Rows of every floor, and floors whose index is out of date
+        self.rows = {}
+        self.dirty = set()
+        self.add(rows)
+
+
+    def add(self, rows):
+        # Add survey rows, e.g. scans appended to the file. The indexes
+        # of their floors are rebuilt on the next query.
+
+        if len(rows) == 0:
+            return
+
+        for floor in np.unique(rows['floor']):
+            floor = int(floor)
+            sel = rows[rows['floor'] == floor]
+            self.rows[floor] = np.concatenate([self.rows[floor], sel]) if floor in self.rows else sel
+            self.dirty.add(floor)
+
+
+    def refresh(self):
+        # Rebuild the indexes of floors with added rows
+        for floor in self.dirty:
+            self.floors[floor] = FloorIndex.from_rows(self.rows[floor], self.missing)
+        self.dirty.clear()
+        self.points = sum(len(index.vectors) for index in self.floors.values())
+
+
+    @classmethod
+    def load(cls, path, missing=-100):
+        # Radio map from a file, empty if the file does not exist
+        if not os.path.exists(path):
+            return cls(np.zeros(0, dtype=FP_ROW), missing)
+        return cls(read_rows(path), missing)
+
+
+    def __len__(self):
+        self.refresh()
+        return self.points
+
+
+    def locate(self, nearby_routers, config=None, k=K):
+        # Weighted kNN fix of a scan (list of network dicts).
+        # Returns a user dict like locator.locate, or None.
+
+        config = config or locator.default_config()
+        self.refresh()
+        if not self.floors:
+            return None
+
+        macs = np.array([routerdb.mac_to_int(nw['MAC']) for nw in nearby_routers], dtype=np.int64)
+        rssi = np.array([nw['RSSI'] for nw in nearby_routers], dtype=np.float32)
+        known = macs >= 0
+        macs, rssi = macs[known].astype(np.uint64), rssi[known]
+        if len(macs) == 0:
+            return None
+
+        # Floor whose survey matches the scan best
+        floor = max(self.floors, key=lambda f: self.floors[f].score(macs, rssi))
+        index = self.floors[floor]
+        if index.score(macs, rssi) <= 0:
+            return None
+
+        idx, dist = index.query(index.vector(macs, rssi), k)
+        w = 1.0 / (dist + 1.0)
+        w /= w.sum()
+        x = float(np.dot(w, index.x[idx]))
+        y = float(np.dot(w, index.y[idx]))
+
+        # Radius from the spread of the neighbours
+        spread = np.dot(w, (index.x[idx] - x)**2 + (index.y[idx] - y)**2)
+        return {
+            'x': x,
+            'y': y,
+            'floor': floor,
+            'radius': min(float(np.sqrt(spread)) / config.px_scale, config.rad_threshold)
+        }
+
+
+
+class RadioMapFile(object):
+    # Radio map file that follows changes of the file. Rows appended to
+    # it, e.g. survey scans, are added to the loaded map; other changes
+    # reload the whole file.
+
+    def __init__(self, path, missing=-100, k=K):
+        self.path = path
+        self.missing = missing
+        self.k = k
+        self.size = None
+        self.count = 0
+        self.radio_map = None
+
+    def locate(self, nearby_routers, config=None):
+        return self.get().locate(nearby_routers, config, self.k)
+
+    def get(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if self.radio_map is None or size < self.size or self.size < FP_HEADER.size:
+            self.radio_map = RadioMap.load(self.path, self.missing)
+            self.count = sum(len(rows) for rows in self.radio_map.rows.values())
+        elif size > self.size:
+            rows = read_rows(self.path, self.count)
+            self.radio_map.add(rows)
+            self.count += len(rows)
+        self.size = size
+        return self.radio_map
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+fit_pathloss.py
+Anton Slavin
+
+Fitting of path-loss models per router, band or floor.
+
+Estimates the transmit power and exponent of the log-distance model
+used by the locator, rssi = power - 10 * path_loss * log10(distance),
+from scans taken at known positions: the fingerprints recorded in
+survey mode, or synthetic scans. Routers are grouped by physical AP,
+BSSID, band, floor, or band and floor, and all groups are fitted at
+once from per-group sums of the least-squares normal equations.
+
+Scans are filtered as for positioning. Per AP, the models are fitted on
+the fused RSSI the locator sees with AP fusion. Other groupings are
+fitted per BSSID without fusion, as an AP's BSSIDs may be on different
+bands. Only routers on the floor of the scan are used. Groups with too
+few observations, too little spread of distance or an implausible
+exponent keep the global POWER and PATH_LOSS.
+
+The models are written next to the routers CSV file, where the locator
+picks them up on load.
+
+Usage:
+    python3 fit_pathloss.py [--labelled FILE | --synthetic N]
+                            [--by ap|bssid|band|floor|band-floor]
+                            [--min-obs N] [--out FILE] [--dry-run]
+"""
+
+
+# Packages
+import argparse
+import json
+import os
+
+import numpy as np
+
+import calibrate
+import routerdb
+import locator
+
+
+GROUPS = ['ap', 'bssid', 'band', 'floor', 'band-floor']
+
+MIN_OBS = 10            # observations needed to fit a group
+MIN_SPREAD = 2.0        # dB, spread of 10 * log10(distance) needed
+PATH_LOSS_RANGE = (1.2, 6.0)
+
+
+
+def observations(routers, scans, tx, ty, tfloor, config):
+    # Router rows, RSSI values and distances in pixels of every
+    # router heard on the floor of its scan, as flat arrays
+
+    keep_all = config.replace(rssi_min=config.rssi_floor)
+    rows, rssi, scan_ids = [], [], []
+    for i,scan in enumerate(scans):
+        kept,_ = locator.filter_nearby(routers, scan, keep_all)
+        rows.extend(routers.index([router['MAC'] for router in kept]).tolist())
+        rssi.extend([router['RSSI'] for router in kept])
+        scan_ids.extend([i] * len(kept))
+
+    rows = np.array(rows, dtype=np.int64)
+    rssi = np.array(rssi, dtype=float)
+    scan_ids = np.array(scan_ids, dtype=np.int64)
+
+    same = routers.floor[rows] == tfloor[scan_ids]
+    dist = np.hypot(routers.x[rows] - tx[scan_ids], routers.y[rows] - ty[scan_ids])
+    return rows[same], rssi[same], np.maximum(dist[same], 1.0)
+
+
+def group_ids(routers, by, config):
+    # Group of every router row, as an index from 0 to the number of groups
+
+    if by == 'ap':
+        return routers.ap_ids(config.ap_nibbles)
+    if by == 'bssid':
+        return np.arange(len(routers))
+
+    # Band from the frequency column, 2 or 5 (GHz)
+    band = (routers.freq >= 5).astype(np.int64)
+    floor = routers.floor.astype(np.int64)
+    key = {'band': band, 'floor': floor, 'band-floor': floor * 2 + band}[by]
+    return np.unique(key, return_inverse=True)[1].reshape(-1)
+
+
+def fit(groups, rssi, dist, n_groups, min_obs=MIN_OBS):
+    # Least-squares fit of rssi = power - path_loss * 10 * log10(dist)
+    # for every group at once. Returns power, path_loss and the number
+    # of observations of every group, NaN for groups without a fit.
+
+    x = -10 * np.log10(dist)
+    n = np.bincount(groups, minlength=n_groups).astype(float)
+    sx = np.bincount(groups, x, n_groups)
+    sy = np.bincount(groups, rssi, n_groups)
+    sxx = np.bincount(groups, x * x, n_groups)
+    sxy = np.bincount(groups, x * rssi, n_groups)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = n * sxx - sx * sx
+        path_loss = (n * sxy - sx * sy) / det
+        power = (sy - path_loss * sx) / n
+        spread = det / (n * n)
+
+    ok = ((n >= min_obs) & (spread >= MIN_SPREAD ** 2) &
+          (path_loss >= PATH_LOSS_RANGE[0]) & (path_loss <= PATH_LOSS_RANGE[1]))
+    return np.where(ok, power, np.nan), np.where(ok, path_loss, np.nan), n
+
+
+def fit_groups(routers, labelled_set, by, config, min_obs=MIN_OBS):
+    # Fit the models of all groups from (scans, x, y, floor).
+    # Returns the group of every router row, power and path_loss of
+    # every group (NaN without a fit), observation counts and the
+    # observations (rows, rssi, dist).
+
+    if by != 'ap':
+        config = config.replace(ap_nibbles='')
+
+    rows, rssi, dist = observations(routers, *labelled_set, config)
+    groups = group_ids(routers, by, config)
+    n_groups = int(groups.max()) + 1 if len(groups) else 0
+    power, path_loss, counts = fit(groups[rows], rssi, dist, n_groups, min_obs)
+    return groups, power, path_loss, counts, (rows, rssi, dist)
+
+
+def rms_residual(rssi, dist, power, path_loss):
+    # Root mean square RSSI residual in dB of the model(s)
+    return float(np.sqrt(np.mean((rssi - power + 10 * path_loss * np.log10(dist)) ** 2)))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit path-loss models per router, band or floor')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--labelled', help='radio map file with the labelled scans, RADIO_MAP_PATH by default')
+    parser.add_argument('--synthetic', type=int, help='use this many synthetic scans instead')
+    parser.add_argument('--by', choices=GROUPS, default='ap', help='routers sharing one model')
+    parser.add_argument('--min-obs', type=int, default=MIN_OBS, help='observations needed per group')
+    parser.add_argument('--out', help='models file, next to ROUTERS_FILE_PATH by default')
+    parser.add_argument('--dry-run', action='store_true', help='only print the fit')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config, 'r') as f:
+        cfg = json.load(f)
+
+    config = locator.LocatorConfig.from_dict(cfg)
+    routers = routerdb.load(cfg['ROUTERS_FILE_PATH'])
+
+    if args.synthetic:
+        labelled_set = calibrate.make_labelled(routers, config, args.synthetic, args.seed)
+    else:
+        path = args.labelled or cfg['RADIO_MAP_PATH']
+        if not os.path.exists(path):
+            parser.error(f'no labelled scans at {path}, survey some or use --synthetic N')
+        labelled_set = calibrate.read_labelled(path)
+
+    groups, power, path_loss, counts, (rows, rssi, dist) = fit_groups(
+        routers, labelled_set, args.by, config, args.min_obs)
+    if len(rows) == 0:
+        print('[!] No routers on the floor of any labelled scan')
+        quit(1)
+
+    fitted = ~np.isnan(power)
+
+    # Global fit, as a suggestion for POWER and PATH_LOSS
+    g_power, g_path_loss, _ = fit(np.zeros(len(rows), dtype=np.int64), rssi, dist, 1, 1)
+
+    # Per-router models, the config's for routers without a fit
+    row_power = np.where(fitted[groups], power[groups], config.power)
+    row_path_loss = np.where(fitted[groups], path_loss[groups], config.path_loss)
+
+    print(f'{len(rows)} observations, {int(fitted.sum())} of {int((counts > 0).sum())} groups fitted (by {args.by})')
+    print(f'Global fit: POWER {g_power[0]:.2f}, PATH_LOSS {g_path_loss[0]:.3f}')
+    print(f'RMS residual: {rms_residual(rssi, dist, config.power, config.path_loss):.2f} dB with the config, '
+          f'{rms_residual(rssi, dist, row_power[rows], row_path_loss[rows]):.2f} dB per group')
+    if fitted.any():
+        print(f'Fitted PATH_LOSS: {np.nanmin(path_loss):.2f} to {np.nanmax(path_loss):.2f}, '
+              f'POWER: {np.nanmin(power):.1f} to {np.nanmax(power):.1f}')
+
+    if not args.dry_run:
+        out = args.out or routerdb.path_loss_path_for(cfg['ROUTERS_FILE_PATH'])
+        covered = np.flatnonzero(fitted[groups])
+        routerdb.write_path_loss(out, [routerdb.int_to_mac(m) for m in routers.macs[covered]],
+                                 power[groups][covered], path_loss[groups][covered])
+        print(f'Saved models of {len(covered)} routers to', out)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+loadgen.py
+Anton Slavin
+
+Load generator for server.py.
+
+Simulates many clients on one machine, each with its own connection,
+sending synthetic scans generated from the routers database and the
+path-loss model. Reports the fix rate and latency percentiles.
+
+Usage:
+    python3 loadgen.py [--clients N] [--scans N] [--method mean|trilat|multilat]
+                       [--host HOST] [--port PORT] [--pipeline N]
+"""
+
+
+# Packages
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+import routerdb
+import locator
+
+
+def make_scans(routers, config, count, aps=12, seed=0):
+    # Synthetic scans: a random position next to a random router,
+    # heard by the closest routers on the same floor with RSSI from
+    # the path-loss model plus noise
+
+    rng = np.random.default_rng(seed)
+    macs = [routerdb.int_to_mac(m) for m in routers.macs]
+    scans = []
+    for _ in range(count):
+        i = rng.integers(len(routers))
+        same = routers.on_floor(routers.floor[i])
+        px = routers.x[i] + rng.normal(0, 150)
+        py = routers.y[i] + rng.normal(0, 150)
+
+        d = np.hypot(routers.x[same] - px, routers.y[same] - py)
+        near = same[np.argsort(d)[:aps]]
+        d = np.maximum(np.sort(d)[:aps], 1.0)
+        rssi = config.power - 10 * config.path_loss * np.log10(d) + rng.normal(0, 2, len(d))
+        rssi = np.clip(np.round(rssi), config.rssi_floor, 0).astype(int)
+
+        scans.append([{'MAC': macs[r], 'RSSI': int(v)} for r,v in zip(near, rssi)])
+
+    return scans
+
+
+async def client(host, port, scans, method, pipeline, latencies, errors):
+    # One simulated device: keeps up to `pipeline` scans in flight
+    reader, writer = await asyncio.open_connection(host, port, limit=2**20)
+    sent = {}
+
+    async def receive():
+        for _ in range(len(scans)):
+            reply = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - sent.pop(reply.get('id')))
+            if 'error' in reply:
+                errors.append(reply['error'])
+            window.release()
+
+    window = asyncio.Semaphore(pipeline)
+    receiver = asyncio.create_task(receive())
+    for i,scan in enumerate(scans):
+        await window.acquire()
+        sent[i] = time.perf_counter()
+        writer.write(json.dumps({'id': i, 'method': method, 'scan': scan}).encode() + b'\n')
+        await writer.drain()
+
+    await receiver
+    writer.close()
+
+
+async def main(args):
+    with open(args.config, 'r') as f:
+        cfg = json.load(f)
+
+    routers = routerdb.load(cfg['ROUTERS_FILE_PATH'])
+    config = locator.LocatorConfig.from_dict(cfg)
+    pool = make_scans(routers, config, 1000)
+
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client(args.host, args.port,
+               [pool[(c * args.scans + i) % len(pool)] for i in range(args.scans)],
+               args.method, args.pipeline, latencies, errors)
+        for c in range(args.clients)
+    ])
+    elapsed = time.perf_counter() - start
+
+    lat = np.array(latencies) * 1000
+    print(f'Clients: {args.clients}, scans: {len(lat)}, errors: {len(errors)}')
+    print(f'Fixes/s: {len(lat) / elapsed:.0f}')
+    print(f'Latency ms: p50 {np.percentile(lat, 50):.1f}, '
+          f'p99 {np.percentile(lat, 99):.1f}, max {lat.max():.1f}')
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for the positioning server')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--scans', type=int, default=20, help='scans per client')
+    parser.add_argument('--pipeline', type=int, default=1, help='scans in flight per client')
+    parser.add_argument('--method', choices=['mean', 'trilat', 'multilat'], default='mean')
+    asyncio.run(main(parser.parse_args()))
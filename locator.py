@@ -9,49 +9,224 @@ Script for performing positioning calculations.
 
 
 # Packages
-from scipy.optimize import minimize
 import numpy as np
+import numbers
 import math
 import json
+import os
 
 
-# Load constants from config
-with open('config.json', 'r') as f:
-    cfg = json.load(f)
+# Positioning methods. True/False from the UI map to trilateration/mean.
+MEAN = 0
+TRILAT = 1
+MULTILAT = 2
 
 
-def RSSI_to_dist(rssi):
+# Default config file, next to this script
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+# Per-router distance tables kept per routers table
+MODEL_CACHE = 8
+
+
+class LocatorConfig(object):
+    # Immutable set of positioning constants.
+    # Derived values, such as the RSSI to distance lookup table,
+    # are computed once when the config is created, so several configs
+    # can be used side by side in the same process.
+
+    __slots__ = ('dist_threshold', 'rad_threshold', 'rad_norm', 'px_scale',
+                 'power', 'path_loss', 'rssi_min', 'rssi_floor',
+                 'lsq_iterations', 'lsq_max_aps', 'ap_nibbles', 'ap_fusion',
+                 'dist_lut', 'dist_list')
+
+    # Config file keys of all constants
+    KEYS = {
+        'dist_threshold': 'DIST_THRESHOLD',
+        'rad_threshold': 'RAD_THRESHOLD',
+        'rad_norm': 'RAD_NORM',
+        'px_scale': 'PX_SCALE',
+        'power': 'POWER',
+        'path_loss': 'PATH_LOSS',
+        'rssi_min': 'RSSI_MIN',
+        'rssi_floor': 'RSSI_FLOOR',
+        'lsq_iterations': 'LSQ_ITERATIONS',
+        'lsq_max_aps': 'LSQ_MAX_APS',
+        'ap_nibbles': 'AP_NIBBLES',
+        'ap_fusion': 'AP_FUSION'
+    }
+
+    def __init__(self, **values):
+        for name in self.KEYS:
+            object.__setattr__(self, name, values[name])
+
+        # Distance for every integer dBm from the floor up to 0,
+        # indexed by -rssi. Same formula as RSSI_to_dist.
+        dists = [self.formula(rssi) for rssi in range(0, self.rssi_floor - 1, -1)]
+        lut = np.array(dists)
+        lut.flags.writeable = False
+        object.__setattr__(self, 'dist_lut', lut)
+        # Same table as a tuple, for single values
+        object.__setattr__(self, 'dist_list', tuple(dists))
+
+
+    @classmethod
+    def from_dict(cls, cfg):
+        # Create a config from a dict with config file keys
+        return cls(**{name: cfg[key] for name,key in cls.KEYS.items()})
+
+
+    @classmethod
+    def from_file(cls, path=CONFIG_PATH):
+        # Create a config from a JSON config file
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+
+    def replace(self, **changes):
+        # New config with some of the constants changed
+        values = {name: getattr(self, name) for name in self.KEYS}
+        values.update(changes)
+        return LocatorConfig(**values)
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError('LocatorConfig is immutable')
+
+
+    def __reduce__(self):
+        # Pickle as config file values, e.g. for worker processes,
+        # as unpickling cannot set the attributes of an immutable config
+        return (self.__class__.from_dict, ({key: getattr(self, name) for name,key in self.KEYS.items()},))
+
+
+    def __repr__(self):
+        values = ', '.join([f'{name}={getattr(self, name)}' for name in self.KEYS])
+        return f'LocatorConfig({values})'
+
+
+    def formula(self, rssi):
+        # Convert RSSI (signal strength) to distance in pixels.
+        # https://stackoverflow.com/questions/62399361/swift-converting-rssi-to-distance
+        # https://en.wikipedia.org/wiki/True-range_multilateration
+        # https://en.wikipedia.org/wiki/Log-distance_path_loss_model
+        # https://appelsiini.net/2017/trilateration-with-n-points/
+
+        dist_m = 10 ** ((self.power - rssi)/(10 * self.path_loss))
+        return dist_m / self.px_scale
+
+
+    def rssi_to_dist(self, rssi):
+        # Convert an array of RSSI values to distances.
+        # Integer dBm values within the table are a single lookup,
+        # anything else (fractional, out of range, NaN) uses the formula.
+
+        rssi = np.asarray(rssi)
+        # Fast path for integer scans, as reported by iw and airport
+        if rssi.dtype.kind == 'i' and rssi.size > 0:
+            if rssi.max() <= 0 and rssi.min() > -len(self.dist_lut):
+                return self.dist_lut[-rssi]
+
+        rssi = rssi.astype(float)
+        idx = -rssi
+        with np.errstate(invalid='ignore'):
+            exact = (idx == np.floor(idx)) & (idx >= 0) & (idx < len(self.dist_lut))
+
+        dist = self.dist_lut[np.where(exact, idx, 0).astype(int)]
+        if not exact.all():
+            dist = np.where(exact, dist, self.formula(rssi))
+        return dist
+
+
+# Lazily loaded default config
+default = None
+
+
+def default_config():
+    # Config loaded from the default config file on first use
+    global default
+    if default is None:
+        default = LocatorConfig.from_file()
+    return default
+
+
+def RSSI_to_dist(rssi, config=None):
     # Convert RSSI (signal strength) to distance in pixels.
-    # https://stackoverflow.com/questions/62399361/swift-converting-rssi-to-distance
-    # https://en.wikipedia.org/wiki/True-range_multilateration
-    # https://en.wikipedia.org/wiki/Log-distance_path_loss_model
-    # https://appelsiini.net/2017/trilateration-with-n-points/
+    config = config or default_config()
+    return config.formula(rssi)
+
+
+def router_model(routers, config):
+    # Transmit power, path-loss exponent and RSSI to distance lookup
+    # table (router row, -rssi) of every router for a config: the
+    # fitted path-loss model of a router if it has one, the config's
+    # otherwise. Built once per config and cached with the routers.
+
+    key = (config.power, config.path_loss, config.px_scale, config.rssi_floor)
+    if key not in routers.model_cache:
+        # A calibration sweep goes through many configs
+        if len(routers.model_cache) >= MODEL_CACHE:
+            routers.model_cache.clear()
+
+        power = np.full(len(routers), float(config.power))
+        path_loss = np.full(len(routers), float(config.path_loss))
+        if routers.power is not None:
+            fitted = ~np.isnan(routers.power)
+            power[fitted] = routers.power[fitted]
+            path_loss[fitted] = routers.path_loss[fitted]
+
+        # Same formula as LocatorConfig.formula, for every router
+        rssi = -np.arange(len(config.dist_lut))
+        table = 10 ** ((power[:, None] - rssi[None, :]) / (10 * path_loss[:, None])) / config.px_scale
+        table.flags.writeable = False
+        routers.model_cache[key] = (power, path_loss, table)
+
+    return routers.model_cache[key]
+
+
+def router_dist(routers, rows, rssi, config):
+    # Convert RSSI values heard from the given router rows (arrays of
+    # the same shape) to distances, as config.rssi_to_dist does but
+    # with the fitted path-loss model of every router.
+    # Integer dBm values are a single lookup in the per-router table.
+
+    if routers.power is None:
+        return config.rssi_to_dist(rssi)
 
-    dist_m = 10 ** ((cfg['POWER'] - rssi)/(10 * cfg['PATH_LOSS']))
-    return dist_m / cfg['PX_SCALE']
+    power, path_loss, table = router_model(routers, config)
+    rows = np.asarray(rows)
+    rssi = np.asarray(rssi)
+    if rssi.dtype.kind == 'i' and rssi.size > 0:
+        if rssi.max() <= 0 and rssi.min() > -table.shape[1]:
+            return table[rows, -rssi]
+
+    rssi = rssi.astype(float)
+    return 10 ** ((power[rows] - rssi) / (10 * path_loss[rows])) / config.px_scale
 
 
 def calc_w_avg_point(locations, weights):
     # Calculate weighted average of given points
 
-    try:
-        centroid = np.average(locations, axis=0, weights=weights)
-    except ZeroDivisionError:
+    # Plain Python, as a scan has too few routers to pay off NumPy
+    w_sum = sum(weights)
+    if w_sum == 0:
         print("[!] Issue with weights:", weights)
         return 0, 0
 
-    x, y = centroid[0], centroid[1]
+    x = sum([w * loc[0] for loc,w in zip(locations, weights)]) / w_sum
+    y = sum([w * loc[1] for loc,w in zip(locations, weights)]) / w_sum
     return x, y
 
 
-def mode_floor(routers):
-    # Calculate the mode of floor values
+def mode_floor(routers, all_floors=None):
+    # Calculate the mode of floor values, of all_floors if given
 
-    all_floors = [int(rr['floor']) for rr in routers]
+    if all_floors is None:
+        all_floors = [int(rr['floor']) for rr in routers]
     freqs = {}
     # Count frequencies
     for item in all_floors:
-        freqs[item] = all_floors.count(item)
+        freqs[item] = freqs.get(item, 0) + 1
     
     try:
         floor = max(freqs, key=freqs.get)
@@ -77,37 +252,278 @@ def cart_to_scr(x, y, w, h):
 
 
 
-def locate(routers, nearby_routers, trilatOrMean):
-    # routers: dict of all routers
+def routers_near(routers, user, radius=None, config=None):
+    # Rows of the routers on the user's floor within a radius (in m,
+    # the user's radius by default) of the fix, nearest first.
+    # Uses the spatial index, so the cost depends on the routers nearby.
+
+    config = config or default_config()
+    radius = user['radius'] if radius is None else radius
+    return routers.within(user['floor'], user['x'], user['y'], radius * config.px_scale)
+
+
+def multilaterate(x, y, ranges, mask, config, start=None):
+    # Least-squares multilateration for many scans at once.
+    # x, y, ranges, mask: arrays of shape (scans, aps), in pixels.
+    # config: LocatorConfig
+    # start: optional (scans, 2) array of previous fixes (NaN if none).
+    # Returns x, y and the weighted RMS range residual in pixels.
+    # Cost is linear in the number of APs, with a fixed iteration count.
+
+    # Zero out unused slots so padding never leaks NaNs into the sums
+    x = np.where(mask, x, 0.0)
+    y = np.where(mask, y, 0.0)
+    ranges = np.where(mask, ranges, 0.0)
+    cnt = np.maximum(mask.sum(axis=1), 1)
+
+    # Farther APs are noisier, weight by inverse variance
+    w = np.where(mask, 1 / np.maximum(ranges, 1.0)**2, 0.0)
+
+    # Closed-form linearized solve: subtract the mean circle equation
+    # from every circle equation and solve the 2x2 normal equations
+    mx = x.sum(axis=1, keepdims=True) / cnt[:, None]
+    my = y.sum(axis=1, keepdims=True) / cnt[:, None]
+    ax = x - mx
+    ay = y - my
+    p2 = x**2 + y**2
+    r2 = ranges**2
+    p2 = p2 - np.where(mask, p2, 0.0).sum(axis=1, keepdims=True) / cnt[:, None]
+    r2 = r2 - np.where(mask, r2, 0.0).sum(axis=1, keepdims=True) / cnt[:, None]
+    b = 0.5 * (p2 - r2)
+
+    lx, ly, solved = solve_normal(ax, ay, b, w)
+    # Degenerate geometry (fewer than three distinct, non-collinear APs):
+    # fall back to the plain centroid of the APs
+    lx = np.where(solved, lx, mx[:, 0])
+    ly = np.where(solved, ly, my[:, 0])
+
+    # Warm start from the previous fix if it explains the ranges better
+    if start is not None:
+        start = np.asarray(start, dtype=float).reshape(-1, 2)
+        sx, sy = start[:, 0], start[:, 1]
+        use_start = ~np.isnan(sx) & ~np.isnan(sy)
+        use_start &= range_cost(x, y, ranges, w, sx, sy) < range_cost(x, y, ranges, w, lx, ly)
+        lx = np.where(use_start, sx, lx)
+        ly = np.where(use_start, sy, ly)
+
+    # Nonlinear refinement with a fixed number of Levenberg-Marquardt
+    # steps; a step is only taken if it lowers the cost of that row
+    ux, uy = lx, ly
+    cost = range_cost(x, y, ranges, w, ux, uy)
+    damping = np.full(len(ux), 1e-3)
+    for _ in range(config.lsq_iterations):
+        dx = ux[:, None] - x
+        dy = uy[:, None] - y
+        d = np.maximum(np.sqrt(dx**2 + dy**2), 1e-6)
+        res = d - ranges
+        jx = dx / d
+        jy = dy / d
+        step_x, step_y, ok = solve_normal(jx, jy, -res, w, damping)
+
+        nx = np.where(ok, ux + step_x, ux)
+        ny = np.where(ok, uy + step_y, uy)
+        new_cost = range_cost(x, y, ranges, w, nx, ny)
+        better = ok & (new_cost < cost)
+        ux = np.where(better, nx, ux)
+        uy = np.where(better, ny, uy)
+        cost = np.where(better, new_cost, cost)
+        damping = np.where(better, damping / 10, damping * 10)
+
+    rms = np.sqrt(cost / np.maximum(w.sum(axis=1), 1e-12))
+    return ux, uy, rms
+
+
+def solve_normal(ax, ay, b, w, damping=0.0):
+    # Solve the weighted 2x2 normal equations (A^T W A) p = A^T W b
+    # for every row, where A has the columns ax and ay
+
+    n00 = (w * ax * ax).sum(axis=1)
+    n01 = (w * ax * ay).sum(axis=1)
+    n11 = (w * ay * ay).sum(axis=1)
+    n00 = n00 * (1 + damping)
+    n11 = n11 * (1 + damping)
+    r0 = (w * ax * b).sum(axis=1)
+    r1 = (w * ay * b).sum(axis=1)
+
+    det = n00 * n11 - n01**2
+    ok = np.abs(det) > 1e-9 * np.maximum(n00 * n11, 1e-12)
+    det = np.where(ok, det, 1.0)
+    px = (n11 * r0 - n01 * r1) / det
+    py = (n00 * r1 - n01 * r0) / det
+    return px, py, ok
+
+
+def range_cost(x, y, ranges, w, ux, uy):
+    # Weighted sum of squared range residuals for every row
+
+    d = np.sqrt((ux[:, None] - x)**2 + (uy[:, None] - y)**2)
+    return (w * (d - ranges)**2).sum(axis=1)
+
+
+def strongest(rssi, mask, limit):
+    # Mask keeping only the `limit` strongest APs of every row
+
+    order = np.argsort(-np.where(mask, rssi, -np.inf), axis=1, kind='stable')
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.arange(rssi.shape[1])[None, :], axis=1)
+    return mask & (rank < limit)
+
+
+def filter_nearby(routers, nearby_routers, config=None):
+    # Split a scan into routers usable for positioning and excluded ones:
+    # too weak (below RSSI_MIN) or not in the routers table.
+    # The remaining BSSIDs of every physical AP are then fused into
+    # one entry.
+    # Raises KeyError or TypeError for malformed scan entries.
+
+    config = config or default_config()
+    rows = routers.index([router['MAC'] for router in nearby_routers])
+    for router in nearby_routers:
+        if not isinstance(router['RSSI'], numbers.Real):
+            raise TypeError(f'RSSI of {router["MAC"]} is not a number')
+
+    kept = []
+    kept_rows = []
+    excluded = []
+    for router,row in zip(nearby_routers, rows.tolist()):
+        if row >= 0 and router['RSSI'] >= config.rssi_min:
+            kept.append(router)
+            kept_rows.append(row)
+        else:
+            excluded.append(router)
+
+    if config.ap_nibbles:
+        kept = fuse_aps(routers, kept, np.array(kept_rows, dtype=np.int64), config)
+
+    return kept, excluded
+
+
+def fuse_aps(routers, nearby_routers, rows, config):
+    # Fold the BSSIDs of every physical AP in a scan into one entry:
+    # the strongest BSSID with the RSSI of all of them combined by
+    # AP_FUSION ('max' or 'mean'). Entries are sorted by RSSI.
+    # rows: routers table rows of the nearby routers
+
+    if len(nearby_routers) == 0:
+        return []
+
+    ap = routers.ap_ids(config.ap_nibbles)[rows]
+    rssi = np.array([router['RSSI'] for router in nearby_routers], dtype=float)
+
+    # First entry of every AP in order of decreasing RSSI is its strongest
+    order = np.argsort(-rssi, kind='stable')
+    _, first, inverse = np.unique(ap[order], return_index=True, return_inverse=True)
+    strongest = order[first].tolist()
+
+    # With max fusion, the strongest entry already has the fused RSSI
+    fused = None
+    if config.ap_fusion == 'mean':
+        # Rounded to whole dBm like merged scans, for the distance table
+        fused = [round(v) for v in (np.bincount(inverse, weights=rssi[order]) / np.bincount(inverse)).tolist()]
+
+    result = []
+    for k,i in enumerate(strongest):
+        router = dict(nearby_routers[i])
+        if fused is not None:
+            router['RSSI'] = fused[k]
+        result.append(router)
+
+    result.sort(key=lambda r: r['RSSI'], reverse=True)
+    return result
+
+
+def annotate_nearby(routers, nearby_routers, config=None):
+    # Set the floor and distance of every nearby router as locate()
+    # does, for when the fix comes from elsewhere
+
+    config = config or default_config()
+    rows = routers.index([router['MAC'] for router in nearby_routers])
+    if (rows < 0).any():
+        raise KeyError(nearby_routers[int(np.argmin(rows))]['MAC'])
+
+    dists = router_dist(routers, rows, [router['RSSI'] for router in nearby_routers], config).tolist()
+    for router,rf,dist in zip(nearby_routers, routers.floor[rows].tolist(), dists):
+        router['floor'] = rf
+        router['DIST'] = dist / config.px_scale
+
+
+def locate(routers, nearby_routers, method, prev=None, config=None):
+    # routers: RouterTable of all routers
     # nearby_routers: list of nearby routers as dicts
+    # method: MEAN, TRILAT or MULTILAT
+    # prev: previous user fix, used to warm-start MULTILAT
+    # config: LocatorConfig, the default config file if not given
 
+    config = config or default_config()
     user = {}
     # Update nearby routers with the corresponding floor, 
     # coordinates, distance from RSSI
     near_coords = []
     near_weights = []   
+    near_dists = []
+    near_rssi = []
     max_dist = 0.0
-    for router in nearby_routers:
-        mac = router['MAC']
-        router['floor'] = routers[mac]['floor']
-        
-        # Distance from RSSI
-        dist = RSSI_to_dist(router['RSSI'])
-        router['DIST'] = dist / cfg['PX_SCALE']
-
-        if dist < cfg['DIST_THRESHOLD']:
-            near_coords.append((routers[mac]['x'], routers[mac]['y']))
+
+    # Gather router details for the whole scan at once,
+    # as plain lists, which are fastest for a single scan
+    rows = routers.rows_of([router['MAC'] for router in nearby_routers])
+    if -1 in rows:
+        raise KeyError(nearby_routers[rows.index(-1)]['MAC'])
+    xs, ys, floors = routers.columns()
+
+    # Distance from RSSI for the whole scan, per router path-loss model.
+    # Without fitted models, integer dBm values are a table lookup.
+    rssi = [router['RSSI'] for router in nearby_routers]
+    if routers.power is None:
+        lut = config.dist_list
+        lo = -len(lut)
+        dists = [lut[-v] if type(v) is int and lo < v <= 0 else float(config.formula(v))
+                 for v in rssi]
+    else:
+        dists = router_dist(routers, rows, rssi, config).tolist()
+
+    px_scale = config.px_scale
+    dist_threshold = config.dist_threshold
+    for router,row,dist,rv in zip(nearby_routers, rows, dists, rssi):
+        router['floor'] = floors[row]
+        router['DIST'] = dist / px_scale
+
+        if dist < dist_threshold:
+            near_coords.append((xs[row], ys[row]))
             # Weight formula for the weighted mean method
-            weight = 1 / router['RSSI']
+            weight = 1 / rv
             near_weights.append(weight)
+            near_rssi.append(rv)
 
-            dist *= cfg['PX_SCALE']
+            dist *= px_scale
+            near_dists.append(dist)
             if dist > max_dist:
                 max_dist = dist
 
     
+    # -================= Multilateration =================-
+    if method == MULTILAT:
+        # Least-squares fit over every AP under the distance threshold
+        if len(near_coords) == 0:
+            print('[!] No APs nearby for multilateration')
+            return
+
+        coords = np.array(near_coords, dtype=float).reshape(1, -1, 2)
+        rssi = np.array([near_rssi], dtype=float)
+        mask = strongest(rssi, np.ones(rssi.shape, dtype=bool), config.lsq_max_aps)
+        start = None
+        if prev is not None:
+            start = np.array([[prev['x'], prev['y']]], dtype=float)
+
+        x,y,rms = multilaterate(coords[..., 0], coords[..., 1],
+                                np.array([near_dists]), mask, config, start)
+        x,y = float(x[0]), float(y[0])
+        # Radius from the range residuals
+        radius = float(rms[0]) / config.px_scale
+
+
     # -================== Trilateration ==================-
-    if trilatOrMean:
+    elif method:
         # Apply multilateration formulas to the formed circles
 
         # Decide if any of the first three are the same point, 
@@ -156,23 +572,202 @@ def locate(routers, nearby_routers, trilatOrMean):
                 max_dist = dist_to_mean
 
 
-    n = len(near_coords)
-    # Precision is increased if more routers are nearby,
-    # by 0.01 for each 10 additional routers
+    if method != MULTILAT:
+        n = len(near_coords)
+        # Precision is increased if more routers are nearby,
+        # by 0.01 for each 10 additional routers
 
-    coef = cfg['RAD_NORM'] - (math.ceil(n / 100) if n < 10 else math.floor(n / 10)) / 100
+        coef = config.rad_norm - (math.ceil(n / 100) if n < 10 else math.floor(n / 10)) / 100
 
-    # Maximum radius is based on the maximum distance to a detected router
-    user['radius'] = (max_dist / cfg['PX_SCALE']) * coef
+        # Maximum radius is based on the maximum distance to a detected router
+        radius = (max_dist / config.px_scale) * coef
 
     # Clamp radius to avoid unrealistic values
-    user['radius'] = min(user['radius'], cfg['RAD_THRESHOLD'])
+    user['radius'] = min(radius, config.rad_threshold)
 
     user['x'] = x
     user['y'] = y
 
     # Calculate the floor based on the mode floor
-    user['floor'] = mode_floor(nearby_routers)
+    user['floor'] = mode_floor(nearby_routers, [floors[row] for row in rows])
 
     # Return user object
     return user
+
+
+def pack_scans(routers, scans, with_rows=False):
+    # Pack a list of scans (each a list of nearby router dicts, as
+    # passed to locate) into padded 2D arrays of shape (scans, max_len).
+    # routers: RouterTable of all routers
+    # Padded slots have an RSSI of NaN.
+    # with_rows: also return the router rows, -1 in padded slots
+
+    lengths = [len(scan) for scan in scans]
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=int)])
+    flat = [router for scan in scans for router in scan]
+
+    # One lookup for every router of every scan
+    rows = routers.index([router['MAC'] for router in flat])
+    if (rows < 0).any():
+        raise KeyError(flat[int(np.argmin(rows))]['MAC'])
+    rssi = np.array([router['RSSI'] for router in flat], dtype=float)
+
+    x = unpack_ragged(routers.x[rows].astype(float), offsets, 0.0)
+    y = unpack_ragged(routers.y[rows].astype(float), offsets, 0.0)
+    floors = unpack_ragged(routers.floor[rows].astype(int), offsets, 0)
+    rssi = unpack_ragged(rssi, offsets)
+
+    if with_rows:
+        return x, y, floors, rssi, unpack_ragged(rows, offsets, -1)
+    return x, y, floors, rssi
+
+
+def unpack_ragged(values, offsets, fill=np.nan):
+    # Convert a flat ragged array into a padded 2D array.
+    # Scan i occupies values[offsets[i]:offsets[i+1]]
+
+    offsets = np.asarray(offsets)
+    lengths = np.diff(offsets)
+    n = len(lengths)
+    k = lengths.max() if n > 0 else 0
+
+    values = np.asarray(values)
+    padded = np.full((n, k), fill, dtype=np.result_type(values, type(fill)))
+    rows = np.repeat(np.arange(n), lengths)
+    cols = np.arange(offsets[0], offsets[-1]) - np.repeat(offsets[:-1], lengths)
+    padded[rows, cols] = values[offsets[0]:offsets[-1]]
+    return padded
+
+
+def batch_mode_floor(floors, mask):
+    # Vectorized mode_floor: most common floor of every row,
+    # ties resolved by first occurrence, 1 for empty rows
+
+    same = floors[:, :, None] == floors[:, None, :]
+    counts = np.where(mask, (same & mask[:, None, :]).sum(axis=2), -1)
+    first = np.argmax(counts, axis=1)
+    floor = np.take_along_axis(floors, first[:, None], axis=1)[:, 0]
+    return np.where(mask.any(axis=1), floor, 1)
+
+
+def locate_batch(x, y, floors, rssi, method, offsets=None, start=None, config=None, dist=None):
+    # Locate many scans at once, matching locate() for every scan.
+    # x, y, floors, rssi: padded arrays of shape (scans, max_len) as
+    # returned by pack_scans, with NaN RSSI marking empty slots.
+    # If offsets are given, the inputs are flat ragged arrays instead.
+    # start: optional (scans, 2) previous fixes to warm-start MULTILAT.
+    # config: LocatorConfig, the default config file if not given.
+    # dist: optional distances of the same shape as rssi, e.g. from
+    # router_dist, instead of the config's path-loss model.
+    # Returns a dict of arrays; scans that could not be located
+    # (trilateration without three different APs) have valid == False.
+
+    config = config or default_config()
+
+    if offsets is not None:
+        x = unpack_ragged(x, offsets, 0.0)
+        y = unpack_ragged(y, offsets, 0.0)
+        floors = unpack_ragged(floors, offsets, 0)
+        rssi = unpack_ragged(rssi, offsets)
+        if dist is not None:
+            dist = unpack_ragged(dist, offsets)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    floors = np.asarray(floors, dtype=int)
+    rssi = np.asarray(rssi, dtype=float)
+
+    n, k = rssi.shape
+    present = ~np.isnan(rssi)
+
+    # Distance from RSSI, same units as in locate()
+    if dist is None:
+        dist = config.rssi_to_dist(rssi)
+    dist = np.asarray(dist, dtype=float)
+    with np.errstate(invalid='ignore'):
+        near = present & (dist < config.dist_threshold)
+    dist_rep = dist / config.px_scale
+    n_near = near.sum(axis=1)
+
+    max_dist = np.where(near, dist * config.px_scale, 0.0).max(axis=1, initial=0.0)
+    valid = np.ones(n, dtype=bool)
+
+    # -================= Multilateration =================-
+    if method == MULTILAT:
+        valid = n_near > 0
+        mask = strongest(rssi, near, config.lsq_max_aps)
+        ux, uy, rms = multilaterate(x, y, dist * config.px_scale, mask, config, start)
+        ux[~valid] = np.nan
+        uy[~valid] = np.nan
+
+    # -================== Trilateration ==================-
+    elif method:
+        # Compact the near routers to the front of each row, keeping order
+        order = np.argsort(~near, axis=1, kind='stable')
+        nx = np.take_along_axis(x, order, axis=1)
+        ny = np.take_along_axis(y, order, axis=1)
+        cols = np.arange(k)
+        in_near = cols[None, :] < n_near[:, None]
+
+        # First coordinate different from the first one
+        diff = in_near & ((nx != nx[:, :1]) | (ny != ny[:, :1]))
+        i2 = np.argmax(diff, axis=1)
+        valid &= diff.any(axis=1)
+
+        # First coordinate after i2 that differs from the one at i2
+        x2 = np.take_along_axis(nx, i2[:, None], axis=1)
+        y2 = np.take_along_axis(ny, i2[:, None], axis=1)
+        diff = in_near & (cols[None, :] > i2[:, None]) & ((nx != x2) | (ny != y2))
+        i3 = np.argmax(diff, axis=1)
+        valid &= diff.any(axis=1)
+
+        # Radii are taken by index from the full nearby list, as in locate()
+        r1 = dist_rep[:, 0] if k > 0 else np.zeros(n)
+        r2 = np.take_along_axis(dist_rep, i2[:, None], axis=1)[:, 0]
+        r3 = np.take_along_axis(dist_rep, i3[:, None], axis=1)[:, 0]
+
+        Ux = x2[:, 0]
+        Vx = np.take_along_axis(nx, i3[:, None], axis=1)[:, 0]
+        Vy = np.take_along_axis(ny, i3[:, None], axis=1)[:, 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ux = (r1**2 - r2**2 + Ux**2) / (2*Ux)
+            uy = (r1**2 - r3**2 + Vx**2 + Vy**2 - 2*Vx*ux) / (2*Vy)
+
+        # Fix result by offsetting
+        ux = ux + (nx[:, 0] if k > 0 else 0.0)
+        uy = uy + (ny[:, 0] if k > 0 else 0.0)
+
+        ux[~valid] = np.nan
+        uy[~valid] = np.nan
+
+    # -================== Weighted Mean ==================-
+    else:
+        weights = np.where(near, 1 / np.where(present, rssi, 1.0), 0.0)
+        w_sum = weights.sum(axis=1)
+        has_weights = w_sum != 0
+        w_sum[~has_weights] = 1.0
+        ux = np.where(has_weights, (weights * x).sum(axis=1) / w_sum, 0.0)
+        uy = np.where(has_weights, (weights * y).sum(axis=1) / w_sum, 0.0)
+
+        dist_to_mean = np.sqrt((x - ux[:, None])**2 + (y - uy[:, None])**2)
+        dist_to_mean = np.where(near, dist_to_mean, 0.0)
+        max_dist = np.maximum(dist_to_mean.max(axis=1, initial=0.0), 1.0)
+
+    if method == MULTILAT:
+        radius = rms / config.px_scale
+    else:
+        # Precision is increased if more routers are nearby
+        steps = np.where(n_near < 10, np.ceil(n_near / 100), np.floor(n_near / 10))
+        coef = config.rad_norm - steps / 100
+        radius = (max_dist / config.px_scale) * coef
+
+    radius = np.minimum(radius, config.rad_threshold)
+    radius[~valid] = np.nan
+
+    return {
+        'x': ux,
+        'y': uy,
+        'radius': radius,
+        'floor': batch_mode_floor(floors, present),
+        'valid': valid
+    }
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+make_tiles.py
+Anton Slavin
+
+Helper script for cutting the floor maps into tile pyramids.
+
+Every map/korrus-*.png image (including the -c and -overlay variants)
+is scaled down once for every map scale used by the app and cut into
+square tiles, so the app only has to decode the tiles that are visible.
+
+Output layout:
+
+    map/tiles/korrus-2-c/tiles.json     # sizes of every level
+    map/tiles/korrus-2-c/3/4_7.png      # scale 3, column 4, row 7
+"""
+
+
+# Packages
+from PySide6.QtCore import Qt, QRect
+from PySide6.QtGui import QImage
+import glob
+import json
+import sys
+import os
+
+
+# Constants
+MAP_GLOB = 'map/korrus-*.png'
+TILES_DIR = 'map/tiles'
+TILE_SIZE = 256
+SCALES = [1, 2, 3, 4, 5]
+
+
+def make_pyramid(path, out_dir, tile=TILE_SIZE, scales=SCALES):
+    # Cut one image into tiles for every scale
+
+    img = QImage(path)
+    if img.isNull():
+        print('[!] Unable to load image:', path)
+        return
+
+    meta = {
+        'width': img.width(),
+        'height': img.height(),
+        'tile': tile,
+        'levels': {}
+    }
+
+    for scale in scales:
+        # Same scaling as the full map in the app
+        scaled = img.scaled(int(img.width() / scale), int(img.height() / scale),
+                            Qt.AspectRatioMode.KeepAspectRatio,
+                            Qt.TransformationMode.SmoothTransformation)
+        w, h = scaled.width(), scaled.height()
+        meta['levels'][str(scale)] = [w, h]
+
+        level_dir = os.path.join(out_dir, str(scale))
+        os.makedirs(level_dir, exist_ok=True)
+        for row in range(0, (h + tile - 1) // tile):
+            for col in range(0, (w + tile - 1) // tile):
+                x, y = col * tile, row * tile
+                part = scaled.copy(QRect(x, y, min(tile, w - x), min(tile, h - y)))
+                part.save(os.path.join(level_dir, f'{col}_{row}.png'))
+
+    # Metadata is written last, so an interrupted run is not used
+    with open(os.path.join(out_dir, 'tiles.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+
+if __name__ == '__main__':
+    # Optional list of images, all maps by default
+    paths = sys.argv[1:] or sorted(glob.glob(MAP_GLOB))
+
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        print('Tiling', path)
+        make_pyramid(path, os.path.join(TILES_DIR, name))
+
+    print('Done.')
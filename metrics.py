@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""
+metrics.py
+Anton Slavin
+
+Latency instrumentation for the scan-to-render pipeline.
+
+Stages are timed with the stage() context manager and kept in bounded
+histograms with logarithmic buckets, so memory does not grow with the
+number of fixes. Summaries (count, mean, p50, p95, max) can be shown in
+the UI, written to a JSON file or served over HTTP on localhost.
+
+Instrumentation is disabled by default. stage() then returns a shared
+no-op context manager, so an instrumented call costs one global lookup
+and an attribute check.
+
+Usage:
+    metrics.enable()
+    with metrics.stage('locate'):
+        ...
+    metrics.summary()
+"""
+
+
+# Packages
+import http.server
+import contextlib
+import threading
+import json
+import math
+import time
+
+
+# Histogram buckets: 8 per power of two from 1 us to ~1 hour
+BUCKET_MIN = 1e-6
+BUCKETS_PER_OCTAVE = 8
+BUCKET_COUNT = 8 * 32
+
+# Pipeline stages in display order
+STAGES = ['scan', 'filter', 'locate', 'fingerprint', 'map_load', 'map_scale', 'render', 'paint', 'fix']
+
+enabled = False
+histograms = {}
+lock = threading.Lock()
+NULL_STAGE = contextlib.nullcontext()
+
+
+
+class Histogram(object):
+    # Latency histogram of fixed size. Quantiles are accurate to the
+    # bucket width (~9%), count, mean and max are exact.
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add(self, sec):
+        i = 0
+        if sec > BUCKET_MIN:
+            i = min(BUCKET_COUNT - 1, int(math.log2(sec / BUCKET_MIN) * BUCKETS_PER_OCTAVE))
+        self.counts[i] += 1
+        self.count += 1
+        self.total += sec
+        self.max = max(self.max, sec)
+
+
+    def quantile(self, q):
+        # Upper edge of the bucket holding the q-th value, capped by the max
+        if self.count == 0:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for i,n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.max, BUCKET_MIN * 2 ** ((i + 1) / BUCKETS_PER_OCTAVE))
+        return self.max
+
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'max': self.max
+        }
+
+
+
+class Stage(object):
+    # Context manager timing one run of a stage
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def stage(name):
+    # Time the enclosed block as a run of the named stage
+    if not enabled:
+        return NULL_STAGE
+    return Stage(name)
+
+
+def record(name, sec):
+    # Add a duration in seconds to a stage, from any thread
+    if not enabled:
+        return
+    with lock:
+        if name not in histograms:
+            histograms[name] = Histogram()
+        histograms[name].add(sec)
+
+
+def reset():
+    with lock:
+        histograms.clear()
+
+
+def summary():
+    # Summaries of all stages in seconds, known stages first
+    with lock:
+        names = [n for n in STAGES if n in histograms]
+        names += sorted(n for n in histograms if n not in STAGES)
+        return {n: histograms[n].summary() for n in names}
+
+
+def format_ms(sec):
+    ms = sec * 1000
+    return f'{ms:.0f}' if ms >= 100 else f'{ms:.1f}' if ms >= 1 else f'{ms:.2f}'
+
+
+def status_text(names=None):
+    # One line with p50/p95 in milliseconds, for a status bar
+    parts = []
+    for name,s in summary().items():
+        if names is None or name in names:
+            parts.append(f'{name} {format_ms(s["p50"])}/{format_ms(s["p95"])}')
+    if not parts:
+        return ''
+    return 'p50/p95 ms: ' + '  '.join(parts)
+
+
+def export(path):
+    # Write the summaries, in seconds, to a JSON file
+    with open(path, 'w') as f:
+        json.dump({'time': time.time(), 'stages': summary()}, f, indent=2)
+
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    # Serves the summaries as JSON on GET /metrics
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+
+        data = json.dumps({'time': time.time(), 'stages': summary()}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1'):
+    # Serve the summaries over HTTP in a background thread
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
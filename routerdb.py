@@ -0,0 +1,562 @@
+#!/usr/bin/env python
+
+"""
+routerdb.py
+Anton Slavin
+
+Array-backed storage for the routers database.
+
+Routers are kept as a struct of NumPy arrays sorted by MAC address
+(stored as uint64), with names and SSIDs interned into a shared
+string list. Lookups of many MACs at once are done with a single
+binary search over the sorted MAC column.
+
+The CSV file is the source of truth. It is compiled into a versioned
+binary file next to it, which is memory-mapped on load without any
+parsing, and rebuilt automatically when the CSV changes.
+
+Path-loss models fitted per router (see fit_pathloss.py) are kept in
+a second CSV file next to it and attached to the table on load.
+
+Binary layout (little-endian):
+    header       magic, version, router count, string count,
+                 CSV size and modification time
+    MAC index    uint64 per router, sorted
+    records      fixed-width x, y, floor, freq, SSID and name ids
+    strings      uint32 offsets (count + 1), followed by UTF-8 data
+"""
+
+
+# Packages
+import numpy as np
+import struct
+import mmap
+import os
+
+
+# Binary database format
+DB_MAGIC = b'DWRT'
+DB_VERSION = 1
+DB_HEADER = struct.Struct('<4sIIIQq')
+DB_RECORD = np.dtype([
+    ('x', '<i4'),
+    ('y', '<i4'),
+    ('floor', '<i2'),
+    ('freq', '<i2'),
+    ('ssid', '<i4'),
+    ('name', '<i4')
+])
+
+# Spatial index cell size, in pixels of the original map
+GRID_CELL = 256
+
+# Last hex digits of the BSSIDs broadcast by one physical AP
+# (eduroam and ut-public, 2G and 5G), see add_routers.py
+AP_NIBBLES = '01ef'
+
+
+def mac_to_int(mac):
+    # Convert a MAC address string (any case, optional : or - delimiters)
+    # to an integer. Returns -1 for malformed addresses.
+
+    digits = mac.strip().replace(':', '').replace('-', '')
+    if len(digits) != 12:
+        return -1
+
+    try:
+        return int(digits, 16)
+    except ValueError:
+        return -1
+
+
+def int_to_mac(value):
+    # Convert an integer back to a lowercase MAC address string
+    digits = f'{int(value):012x}'
+    return ':'.join([digits[i:i+2] for i in range(0,12,2)])
+
+
+class StringTable(object):
+    # Read-only string table backed by a buffer of UTF-8 data,
+    # decoding strings only when they are accessed
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return bytes(self.data[start:end]).decode('utf-8')
+
+
+
+class FloorGrid(object):
+    # Uniform grid over the routers of all floors. Router rows are
+    # sorted by (floor, cell row, cell column) with the start of every
+    # cell in a table, so the cells of one row of a query rectangle
+    # form a single contiguous slice.
+
+    def __init__(self, x, y, floor, cell=GRID_CELL):
+        self.cell = cell
+        self.x0 = int(x.min())
+        self.y0 = int(y.min())
+        self.f0 = int(floor.min())
+        self.cols = (int(x.max()) - self.x0) // cell + 1
+        self.rows = (int(y.max()) - self.y0) // cell + 1
+        self.floors = int(floor.max()) - self.f0 + 1
+
+        keys = self.key(floor.astype(np.int64) - self.f0,
+                        (y.astype(np.int64) - self.y0) // cell,
+                        (x.astype(np.int64) - self.x0) // cell)
+        self.order = np.argsort(keys, kind='stable')
+        self.starts = np.searchsorted(keys[self.order],
+                                      np.arange(self.floors * self.rows * self.cols + 1))
+
+
+    def key(self, f, r, c):
+        return (f * self.rows + r) * self.cols + c
+
+
+    def candidates(self, floor, x0, y0, x1, y1):
+        # Rows of all routers in the cells overlapping the rectangle
+        f = floor - self.f0
+        if f < 0 or f >= self.floors:
+            return np.zeros(0, dtype=np.int64)
+
+        c0 = max(0, (int(x0) - self.x0) // self.cell)
+        c1 = min(self.cols - 1, (int(x1) - self.x0) // self.cell)
+        r0 = max(0, (int(y0) - self.y0) // self.cell)
+        r1 = min(self.rows - 1, (int(y1) - self.y0) // self.cell)
+        if c0 > c1 or r0 > r1:
+            return np.zeros(0, dtype=np.int64)
+
+        parts = [self.order[self.starts[self.key(f, r, c0)]:self.starts[self.key(f, r, c1) + 1]]
+                 for r in range(r0, r1 + 1)]
+        return np.concatenate(parts)
+
+
+
+class RouterTable(object):
+    def __init__(self, macs, x, y, floor, freq, ssid_ids, name_ids, strings, buf=None):
+        # All columns must have the same length and be sorted by MAC.
+        # ssid_ids and name_ids index into strings.
+        # buf: memory map backing the columns, kept open with the table
+
+        self.macs = macs
+        self.x = x
+        self.y = y
+        self.floor = floor
+        self.freq = freq
+        self.ssid_ids = ssid_ids
+        self.name_ids = name_ids
+        self.strings = strings
+        self.buf = buf
+        self.grid = None # spatial index, built on first use
+        self.ap_cache = {} # AP ids per nibble rule
+        self.mac_rows = None # row per MAC string, built on first use
+        self.lists = None # x, y and floor columns as lists, for single scans
+
+        # Fitted transmit power and path-loss exponent of every row,
+        # NaN for routers without a fit. None if nothing was fitted.
+        self.power = None
+        self.path_loss = None
+        self.model_cache = {} # derived per-router tables per config
+
+
+    @classmethod
+    def from_rows(cls, rows):
+        # Build a table from an iterable of router dicts with the keys
+        # MAC, x, y, SSID, floor, freq and name
+
+        macs, x, y, floor, freq, ssid_ids, name_ids = [], [], [], [], [], [], []
+        strings = []
+        interned = {}
+
+        def intern(s):
+            if s not in interned:
+                interned[s] = len(strings)
+                strings.append(s)
+            return interned[s]
+
+        for rr in rows:
+            mac = mac_to_int(rr['MAC'])
+            if mac < 0:
+                print('[!] Skipping router with malformed MAC address:', rr['MAC'])
+                continue
+
+            macs.append(mac)
+            x.append(rr['x'])
+            y.append(rr['y'])
+            floor.append(rr['floor'])
+            freq.append(rr['freq'])
+            ssid_ids.append(intern(rr['SSID']))
+            name_ids.append(intern(rr['name']))
+
+        # Sort every column by MAC for binary search lookups.
+        # Of rows with the same MAC, the last one wins.
+        macs = np.asarray(macs, dtype=np.uint64)
+        order = np.argsort(macs, kind='stable')
+        sorted_macs = macs[order]
+        order = order[np.append(sorted_macs[1:] != sorted_macs[:-1], len(macs) > 0)[:len(macs)]]
+        return cls(macs[order],
+                   np.asarray(x, dtype=np.int32)[order],
+                   np.asarray(y, dtype=np.int32)[order],
+                   np.asarray(floor, dtype=np.int16)[order],
+                   np.asarray(freq, dtype=np.int16)[order],
+                   np.asarray(ssid_ids, dtype=np.int32)[order],
+                   np.asarray(name_ids, dtype=np.int32)[order],
+                   strings)
+
+
+    def __len__(self):
+        return len(self.macs)
+
+
+    def __contains__(self, mac):
+        return self.index([mac])[0] >= 0
+
+
+    def __getitem__(self, mac):
+        # Single router as a dict, for UI code
+        i = self.index([mac])[0]
+        if i < 0:
+            raise KeyError(mac)
+        return self.row(i)
+
+
+    def row(self, i):
+        # Router at row i as a dict
+        return {
+            'MAC': int_to_mac(self.macs[i]),
+            'x': int(self.x[i]),
+            'y': int(self.y[i]),
+            'SSID': self.strings[self.ssid_ids[i]],
+            'floor': int(self.floor[i]),
+            'freq': int(self.freq[i]),
+            'name': self.strings[self.name_ids[i]]
+        }
+
+
+    def name(self, i):
+        # Location name of the router at row i
+        return self.strings[self.name_ids[i]]
+
+
+    def index(self, macs):
+        # Rows of the given MAC addresses (strings or integers),
+        # -1 for MACs not present in the table
+        return np.array(self.rows_of(macs), dtype=np.int64)
+
+
+    def rows_of(self, macs):
+        # Rows of the given MAC addresses as a list, -1 for unknown ones.
+        # Lowercase MACs with colons, as the scanners report them, are a
+        # dict lookup. Other forms and integers are searched for.
+
+        if self.mac_rows is None:
+            self.mac_rows = {int_to_mac(m): i for i,m in enumerate(self.macs.tolist())}
+
+        rows = [self.mac_rows.get(m, -1) if isinstance(m, str) else -1 for m in macs]
+        if -1 not in rows or len(self.macs) == 0:
+            return rows
+
+        missing = [i for i,row in enumerate(rows) if row < 0]
+        keys = np.array([mac_to_int(macs[i]) if isinstance(macs[i], str) else macs[i]
+                         for i in missing], dtype=np.int64)
+        found = np.searchsorted(self.macs, keys.astype(np.uint64))
+        found = np.minimum(found, len(self.macs) - 1)
+        ok = (keys >= 0) & (self.macs[found] == keys.astype(np.uint64))
+        for i,row,hit in zip(missing, found.tolist(), ok.tolist()):
+            if hit:
+                rows[i] = row
+
+        return rows
+
+
+    def columns(self):
+        # x, y and floor of every row as lists, which are faster than
+        # arrays to read one element at a time
+        if self.lists is None:
+            self.lists = (self.x.tolist(), self.y.tolist(), self.floor.tolist())
+        return self.lists
+
+
+    def coords(self, macs):
+        # Coordinates of the given MACs as an (n, 2) array.
+        # Unknown MACs raise a KeyError.
+
+        rows = self.index(macs)
+        if (rows < 0).any():
+            raise KeyError(macs[int(np.argmin(rows))])
+        return np.stack([self.x[rows], self.y[rows]], axis=1)
+
+
+    def on_floor(self, floor):
+        # Rows of all routers on the given floor
+        return np.flatnonzero(self.floor == floor)
+
+
+    def ap_ids(self, nibbles=AP_NIBBLES):
+        # Physical AP of every row, as an index from 0 to the number of
+        # APs. BSSIDs whose last hex digit is one of nibbles and that
+        # differ only in it belong to the same AP, as long as they are
+        # at the same position. Other BSSIDs are APs of their own.
+
+        if nibbles not in self.ap_cache:
+            macs = self.macs.astype(np.uint64)
+            digits = np.array([int(c, 16) for c in nibbles], dtype=np.uint64)
+            grouped = np.isin(macs & np.uint64(0xf), digits)
+            # Ungrouped MACs (48 bits) are moved out of the range of grouped keys
+            base = np.where(grouped, macs >> np.uint64(4), macs | np.uint64(1 << 60))
+
+            keys = np.zeros(len(macs), dtype=[('base', '<u8'), ('floor', '<i2'),
+                                              ('x', '<i4'), ('y', '<i4')])
+            keys['base'] = base
+            keys['floor'] = self.floor
+            keys['x'] = self.x
+            keys['y'] = self.y
+            _, ids = np.unique(keys, return_inverse=True)
+            self.ap_cache[nibbles] = ids.reshape(-1)
+
+        return self.ap_cache[nibbles]
+
+
+    def set_path_loss(self, macs, power, path_loss):
+        # Attach fitted path-loss models to the routers with the given
+        # MACs. Unknown MACs are ignored.
+
+        rows = self.index(macs)
+        found = rows >= 0
+        self.power = np.full(len(self.macs), np.nan)
+        self.path_loss = np.full(len(self.macs), np.nan)
+        self.power[rows[found]] = np.asarray(power, dtype=float)[found]
+        self.path_loss[rows[found]] = np.asarray(path_loss, dtype=float)[found]
+        self.model_cache = {}
+
+
+    def spatial(self):
+        # Spatial index of the routers, built on first use
+        if self.grid is None and len(self.macs) > 0:
+            self.grid = FloorGrid(self.x, self.y, self.floor)
+        return self.grid
+
+
+    def in_rect(self, floor, x0, y0, x1, y1):
+        # Rows of the routers on the given floor inside a rectangle
+        if len(self.macs) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        rows = self.spatial().candidates(floor, x0, y0, x1, y1)
+        x, y = self.x[rows], self.y[rows]
+        inside = (self.floor[rows] == floor) & (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+        return rows[inside]
+
+
+    def within(self, floor, x, y, radius):
+        # Rows of the routers on the given floor within a radius of
+        # a point, nearest first
+        rows = self.in_rect(floor, x - radius, y - radius, x + radius, y + radius)
+        d = np.hypot(self.x[rows] - x, self.y[rows] - y)
+        near = d <= radius
+        return rows[near][np.argsort(d[near], kind='stable')]
+
+
+
+def read_csv(path):
+    # Read all router rows from a CSV file as dicts
+    # Format: x,y,mac,ssid,floor,frequency,name
+
+    # Open and read file
+    with open(path, 'r') as f:
+        rows = f.read().splitlines()
+
+    # Skip first row
+    if rows and rows[0].startswith('x'):
+        rows = rows[1:]
+
+    routers = []
+    for row in rows:
+        if len(row) == 0 or not row:
+            continue
+
+        row = row.split(',')
+        routers.append({
+            'x': int(row[0]),
+            'y': int(row[1]),
+            'MAC': row[2],
+            'SSID': row[3],
+            'floor': int(row[4]),
+            'freq': int(row[5]),
+            'name': row[6].strip()
+        })
+
+    return routers
+
+
+def load_csv(path):
+    # Load data for all routers from a CSV file, parsing every row
+    return RouterTable.from_rows(read_csv(path))
+
+
+def db_path_for(csv_path):
+    # Path of the compiled database belonging to a CSV file
+    return os.path.splitext(csv_path)[0] + '.rdb'
+
+
+def path_loss_path_for(csv_path):
+    # Path of the fitted path-loss models belonging to a CSV file
+    return os.path.splitext(csv_path)[0] + '.pathloss.csv'
+
+
+def read_path_loss(path):
+    # Read fitted path-loss models as (MACs, powers, exponents)
+    # Format: mac,power,path_loss
+
+    macs, power, path_loss = [], [], []
+    with open(path, 'r') as f:
+        for row in f.read().splitlines()[1:]:
+            if not row:
+                continue
+            row = row.split(',')
+            macs.append(row[0])
+            power.append(float(row[1]))
+            path_loss.append(float(row[2]))
+
+    return macs, power, path_loss
+
+
+def write_path_loss(path, macs, power, path_loss):
+    # Write fitted path-loss models, one row per MAC
+    with open(path, 'w') as f:
+        f.write('mac,power,path_loss\n')
+        for mac,p,n in zip(macs, power, path_loss):
+            f.write(f'{mac},{p:.3f},{n:.4f}\n')
+
+
+def compile_db(csv_path, db_path=None):
+    # Compile the CSV file into a binary database.
+    # The file is written next to the target and moved into place,
+    # so readers never see a partially written database.
+
+    db_path = db_path or db_path_for(csv_path)
+    st = os.stat(csv_path)
+    table = load_csv(csv_path)
+    n = len(table)
+
+    records = np.zeros(n, dtype=DB_RECORD)
+    records['x'] = table.x
+    records['y'] = table.y
+    records['floor'] = table.floor
+    records['freq'] = table.freq
+    records['ssid'] = table.ssid_ids
+    records['name'] = table.name_ids
+
+    encoded = [s.encode('utf-8') for s in table.strings]
+    offsets = np.zeros(len(encoded) + 1, dtype='<u4')
+    offsets[1:] = np.cumsum([len(s) for s in encoded])
+
+    header = DB_HEADER.pack(DB_MAGIC, DB_VERSION, n, len(encoded),
+                            st.st_size, st.st_mtime_ns)
+
+    tmp_path = db_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(table.macs.astype('<u8').tobytes())
+        f.write(records.tobytes())
+        f.write(offsets.tobytes())
+        f.write(b''.join(encoded))
+
+    os.replace(tmp_path, db_path)
+
+
+def open_db(db_path):
+    # Memory-map a compiled database. No rows are parsed or copied,
+    # all columns are views into the mapped file.
+    # Returns None if the file is missing or has a different version.
+
+    try:
+        with open(db_path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if len(buf) < DB_HEADER.size:
+        buf.close()
+        return None
+
+    magic, version, n, n_strings, _, _ = DB_HEADER.unpack_from(buf)
+    if magic != DB_MAGIC or version != DB_VERSION:
+        buf.close()
+        return None
+
+    offset = DB_HEADER.size
+    macs = np.frombuffer(buf, dtype='<u8', count=n, offset=offset)
+    offset += macs.nbytes
+    records = np.frombuffer(buf, dtype=DB_RECORD, count=n, offset=offset)
+    offset += records.nbytes
+    str_offsets = np.frombuffer(buf, dtype='<u4', count=n_strings + 1, offset=offset)
+    offset += str_offsets.nbytes
+    strings = StringTable(str_offsets, memoryview(buf)[offset:])
+
+    return RouterTable(macs, records['x'], records['y'], records['floor'],
+                       records['freq'], records['ssid'], records['name'],
+                       strings, buf)
+
+
+def is_stale(csv_path, db_path):
+    # Check if the compiled database does not match the CSV file
+
+    try:
+        st = os.stat(csv_path)
+        with open(db_path, 'rb') as f:
+            header = f.read(DB_HEADER.size)
+        magic, version, _, _, size, mtime = DB_HEADER.unpack(header)
+    except (OSError, struct.error):
+        return True
+
+    return (magic != DB_MAGIC or version != DB_VERSION or
+            size != st.st_size or mtime != st.st_mtime_ns)
+
+
+def load(csv_path, db_path=None):
+    # Load the routers database, compiling the CSV file first
+    # if the binary database is missing or out of date.
+    # Fitted path-loss models next to the CSV file are attached.
+
+    db_path = db_path or db_path_for(csv_path)
+    table = None
+
+    if is_stale(csv_path, db_path):
+        try:
+            compile_db(csv_path, db_path)
+        except OSError as e:
+            # E.g. read-only data folder or database mapped on Windows
+            print('[!] Unable to compile routers database:', e)
+            table = load_csv(csv_path)
+
+    if table is None:
+        table = open_db(db_path)
+        if table is None:
+            print('[!] Unable to open routers database:', db_path)
+            table = load_csv(csv_path)
+
+    pl_path = path_loss_path_for(csv_path)
+    if os.path.exists(pl_path):
+        table.set_path_loss(*read_path_loss(pl_path))
+
+    return table
+
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Compile a CSV file into a binary database
+    args = sys.argv[1:]
+    if len(args) not in [1, 2]:
+        print('[!] Usage:\n    python3 routerdb.py routers.csv [routers.rdb]')
+        quit(1)
+
+    compile_db(*args)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+scanevents.py
+Anton Slavin
+
+Push-based scanning from the kernel's scan notifications (Linux).
+
+EventScanner keeps one long-running iw event process open and reads
+it in a background thread. When an adapter reports new scan results,
+only the networks seen by that scan are read from the kernel's scan
+cache (iw scan dump, a few milliseconds) and handed to the next scan()
+call, which waits for them otherwise. Positions are then updated as
+soon as the radio has data, instead of on a timer.
+
+Scans started by other programs (e.g. NetworkManager) are used as
+well. If no scan was started for a while, one is triggered.
+
+The event, dump and trigger commands can be replaced, e.g. by scripts
+printing recorded output, to test without a Wi-Fi adapter.
+"""
+
+
+# Packages
+import subprocess as sp
+import threading
+import time
+import re
+
+import scanner
+
+
+# Commands run per adapter, {adapter} is replaced by its name
+DUMP_CMD = ('iw', '{adapter}', 'scan', 'dump')
+TRIGGER_CMD = ('iw', '{adapter}', 'scan', 'trigger')
+
+# iw event line, optionally prefixed with a timestamp (-t):
+#   1697551234.123456: wlan0 (phy #0): new scan results
+EVENT = re.compile(r'^(?:[\d.]+: )?(\S+) \(phy #\d+\): (.+)$')
+
+SLACK_MS = 500          # networks seen this long before a scan started still count as fresh
+WAIT_SEC = 30.0         # scan() gives up waiting after this long
+
+
+
+def parse_iw_event(lines):
+    # Yield (adapter, message) for every event line of iw event
+    for line in lines:
+        match = EVENT.match(line.rstrip())
+        if match is not None:
+            yield match.group(1), match.group(2)
+
+
+
+class EventScanner(object):
+    # Scanner backend serving scan results as they are reported.
+    # adapters: list of adapter names to follow
+    # refresh: seconds without a started scan before one is triggered
+    # cmd: event source, dump_cmd and trigger_cmd: commands per adapter
+    # Once the event source ends and all results were served,
+    # scan() returns empty lists and finished is set.
+
+    def __init__(self, adapters, refresh=4.0, wait=WAIT_SEC, cmd=('iw', 'event', '-t'),
+                 dump_cmd=DUMP_CMD, trigger_cmd=TRIGGER_CMD):
+        self.adapters = list(adapters)
+        self.refresh = refresh
+        self.wait = wait
+        self.dump_cmd = dump_cmd
+        self.trigger_cmd = trigger_cmd
+        self.started = {}
+        self.fresh = {}
+        self.last_start = None
+        self.ended = False
+        self.cond = threading.Condition()
+
+        self.proc = sp.Popen(list(cmd), stdout=sp.PIPE, stderr=sp.DEVNULL,
+                             encoding='utf-8', errors='replace')
+        threading.Thread(target=self.read, daemon=True).start()
+
+
+    @property
+    def finished(self):
+        return self.ended and not self.fresh
+
+
+    def read(self):
+        # Event thread: follow the notifications of the event source
+        for adapter,message in parse_iw_event(self.proc.stdout):
+            if adapter not in self.adapters:
+                continue
+
+            if message == 'scan started':
+                self.started[adapter] = time.monotonic()
+                self.last_start = self.started[adapter]
+            elif message == 'new scan results':
+                self.results(adapter)
+
+        with self.cond:
+            self.ended = True
+            self.cond.notify_all()
+
+
+    def results(self, adapter):
+        # Read the networks of the scan that just finished from the cache
+        max_age = None
+        if adapter in self.started:
+            max_age = (time.monotonic() - self.started.pop(adapter)) * 1000 + SLACK_MS
+
+        lines = scanner.run_lines(self.command(self.dump_cmd, adapter), timeout=scanner.timeout)
+        networks = list(scanner.parse_iw(lines, adapter, max_age))
+        with self.cond:
+            self.fresh[adapter] = networks
+            self.cond.notify_all()
+
+
+    def trigger(self):
+        # Start a scan on every adapter, results are reported as events
+        self.last_start = time.monotonic()
+        for adapter in self.adapters:
+            sp.run(self.command(self.trigger_cmd, adapter), stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+
+
+    def command(self, cmd, adapter):
+        return [part.format(adapter=adapter) for part in cmd]
+
+
+    def scan(self, adapter=None):
+        # Networks of the scan results reported since the last call,
+        # merged over adapters. Waits for new results if there are none,
+        # empty if none arrive in time.
+
+        deadline = time.monotonic() + self.wait
+        with self.cond:
+            while not self.fresh and not self.ended:
+                now = time.monotonic()
+                if now >= deadline:
+                    return []
+
+                if self.last_start is None or now - self.last_start >= self.refresh:
+                    self.trigger()
+                    continue
+
+                self.cond.wait(min(deadline, self.last_start + self.refresh) - now)
+
+            scans, self.fresh = list(self.fresh.values()), {}
+
+        return scanner.merge_scans(scans, scanner.merge)
+
+
+    def close(self):
+        # Stop the event source, waking up a waiting scan()
+        self.proc.kill()
+        self.proc.wait()
+        with self.cond:
+            self.ended = True
+            self.cond.notify_all()
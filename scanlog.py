@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+scanlog.py
+Anton Slavin
+
+Recording and replaying of network scans.
+
+ScanRecorder appends every scan with its timestamp to a compact binary
+log. ReplayScanner reads a log back and serves the scans in place of a
+live scan, either at the recorded pace or as fast as possible, so
+experiments do not need a Wi-Fi adapter or sudo.
+
+Log layout (little-endian):
+    header       magic, version
+    per scan     timestamp (float64), network count (uint16),
+                 count x (MAC as int64, RSSI as float32),
+                 count x (SSID length (uint8), UTF-8 SSID)
+"""
+
+
+# Packages
+import struct
+import time
+
+import routerdb
+
+
+# Log format
+LOG_MAGIC = b'DWSL'
+LOG_VERSION = 1
+LOG_HEADER = struct.Struct('<4sH')
+SCAN_HEADER = struct.Struct('<dH')
+NETWORK = struct.Struct('<qf')
+
+
+
+class ScanRecorder(object):
+    # Appends scans to a log file, flushing after every scan
+
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(LOG_HEADER.pack(LOG_MAGIC, LOG_VERSION))
+            self.file.flush()
+
+
+    def write(self, networks, t=None):
+        # Append a scan (list of network dicts) taken at time t
+        t = time.time() if t is None else t
+
+        macs = [routerdb.mac_to_int(nw.get('MAC', '')) for nw in networks]
+        rows = [(mac, nw) for mac,nw in zip(macs, networks) if mac >= 0 and 'RSSI' in nw]
+        rows = rows[:65535]
+
+        data = [SCAN_HEADER.pack(t, len(rows))]
+        for mac,nw in rows:
+            data.append(NETWORK.pack(mac, nw['RSSI']))
+        for _,nw in rows:
+            ssid = (nw.get('SSID') or '').encode('utf-8')[:255]
+            data.append(bytes([len(ssid)]) + ssid)
+
+        self.file.write(b''.join(data))
+        self.file.flush()
+
+
+    def close(self):
+        self.file.close()
+
+
+
+def read_log(path):
+    # Yield (timestamp, networks) for every scan in a log.
+    # A truncated last scan (e.g. after a crash) is ignored.
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if len(data) < LOG_HEADER.size:
+        return
+
+    magic, version = LOG_HEADER.unpack_from(data)
+    if magic != LOG_MAGIC or version != LOG_VERSION:
+        print('[!] Not a scan log or unsupported version:', path)
+        return
+
+    pos = LOG_HEADER.size
+    while pos + SCAN_HEADER.size <= len(data):
+        t, n = SCAN_HEADER.unpack_from(data, pos)
+        pos += SCAN_HEADER.size
+        if pos + n * NETWORK.size > len(data):
+            return
+
+        networks = []
+        for mac,rssi in NETWORK.iter_unpack(data[pos:pos + n * NETWORK.size]):
+            # Integer RSSI values are stored exactly
+            rssi = int(rssi) if rssi == int(rssi) else rssi
+            networks.append({'MAC': routerdb.int_to_mac(mac), 'RSSI': rssi})
+        pos += n * NETWORK.size
+
+        for network in networks:
+            if pos >= len(data) or pos + 1 + data[pos] > len(data):
+                return
+            length = data[pos]
+            network['SSID'] = data[pos + 1:pos + 1 + length].decode('utf-8', errors='replace')
+            pos += 1 + length
+
+        yield t, networks
+
+
+
+class ReplayScanner(object):
+    # Scanner backend serving the scans of a log.
+    # speed: 1.0 for the recorded pace, 2.0 twice as fast, 0 for as
+    # fast as possible. Once the log is exhausted, scan() returns
+    # empty lists and finished is set, unless loop is enabled.
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.scans = list(read_log(path))
+        self.speed = speed
+        self.loop = loop
+        self.pos = 0
+        self.start = None
+        self.finished = len(self.scans) == 0
+
+
+    def scan(self, adapter=None):
+        if self.pos >= len(self.scans):
+            if not self.loop or not self.scans:
+                self.finished = True
+                return []
+            self.pos = 0
+            self.start = None
+
+        t, networks = self.scans[self.pos]
+        self.pos += 1
+
+        # Wait until the scan is due, relative to the first one
+        if self.speed > 0:
+            if self.start is None:
+                self.start = (time.monotonic(), t)
+            due = self.start[0] + (t - self.start[1]) / self.speed
+            time.sleep(max(0.0, due - time.monotonic()))
+
+        # Copies, as callers mutate the network dicts
+        return [dict(nw) for nw in networks]
@@ -11,144 +11,366 @@ Main method is run(), which performs an OS platform check and launches
 the appropriate method for scanning.
 
 Returned data is in the form of a list of dict objects.
+The parse_* generators read the scan output line by line and yield
+every network as soon as its block is complete.
+
+On Linux, scans can be served from the kernel's cached scan results
+(iw scan dump), which takes milliseconds and needs no root. The cache
+is refreshed by a background scan trigger every few seconds, and an
+active scan is only run when it holds no results fresh enough.
+
+Several Linux adapters (a comma-separated adapter name) are scanned
+concurrently, and the networks seen by more than one are merged.
 """
 
 
 # Packages
-from scipy.interpolate import interp1d
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import subprocess as sp
+import threading
+import metrics
+import time
 import sys
+import re
+
+
+# Windows reports signal quality in %, linearly mapped to -100..-50 dBm
+PERCENT_TO_DBM = [-100 + p / 2 for p in range(101)]
+
+# airport -s row: right-aligned SSID, BSSID, RSSI, ...
+AIRPORT_ROW = re.compile(r'^\s*(.*?)\s+([0-9a-fA-F]{2}(?::[0-9a-fA-F]{2}){5})\s+(-\d+)\s')
+AIRPORT_NO_BSSID = re.compile(r'^\s*(.*?)\s+(-\d+)\s')
+
+# Optional scan log: replayed instead of scanning, or recorded to.
+# Or scan notifications followed instead of scanning (event_driven).
+backend = None
+recorder = None
+event_driven = False
+
+# Linux scan cache: maximum age of cached results in seconds (0 to
+# always run an active scan) and seconds between background scans.
+# Refresh times and scan triggers are kept per adapter.
+cache_sec = 0
+refresh_sec = 0
+last_refresh = {}
+triggers = {}
+
+# Seconds a triggered scan may take, and between polls of its results
+TRIGGER_SEC = 5.0
+TRIGGER_POLL = 0.25
+
+# Multiple adapters: how RSSI values of one network are merged
+# (max, mean or latest) and seconds each scan command may take
+MERGE = ['max', 'mean', 'latest']
+merge = 'max'
+timeout = None
+pool = None
+
+
+
+def run_lines(cmd, encoding='utf-8', timeout=None):
+    # Run a command and yield its output line by line,
+    # as soon as each line is written to the pipe.
+    # The command is killed after timeout seconds, ending the output.
+
+    proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.DEVNULL,
+                    encoding=encoding, errors='replace')
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+    try:
+        for line in proc.stdout:
+            yield line
+    finally:
+        if timer is not None:
+            timer.cancel()
+        proc.stdout.close()
+        proc.wait()
 
 
+def parse_airport(lines):
+    # Parse the output of airport -s, yielding every network
 
-def scan_macos():
-    # Run the airport utility as a subprocess
-    # NB! The utility must be enabled/linked beforehand
-    res = sp.run(['airport', '-s'], capture_output=True)
-
-    # Parse output from the airport scan
-    networks = []
-    result = res.stdout.decode().split('\n')
-    for idx,row in enumerate(result):
-        row = row.strip().split(' ')
-
-        # Filter out first and invalid rows
-        if idx == 0 or row[0] == '':
+    for idx,row in enumerate(lines):
+        # Skip the header row
+        if idx == 0:
             continue
 
-        if not row[2].startswith('-'):
-            continue
-
-        # Check if any of the desired values are empty
-        for i in range(0,3):
-            if row[i] == '':
+        match = AIRPORT_ROW.match(row)
+        if match is None:
+            # BSSIDs are hidden when the utility is not run as root
+            if AIRPORT_NO_BSSID.match(row):
                 print('[!] Incomplete data during nearby network parsing')
                 print('Did you run the app as sudo?')
                 quit(1)
+            continue
 
         # First columns contain the required values
         # Based on the output of airport -s command
-        network = {
-            'SSID': row[0],
-            'MAC': row[1],
-            'RSSI': int(row[2])
+        yield {
+            'SSID': match.group(1),
+            'MAC': match.group(2).lower(),
+            'RSSI': int(match.group(3))
         }
-        networks.append(network)
 
-    return networks
 
+def parse_iw(lines, adapter, max_age=None):
+    # Parse the output of iw <adapter> scan (or scan dump),
+    # yielding every network once its BSS block is complete.
+    # Networks last seen more than max_age ms ago are skipped.
 
-def scan_linux(adapter):
-    # Run the iw utility and parse output (despite being not recommended)
-    # to get a list of nearby networks.
-    # Custom adapter name given as app argument
+    header = f'(on {adapter})'
+    network = None
+    age = 0
+    for row in lines:
+        if row.startswith('BSS ') and header in row:
+            if network is not None and 'RSSI' in network and (max_age is None or age <= max_age):
+                yield network
 
-    res = sp.run(['iw', adapter, 'scan'], capture_output=True)
-    result = res.stdout.decode().split('\n')
-    
-    networks = []
-    new_network = {}
-    adding = False
-    for row in result:
-        row = row.strip().lower()
-
-        if row.startswith('bss') and f'(on {adapter})' in row:
-            if adding:
-                networks.append(new_network)
-                new_network = {}
-            
-            adding = True
-            new_network['MAC'] = row[4:21]
-
-        if adding and row.startswith('ssid:'):
-            new_network['SSID'] = row[6:]
-
-        if adding and row.startswith('signal:'):
-            new_network['RSSI'] = int(row[8:11])
-
-    networks.append(new_network)
-    return networks
+            network = {'MAC': row[4:21].lower()}
+            age = 0
+            continue
 
+        if network is None:
+            continue
 
-def scan_win():
-    # Run the netsh utility and parse output to get a list
-    # of nearby networks as detected by Wi-Fi adapter
-    res = sp.run(['netsh', 'wlan', 'show', 'all'], capture_output=True)
-    result = res.stdout.decode(encoding='cp1252').split('\n')
+        row = row.lstrip()
+        if row.startswith('SSID:'):
+            network['SSID'] = row[6:].rstrip('\n').lower()
+        elif row.startswith('signal:'):
+            network['RSSI'] = int(float(row[8:].split(' ', 1)[0]))
+        elif row.startswith('last seen:') and row.rstrip().endswith('ms ago'):
+            age = int(row[11:].split(' ', 1)[0])
+
+    if network is not None and 'RSSI' in network and (max_age is None or age <= max_age):
+        yield network
+
+
+def parse_netsh(lines):
+    # Parse the output of netsh wlan show all, yielding every BSSID.
+    # Networks are listed by SSID, each followed by its BSSIDs.
 
-    networks = []
-    new_network = {}
     display = False
-    adding = False
-    for row in result:
+    ssid = None
+    network = None
+    for row in lines:
         if 'SHOW NETWORKS MODE=BSSID' in row:
             display = True
+            continue
 
         if 'SHOW INTERFACE CAPABILITIES' in row:
             display = False
+            if network is not None:
+                yield network
+                network = None
+            continue
 
         if not display:
             continue
 
-        row = row.strip().lower()
-        if row.startswith('ssid '):
-            if adding:
-                networks.append(new_network)
-                new_network = {}
+        row = row.strip()
+        if row.startswith('SSID '):
+            ssid = row.split(':', 1)[1].strip().lower()
+
+        elif row.startswith('BSSID'):
+            if network is not None:
+                yield network
+            network = {'SSID': ssid, 'MAC': row.split(':', 1)[1].strip().lower()}
+
+        elif network is not None and row.startswith('Signal'):
+            # Convert signal strength % to dBm
+            percent = int(row.split(':', 1)[1].strip()[:-1])
+            network['RSSI'] = PERCENT_TO_DBM[percent]
+
+            # The signal is the last field needed from this BSSID
+            yield network
+            network = None
+
+    if network is not None:
+        yield network
 
-            adding = True
-            new_network['SSID'] = row.split(':')[1].strip()
 
-        if adding and row.startswith('bssid'):
-            new_network['MAC'] = row.split(':', 1)[1].strip()
+def scan_macos():
+    # Run the airport utility as a subprocess
+    # NB! The utility must be enabled/linked beforehand
+    return list(parse_airport(run_lines(['airport', '-s'])))
+
+
+def scan_linux(adapter):
+    # Run the iw utility and parse output (despite being not recommended)
+    # to get a list of nearby networks.
+    # Custom adapter name given as app argument
 
-        if adding and row.startswith('signal'):
-            # Interpolate signal strength % to dBm
-            conversion = interp1d([0, 100], [-100, -50])
-            percent = int(row.split(':')[1].strip()[:-1])
-            new_network['RSSI'] = conversion(percent)
+    if cache_sec > 0:
+        networks = scan_linux_cached(adapter)
+        if networks:
+            return networks
 
+        # The kernel refuses an active scan while a triggered one runs
+        networks = wait_triggered(adapter)
+        if networks:
+            return networks
 
-    networks.append(new_network)
+    # Active scan, blocks for a few seconds
+    networks = list(parse_iw(run_lines(['iw', adapter, 'scan'], timeout=timeout), adapter))
+    last_refresh[adapter] = time.monotonic()
     return networks
 
 
+def scan_linux_cached(adapter):
+    # Networks from the kernel's cached scan results seen within
+    # cache_sec, refreshing the cache in the background if due.
+    # Empty if the cache holds no fresh results, in which case no
+    # background scan is started, so an active scan can run instead.
+
+    lines = run_lines(['iw', adapter, 'scan', 'dump'], timeout=timeout)
+    networks = list(parse_iw(lines, adapter, cache_sec * 1000))
+
+    now = time.monotonic()
+    if networks and (adapter not in last_refresh or now - last_refresh[adapter] >= refresh_sec):
+        # Only one background scan at a time, finished ones are reaped
+        trigger = triggers.get(adapter)
+        if trigger is None or trigger.poll() is not None:
+            triggers[adapter] = sp.Popen(['iw', adapter, 'scan', 'trigger'],
+                                         stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+            last_refresh[adapter] = now
+
+    return networks
+
+
+def wait_triggered(adapter):
+    # Networks of a background scan of the adapter that may still be
+    # running, polled from the cache until TRIGGER_SEC after it started.
+    # Empty if there is none or it found nothing.
+
+    trigger = triggers.pop(adapter, None)
+    if trigger is None:
+        return []
+
+    started = last_refresh[adapter]
+    if time.monotonic() - started >= TRIGGER_SEC:
+        return []
+
+    trigger.wait()
+    while True:
+        age = time.monotonic() - started
+        lines = run_lines(['iw', adapter, 'scan', 'dump'], timeout=timeout)
+        networks = list(parse_iw(lines, adapter, age * 1000))
+        if networks or age >= TRIGGER_SEC:
+            return networks
+        time.sleep(TRIGGER_POLL)
+
+
+def scan_linux_many(adapters):
+    # Scan several adapters concurrently and merge their networks.
+    # A scan that times out contributes the networks read until then.
+    global pool
+
+    if pool is None:
+        pool = ThreadPoolExecutor(max(len(adapters), 4), 'scan')
+
+    futures = [pool.submit(scan_linux, adapter) for adapter in adapters]
+    return merge_scans([f.result() for f in as_completed(futures)], merge)
+
+
+def merge_scans(scans, how='max'):
+    # Merge lists of networks seen by different adapters, in the order
+    # the scans finished. Networks seen by several adapters get the
+    # max or mean of their RSSI values, or those of the latest scan.
+
+    merged = {}
+    rssi = {}
+    for networks in scans:
+        for network in networks:
+            mac = network['MAC']
+            if mac not in merged or how == 'latest':
+                merged[mac] = dict(network)
+            rssi.setdefault(mac, []).append(network['RSSI'])
+
+    if how == 'max':
+        for mac,network in merged.items():
+            network['RSSI'] = max(rssi[mac])
+    elif how == 'mean':
+        for mac,network in merged.items():
+            network['RSSI'] = round(sum(rssi[mac]) / len(rssi[mac]))
+
+    return list(merged.values())
+
+
+def scan_win():
+    # Run the netsh utility and parse output to get a list
+    # of nearby networks as detected by Wi-Fi adapter
+    cmd = ['netsh', 'wlan', 'show', 'all']
+    return list(parse_netsh(run_lines(cmd, encoding='cp1252')))
+
+
+def configure(record=None, replay=None, speed=1.0, loop=False, cache=0, refresh=0,
+              merge_by='max', adapter_timeout=None, events=None):
+    # Record every live scan to a log file, or replay scans from one
+    # instead of scanning (speed 0 replays as fast as possible).
+    # On Linux, serve scans from cached results up to cache seconds
+    # old, refreshed every refresh seconds (cache 0 disables this).
+    # Networks of several adapters are merged by merge_by, and every
+    # scan command is stopped after adapter_timeout seconds.
+    # events: Linux adapter name(s) whose scan notifications are
+    # followed instead of scanning on every call.
+    global backend, recorder, cache_sec, refresh_sec, merge, timeout, event_driven
+    import scanlog
+    import scanevents
+
+    if merge_by not in MERGE:
+        print('[!] Unknown scan merge method:', merge_by)
+        merge_by = 'max'
+
+    cache_sec = cache
+    refresh_sec = refresh
+    merge = merge_by
+    timeout = adapter_timeout or None
+
+    backend = None
+    if replay:
+        backend = scanlog.ReplayScanner(replay, speed, loop)
+    elif events and sys.platform == 'linux':
+        adapters = [a.strip() for a in events.split(',') if a.strip()]
+        backend = scanevents.EventScanner(adapters, refresh)
+    event_driven = isinstance(backend, scanevents.EventScanner)
+    recorder = scanlog.ScanRecorder(record) if record and not replay else None
+
+
+def close():
+    # Stop the scan backend and close the scan log, if any
+    if backend is not None and hasattr(backend, 'close'):
+        backend.close()
+    if recorder is not None:
+        recorder.close()
+
+
 def scan(adapter=None):
     # Launch the appropriate scanning method based on OS
-    # Custom adapter name given for Linux, otherwise always None
+    # Custom adapter name given for Linux, otherwise always None.
+    # Several Linux adapters are given separated by commas.
     pf = sys.platform
     networks = []
 
-    if pf == 'linux':
-        networks = scan_linux(adapter)
-    elif pf  == 'win32':
-        networks = scan_win()
-    elif pf == 'darwin':
-        networks = scan_macos()
-    else:
-        print('[!] Unable to start a live scan')
-        print('Your OS is not supported by this app.')
-        sys.exit(1)
+    with metrics.stage('scan'):
+        if backend is not None:
+            networks = backend.scan(adapter)
+        elif pf == 'linux' and adapter and ',' in adapter:
+            networks = scan_linux_many([a.strip() for a in adapter.split(',') if a.strip()])
+        elif pf == 'linux':
+            networks = scan_linux(adapter)
+        elif pf  == 'win32':
+            networks = scan_win()
+        elif pf == 'darwin':
+            networks = scan_macos()
+        else:
+            print('[!] Unable to start a live scan')
+            print('Your OS is not supported by this app.')
+            sys.exit(1)
+
+    if recorder is not None:
+        recorder.write(networks)
 
     # Try sorting networks if list not empty and not malformed
     try:
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+scheduler.py
+Anton Slavin
+
+Adaptive scheduling of automatic scans.
+
+The time between scan starts follows the user: it is halved whenever
+the last fix moved by more than a few meters (or changed floor), and
+grows by half when the user stays put, within fixed bounds. The next
+scan is only scheduled once the previous one has finished, so scans
+never overlap, and a scan slower than the interval is followed by the
+next one right away.
+
+The effective fix rate over the last fixes is kept for display.
+"""
+
+
+# Packages
+import collections
+import math
+import time
+
+
+# Defaults, overridden by the config file
+MIN_SEC = 1.0           # shortest time between scan starts
+MAX_SEC = 15.0          # longest time between scan starts
+MOVE_M = 3.0            # movement between fixes that counts as moving
+
+SPEEDUP = 0.5           # interval factor when moving
+BACKOFF = 1.5           # interval factor when stationary
+RATE_FIXES = 10         # fixes the rate is measured over
+
+
+
+class AdaptiveSchedule(object):
+    def __init__(self, interval, min_sec=MIN_SEC, max_sec=MAX_SEC, move_m=MOVE_M,
+                 px_scale=1.0, adaptive=True):
+        # interval: starting seconds between scan starts, kept fixed
+        # if not adaptive
+        # px_scale: map pixels per meter
+
+        self.base = interval
+        self.min_sec = min(min_sec, interval)
+        self.max_sec = max(max_sec, interval)
+        self.move_m = move_m
+        self.px_scale = px_scale
+        self.adaptive = adaptive
+        self.reset()
+
+
+    @classmethod
+    def from_dict(cls, cfg, px_scale=1.0):
+        # Create a schedule from a dict with config file keys
+        return cls(cfg['AUTO_SEC'], cfg['AUTO_MIN_SEC'], cfg['AUTO_MAX_SEC'],
+                   cfg['AUTO_MOVE_M'], px_scale, cfg['AUTO_ADAPTIVE'])
+
+
+    def reset(self):
+        self.interval = self.base
+        self.started = None
+        self.duration = 0.0
+        self.prev = None
+        self.fixes = collections.deque(maxlen=RATE_FIXES)
+
+
+    def begin(self, t=None):
+        # A scan has started
+        self.started = time.monotonic() if t is None else t
+
+
+    def end(self, user, t=None):
+        # A scan has finished with the given fix (user dict or None).
+        # Returns the seconds to wait before starting the next scan.
+
+        t = time.monotonic() if t is None else t
+        if self.started is not None:
+            self.duration = t - self.started
+
+        if user is not None:
+            if self.adaptive and self.prev is not None:
+                if self.moved(self.prev, user):
+                    self.interval = max(self.min_sec, self.interval * SPEEDUP)
+                else:
+                    self.interval = min(self.max_sec, self.interval * BACKOFF)
+            self.prev = dict(user)
+            self.fixes.append(t)
+
+        return max(0.0, self.interval - self.duration)
+
+
+    def moved(self, prev, user):
+        if user['floor'] != prev['floor']:
+            return True
+        dist = math.hypot(user['x'] - prev['x'], user['y'] - prev['y']) / self.px_scale
+        return dist > self.move_m
+
+
+    def rate(self):
+        # Successful fixes per minute over the last RATE_FIXES fixes
+        if len(self.fixes) < 2 or self.fixes[-1] == self.fixes[0]:
+            return 0.0
+        return 60.0 * (len(self.fixes) - 1) / (self.fixes[-1] - self.fixes[0])
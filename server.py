@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+"""
+server.py
+Anton Slavin
+
+Multi-client positioning server.
+
+Devices connect over TCP and send their raw scans as JSON lines:
+
+    {"id": 1, "method": "mean", "scan": [{"MAC": "7c:21:...", "RSSI": -60}, ...]}
+
+and receive one JSON line per scan, in the order they were sent:
+
+    {"id": 1, "x": 2183.7, "y": 2048.2, "floor": 2, "radius": 3.1, "location": "2019"}
+    {"id": 2, "error": "no suitable nearby routers"}
+
+Incoming scans from all clients are collected into micro-batches and
+resolved with a single locate_batch call per method. The request queue
+is bounded: when it is full, the server stops reading from clients
+until the batcher catches up, which pushes back through TCP.
+
+Usage:
+    python3 server.py [--host HOST] [--port PORT] [--config PATH]
+"""
+
+
+# Packages
+import argparse
+import asyncio
+import numbers
+import json
+import math
+
+import numpy as np
+
+import routerdb
+import locator
+
+
+# Micro-batching and backpressure limits
+BATCH_MAX = 512         # scans per locate_batch call
+BATCH_WAIT = 0.002      # seconds to wait for a batch to fill up
+QUEUE_MAX = 4096        # scans waiting to be batched, over all clients
+CLIENT_INFLIGHT = 64    # unanswered scans per client
+
+METHODS = {
+    'mean': locator.MEAN,
+    'trilat': locator.TRILAT,
+    'multilat': locator.MULTILAT
+}
+
+
+
+def valid_scan(scan):
+    # Whether a scan from a client is a list of networks with a MAC
+    # string and a finite, negative RSSI each
+    if not isinstance(scan, list):
+        return False
+
+    for network in scan:
+        if not isinstance(network, dict):
+            return False
+        mac, rssi = network.get('MAC'), network.get('RSSI')
+        if not isinstance(mac, str):
+            return False
+        if isinstance(rssi, bool) or not isinstance(rssi, numbers.Real):
+            return False
+        if not (math.isfinite(rssi) and rssi < 0):
+            return False
+
+    return True
+
+
+
+class PositioningServer(object):
+    def __init__(self, routers, config):
+        self.routers = routers
+        self.config = config
+        self.queue = asyncio.Queue(QUEUE_MAX)
+        self.batches = 0
+        self.fixes = 0
+
+
+    async def handle_client(self, reader, writer):
+        # Read scans from one client and answer them in order.
+        # The client's previous fix warm-starts multilateration.
+
+        state = {'prev': None}
+        inflight = asyncio.Semaphore(CLIENT_INFLIGHT)
+        replies = asyncio.Queue()
+        sender = asyncio.create_task(self.send_replies(replies, writer, inflight))
+        reading = asyncio.create_task(self.read_requests(reader, replies, inflight, state))
+
+        # Once the client can no longer be answered, stop reading too,
+        # as the reader would wait for free in-flight slots forever
+        try:
+            await asyncio.wait([reading, sender], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            reading.cancel()
+            await replies.put(None)
+            await sender
+
+
+    async def read_requests(self, reader, replies, inflight, state):
+        # Queue the scans of one client, with a reply future for each
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                await inflight.acquire()
+                future = asyncio.get_running_loop().create_future()
+                await replies.put(future)
+
+                try:
+                    request = json.loads(line)
+                    method = METHODS[request.get('method', 'mean')]
+                    scan = request['scan']
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    future.set_result({'error': 'malformed request'})
+                    continue
+
+                # Bad scans are answered here, so they never reach a batch
+                if not valid_scan(scan):
+                    future.set_result({'id': request.get('id'), 'error': 'malformed scan'})
+                    continue
+
+                # Blocks while the queue is full (backpressure)
+                await self.queue.put((request.get('id'), method, scan, state, future))
+        except ConnectionError:
+            pass
+
+
+    async def send_replies(self, replies, writer, inflight):
+        # Write replies in request order as they become ready
+        try:
+            while True:
+                future = await replies.get()
+                if future is None:
+                    break
+
+                reply = await future
+                inflight.release()
+                writer.write(json.dumps(reply, separators=(',', ':')).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+    async def batcher(self):
+        # Collect queued scans into batches and resolve them
+        while True:
+            batch = [await self.queue.get()]
+            deadline = asyncio.get_running_loop().time() + BATCH_WAIT
+            while len(batch) < BATCH_MAX:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Drain whatever else is already waiting
+            while len(batch) < BATCH_MAX and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                self.resolve(batch)
+            except Exception as e:
+                print('[!] Failed to resolve batch:', e)
+                for entry in batch:
+                    if not entry[4].done():
+                        entry[4].set_result({'id': entry[0], 'error': 'internal error'})
+            self.batches += 1
+
+
+    def resolve(self, batch):
+        # Locate a batch of (id, method, scan, state, future) entries,
+        # one locate_batch call per method
+
+        by_method = {}
+        for entry in batch:
+            rid, method, scan, state, future = entry
+            try:
+                nearby,_ = locator.filter_nearby(self.routers, scan, self.config)
+            except (KeyError, TypeError, ValueError, OverflowError):
+                future.set_result({'id': rid, 'error': 'malformed scan'})
+                continue
+
+            if len(nearby) == 0:
+                future.set_result({'id': rid, 'error': 'no suitable nearby routers'})
+                continue
+
+            by_method.setdefault(method, []).append((entry, nearby))
+
+        for method,items in by_method.items():
+            scans = [nearby for _,nearby in items]
+            start = None
+            if method == locator.MULTILAT:
+                start = np.array([[np.nan, np.nan] if e[3]['prev'] is None else e[3]['prev']
+                                  for e,_ in items], dtype=float)
+
+            # Distances with the path-loss model of every router
+            x, y, floors, rssi, rows = locator.pack_scans(self.routers, scans, with_rows=True)
+            dist = locator.router_dist(self.routers, rows, rssi, self.config)
+            res = locator.locate_batch(x, y, floors, rssi, method, start=start,
+                                       config=self.config, dist=dist)
+
+            # Nearest router of every scan names the location
+            rows = self.routers.index([nearby[0]['MAC'] for nearby in scans])
+            for i,(entry,_) in enumerate(items):
+                rid, _, _, state, future = entry
+                if not res['valid'][i]:
+                    future.set_result({'id': rid, 'error': 'unable to locate'})
+                    continue
+
+                x, y = float(res['x'][i]), float(res['y'][i])
+                radius = float(res['radius'][i])
+                if not (math.isfinite(x) and math.isfinite(y) and math.isfinite(radius)):
+                    future.set_result({'id': rid, 'error': 'invalid fix'})
+                    continue
+
+                state['prev'] = (x, y)
+                future.set_result({
+                    'id': rid,
+                    'x': round(x, 1),
+                    'y': round(y, 1),
+                    'floor': int(res['floor'][i]),
+                    'radius': round(radius, 2),
+                    'location': self.routers.name(rows[i])
+                })
+                self.fixes += 1
+
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_client, host, port, limit=2**20)
+        self.batch_task = asyncio.create_task(self.batcher())
+        print(f'Listening on {host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Multi-client positioning server')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    # Load config file
+    with open(args.config, 'r') as f:
+        cfg = json.load(f)
+
+    routers = routerdb.load(cfg['ROUTERS_FILE_PATH'])
+    server = PositioningServer(routers, locator.LocatorConfig.from_dict(cfg))
+
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
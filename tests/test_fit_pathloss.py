@@ -0,0 +1,42 @@
+import numpy as np
+
+import calibrate
+import fit_pathloss
+import locator
+import routerdb
+
+
+def make_routers():
+    # APs on a grid, each with two 2.4 GHz (nibbles 0 and 1) and two
+    # 5 GHz (nibbles e and f) BSSIDs at the same position
+    rows = []
+    for i in range(16):
+        x, y = 200 + 400 * (i % 4), 200 + 400 * (i // 4)
+        for nibble,freq in zip('01ef', [2, 2, 5, 5]):
+            rows.append({'MAC': f'00:00:00:00:{i:02x}:0{nibble}', 'x': x, 'y': y,
+                         'SSID': 'test', 'floor': 1, 'freq': freq, 'name': f'room {i}'})
+    return routerdb.RouterTable.from_rows(rows)
+
+
+def test_bands_fitted_separately():
+    routers = make_routers()
+    config = locator.LocatorConfig.from_file().replace(ap_nibbles='01ef', ap_fusion='mean')
+
+    # 5 GHz attenuates faster than 2.4 GHz
+    band5 = routers.freq == 5
+    power = np.where(band5, -5.0, 0.0)
+    path_loss = np.where(band5, 3.0, 2.0)
+    labelled_set = calibrate.make_labelled(routers, config, 400, seed=1,
+                                           power=power, path_loss=path_loss)
+
+    groups, fitted_power, fitted_path_loss, counts, _ = fit_pathloss.fit_groups(
+        routers, labelled_set, 'band', config)
+
+    # Group of each band
+    band2_group = groups[np.flatnonzero(~band5)[0]]
+    band5_group = groups[np.flatnonzero(band5)[0]]
+    # Weak readings are not heard, which biases steep fits a little
+    assert fitted_path_loss[band5_group] - fitted_path_loss[band2_group] > 0.6
+    assert abs(fitted_path_loss[band2_group] - 2.0) < 0.3
+    assert abs(fitted_path_loss[band5_group] - 3.0) < 0.3
+    assert fitted_power[band5_group] < fitted_power[band2_group]
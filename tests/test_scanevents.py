@@ -0,0 +1,80 @@
+import sys
+
+import locator
+import routerdb
+import scanevents
+
+
+MACS = ['00:00:00:00:00:01', '00:00:00:00:00:02', '00:00:00:00:00:03', '00:00:00:00:00:04']
+
+# Recorded iw event output: one scan on wlan0, and one on an adapter
+# that is not followed
+EVENTS = '''
+import time
+print('1697551234.100000: wlan0 (phy #0): scan started', flush=True)
+time.sleep(0.1)
+print('1697551234.200000: wlan1 (phy #1): new scan results', flush=True)
+print('1697551234.300000: wlan0 (phy #0): new scan results', flush=True)
+time.sleep(0.2)
+'''
+
+# Recorded iw scan dump output, the last network is too old
+DUMP = '''
+import sys
+rows = []
+for i,mac in enumerate(%r):
+    rows += ['BSS %%s(on %%s)' %% (mac, sys.argv[1]),
+             '\\tlast seen: %%d ms ago' %% (100 if i < 4 else 60000),
+             '\\tsignal: %%d.00 dBm' %% (-40 - 5 * i),
+             '\\tSSID: test']
+print('\\n'.join(rows))
+''' % (MACS + ['00:00:00:00:00:05'])
+
+
+def make_scanner(events=EVENTS, wait=5.0):
+    python = sys.executable
+    return scanevents.EventScanner(['wlan0'], refresh=60.0, wait=wait,
+                                   cmd=(python, '-c', events),
+                                   dump_cmd=(python, '-c', DUMP, '{adapter}'),
+                                   trigger_cmd=(python, '-c', ''))
+
+
+def test_parse_iw_event():
+    lines = ['1697551234.123456: wlan0 (phy #0): new scan results\n',
+             'wlan1 (phy #1): scan started\n',
+             'garbage\n']
+    assert list(scanevents.parse_iw_event(lines)) == [('wlan0', 'new scan results'),
+                                                      ('wlan1', 'scan started')]
+
+
+def test_event_dump_locate():
+    backend = make_scanner()
+    try:
+        nearby = backend.scan()
+    finally:
+        backend.close()
+
+    assert sorted(network['MAC'] for network in nearby) == MACS
+    assert {network['RSSI'] for network in nearby} == {-40, -45, -50, -55}
+
+    routers = routerdb.RouterTable.from_rows([
+        {'MAC': mac, 'x': 100 * (i + 1), 'y': 50 * (i + 1) ** 2, 'SSID': 'test',
+         'floor': 2, 'freq': 2, 'name': f'room {i}'}
+        for i,mac in enumerate(MACS)
+    ])
+    config = locator.LocatorConfig.from_file().replace(ap_nibbles='')
+    kept,excluded = locator.filter_nearby(routers, nearby, config)
+    assert len(kept) == 4 and excluded == []
+
+    user = locator.locate(routers, kept, locator.MEAN, config=config)
+    assert user['floor'] == 2
+    assert 100 <= user['x'] <= 400
+
+
+def test_finished_without_results():
+    backend = make_scanner(events='print("wlan0 (phy #0): scan started")', wait=2.0)
+    try:
+        assert backend.scan() == []
+        assert backend.finished
+    finally:
+        backend.close()
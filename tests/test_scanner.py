@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+
+import pytest
+
+import scanner
+
+
+# Stand-in for iw that simulates the kernel's scan cache in a state
+# folder: triggered scans finish after a while, an active scan is
+# refused while one runs, and scan dump reports how long ago every
+# network was last seen. Every call is logged.
+FAKE_IW = '''#!%s
+import os
+import sys
+import time
+
+state = os.environ['FAKE_IW_STATE']
+now = time.time()
+
+def read(name):
+    try:
+        with open(os.path.join(state, name)) as f:
+            return float(f.read())
+    except OSError:
+        return None
+
+def write(name, value):
+    with open(os.path.join(state, name), 'w') as f:
+        f.write(repr(value))
+
+with open(os.path.join(state, 'log'), 'a') as f:
+    f.write(' '.join(sys.argv[2:]) + '\\n')
+
+# A triggered scan that finished updates the cache
+pending = read('pending')
+if pending is not None and now >= pending:
+    write('cache', pending)
+    os.remove(os.path.join(state, 'pending'))
+    pending = None
+
+adapter, args = sys.argv[1], sys.argv[2:]
+
+def dump(seen):
+    for i in range(3):
+        print('BSS 00:00:00:00:00:0%%d(on %%s)' %% (i + 1, adapter))
+        print('\\tlast seen: %%d ms ago' %% int((now - seen) * 1000))
+        print('\\tsignal: %%d.00 dBm' %% (-40 - 5 * i))
+        print('\\tSSID: test')
+
+if args == ['scan', 'trigger']:
+    if pending is None:
+        write('pending', now + 0.4)
+elif args == ['scan', 'dump']:
+    if read('cache') is not None:
+        dump(read('cache'))
+elif args == ['scan']:
+    if pending is not None:
+        sys.stderr.write('command failed: Device or resource busy (-16)\\n')
+        sys.exit(240)
+    time.sleep(0.2)
+    write('cache', now)
+    dump(now)
+''' % sys.executable
+
+
+@pytest.fixture
+def iw(tmp_path, monkeypatch):
+    # Fake iw first on the PATH, with a fresh scanner state
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'iw'
+    script.write_text(FAKE_IW)
+    script.chmod(0o755)
+
+    state = tmp_path / 'state'
+    state.mkdir()
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('FAKE_IW_STATE', str(state))
+
+    monkeypatch.setattr(scanner, 'cache_sec', 10)
+    monkeypatch.setattr(scanner, 'refresh_sec', 4)
+    monkeypatch.setattr(scanner, 'timeout', None)
+    monkeypatch.setattr(scanner, 'last_refresh', {})
+    monkeypatch.setattr(scanner, 'triggers', {})
+
+    class FakeIw(object):
+        def set_cache(self, age):
+            (state / 'cache').write_text(repr(time.time() - age))
+
+        def calls(self):
+            log = state / 'log'
+            return log.read_text().splitlines() if log.exists() else []
+
+    return FakeIw()
+
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='needs an executable script')
+
+
+def macs(networks):
+    return sorted(network['MAC'] for network in networks)
+
+
+def test_cold_cache_runs_active_scan(iw):
+    networks = scanner.scan_linux('wlan0')
+    assert macs(networks) == ['00:00:00:00:00:01', '00:00:00:00:00:02', '00:00:00:00:00:03']
+    assert iw.calls() == ['scan dump', 'scan']
+
+
+def test_stale_cache_after_idle(iw):
+    iw.set_cache(age=20)
+    assert len(scanner.scan_linux('wlan0')) == 3
+    assert iw.calls() == ['scan dump', 'scan']
+
+
+def test_fresh_cache_refreshed_in_background(iw):
+    iw.set_cache(age=2)
+    networks = scanner.scan_linux('wlan0')
+    assert [network['RSSI'] for network in networks] == [-40, -45, -50]
+
+    scanner.triggers['wlan0'].wait()
+    assert iw.calls() == ['scan dump', 'scan trigger']
+
+
+def test_waits_for_running_background_scan(iw):
+    # A background scan is started, then the cache goes stale
+    # before it has finished
+    iw.set_cache(age=8)
+    assert len(scanner.scan_linux('wlan0')) == 3
+    iw.set_cache(age=20)
+
+    assert len(scanner.scan_linux('wlan0')) == 3
+    assert 'scan' not in iw.calls()
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import socket
+import struct
+
+import locator
+import routerdb
+import server
+
+
+def make_server():
+    routers = routerdb.RouterTable.from_rows([
+        {'MAC': f'00:00:00:00:00:0{i}', 'x': 100 * i, 'y': 50 * i, 'SSID': 'test',
+         'floor': 1, 'freq': 2, 'name': f'room {i}'}
+        for i in range(1, 5)
+    ])
+    config = locator.LocatorConfig.from_file()
+    return server.PositioningServer(routers, config)
+
+
+def request(i):
+    scan = [{'MAC': f'00:00:00:00:00:0{k}', 'RSSI': -40 - k} for k in range(1, 5)]
+    return (json.dumps({'id': i, 'scan': scan}) + '\n').encode()
+
+
+async def start(positioning):
+    # Server on a free port, with an event set when a client handler returns
+    finished = asyncio.Event()
+
+    async def handle(reader, writer):
+        await positioning.handle_client(reader, writer)
+        finished.set()
+
+    tcp = await asyncio.start_server(handle, '127.0.0.1', 0)
+    batcher = asyncio.create_task(positioning.batcher())
+    return tcp, batcher, finished, tcp.sockets[0].getsockname()[1]
+
+
+def test_replies_in_order():
+    async def main():
+        tcp, batcher, finished, port = await start(make_server())
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b''.join(request(i) for i in range(10)))
+        writer.write(b'not json\n')
+        await writer.drain()
+
+        replies = [json.loads(await reader.readline()) for _ in range(11)]
+        assert [r.get('id') for r in replies[:10]] == list(range(10))
+        assert all('x' in r for r in replies[:10])
+        assert replies[10] == {'error': 'malformed request'}
+
+        writer.close()
+        await asyncio.wait_for(finished.wait(), 5)
+        batcher.cancel()
+        tcp.close()
+
+    asyncio.run(main())
+
+
+def test_disconnect_mid_stream():
+    # A client that sends more scans than it may have in flight and
+    # drops the connection without reading any replies
+    async def main():
+        positioning = make_server()
+        tcp, batcher, finished, port = await start(positioning)
+
+        # A small receive buffer makes the server's writes stall early
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, ('127.0.0.1', port))
+        data = b''.join(request(i) for i in range(5000))
+        sending = asyncio.create_task(asyncio.get_running_loop().sock_sendall(sock, data))
+        await asyncio.sleep(0.5)
+        sending.cancel()
+        # Reset instead of a graceful close
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        sock.close()
+
+        # The handler must return instead of waiting for replies forever
+        await asyncio.wait_for(finished.wait(), 5)
+
+        # Other clients are still served
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request(1))
+        await writer.drain()
+        assert 'x' in json.loads(await asyncio.wait_for(reader.readline(), 5))
+        writer.close()
+
+        batcher.cancel()
+        tcp.close()
+
+    asyncio.run(main())
+
+
+def test_bad_scans_next_to_good_ones():
+    # Bad scans in the same micro-batch as good ones only fail themselves
+    good = [{'MAC': f'00:00:00:00:00:0{k}', 'RSSI': -40 - k} for k in range(1, 5)]
+    bad = [
+        [dict(good[0], MAC=2**70)] + good[1:],
+        [dict(good[0], MAC=1.5e30)] + good[1:],
+        [dict(good[0], MAC=[1])] + good[1:],
+        [dict(good[0], RSSI=0)] + good[1:],
+        [dict(good[0], RSSI='abc')] + good[1:],
+        [dict(good[0], RSSI=float('nan'))] + good[1:],
+        'not a list'
+    ]
+
+    def strict(line):
+        # Replies must be valid JSON, without NaN or Infinity
+        def reject(constant):
+            raise ValueError(constant)
+        return json.loads(line, parse_constant=reject)
+
+    async def client(i, scan, port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write((json.dumps({'id': i, 'scan': scan}) + '\n').encode())
+        await writer.drain()
+        reply = strict(await asyncio.wait_for(reader.readline(), 5))
+        writer.close()
+        return reply
+
+    async def main():
+        tcp, batcher, finished, port = await start(make_server())
+        scans = [good if i % 2 == 0 else bad[i // 2] for i in range(2 * len(bad))]
+        replies = await asyncio.gather(*[client(i, scan, port) for i,scan in enumerate(scans)])
+
+        for i,reply in enumerate(replies):
+            assert reply['id'] == i
+            if i % 2 == 0:
+                assert 'x' in reply, reply
+            else:
+                assert reply['error'] == 'malformed scan', reply
+
+        batcher.cancel()
+        tcp.close()
+
+    asyncio.run(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+tracker.py
+Anton Slavin
+
+Particle filter tracking the user across consecutive scans.
+
+Every particle is a possible user position on the current floor, all
+kept in NumPy arrays. Between scans, particles move in a random
+direction by at most the maximum walking speed times the elapsed time.
+On every scan, each particle is weighted by how well the RSSI values
+predicted for it by the path-loss model match the measured ones.
+Particles are resampled when the weights degenerate.
+
+The filter starts (and restarts when lost or on a floor change) from
+a weighted mean fix of the scan.
+"""
+
+
+# Packages
+import numpy as np
+import time
+
+import locator
+
+
+# Defaults, overridden by the config file
+PARTICLES = 4000
+MAX_SPEED = 2.0         # m/s
+RSSI_SIGMA = 4.0        # dB, measurement noise of the path-loss model
+
+INIT_SPREAD = 8.0       # m, spread of particles around the first fix
+JITTER = 0.3            # m, minimum movement between scans
+MAX_DT = 30.0           # s, longer gaps are treated as this
+LOST_SIGMA = 3.0        # restart if the best particle is further off (in sigmas)
+
+
+class ParticleTracker(object):
+    def __init__(self, config=None, particles=PARTICLES, max_speed=MAX_SPEED,
+                 rssi_sigma=RSSI_SIGMA, seed=None):
+        # config: LocatorConfig, the default config file if not given
+        # max_speed in m/s, rssi_sigma in dB
+
+        self.config = config or locator.default_config()
+        self.n = particles
+        self.max_speed = max_speed
+        self.rssi_sigma = rssi_sigma
+        self.rng = np.random.default_rng(seed)
+        self.reset()
+
+
+    @classmethod
+    def from_dict(cls, cfg, config=None):
+        # Create a tracker from a dict with config file keys
+        return cls(config, cfg['TRACKER_PARTICLES'], cfg['TRACKER_MAX_SPEED'],
+                   cfg['TRACKER_RSSI_SIGMA'])
+
+
+    def reset(self):
+        # Forget the track, the next scan starts a new one
+        self.px = None
+        self.py = None
+        self.weights = None
+        self.floor = None
+        self.last_t = None
+
+
+    def init_particles(self, x, y):
+        spread = INIT_SPREAD * self.config.px_scale
+        self.px = self.rng.normal(x, spread, self.n)
+        self.py = self.rng.normal(y, spread, self.n)
+        self.weights = np.full(self.n, 1.0 / self.n)
+
+
+    def predict(self, dt):
+        # Move every particle by up to max_speed * dt in a random direction
+        reach = (self.max_speed * min(dt, MAX_DT) + JITTER) * self.config.px_scale
+        r = reach * np.sqrt(self.rng.random(self.n))
+        a = self.rng.random(self.n) * (2 * np.pi)
+        self.px += r * np.cos(a)
+        self.py += r * np.sin(a)
+
+
+    def log_likelihood(self, ax, ay, rssi, power, path_loss):
+        # Log-likelihood of the scan for every particle, as a sum of
+        # Gaussian RSSI residuals against the path-loss model of every
+        # router (power and path_loss arrays like rssi)
+
+        # Single precision is plenty for pixel ranges and halves the work
+        dx = self.px.astype(np.float32)[:, None] - ax.astype(np.float32)[None, :]
+        dy = self.py.astype(np.float32)[:, None] - ay.astype(np.float32)[None, :]
+        # Squared range in pixels as in multilaterate, at least 1 px.
+        # log10(d) = log10(d^2) / 2 saves the square root.
+        d2 = np.maximum(dx * dx + dy * dy, np.float32(1.0))
+        res = np.log10(d2)
+        res *= (5 * path_loss / self.rssi_sigma).astype(np.float32)[None, :]
+        res += ((rssi - power) / self.rssi_sigma).astype(np.float32)[None, :]
+        return -0.5 * np.einsum('ij,ij->i', res, res).astype(float)
+
+
+    def resample(self):
+        # Systematic resampling, O(n)
+        positions = (self.rng.random() + np.arange(self.n)) / self.n
+        idx = np.searchsorted(np.cumsum(self.weights), positions)
+        idx = np.minimum(idx, self.n - 1)
+        self.px = self.px[idx]
+        self.py = self.py[idx]
+        self.weights = np.full(self.n, 1.0 / self.n)
+
+
+    def update(self, routers, nearby_routers, t=None):
+        # routers: RouterTable of all routers
+        # Update the track with a filtered scan (list of nearby router
+        # dicts, strongest first) taken at time t (seconds).
+        # Nearby routers get their floor and distance set, as in locate.
+        # Returns a user dict like locate, or None.
+
+        config = self.config
+        t = time.monotonic() if t is None else t
+
+        # Fresh fix of the scan alone, used to start or restart the track.
+        # Also sets the floor and distance of every router.
+        fix = locator.locate(routers, nearby_routers, locator.MEAN, None, config)
+        if fix is None:
+            return None
+
+        # Strongest routers of the floor with the most routers
+        rows = routers.index([router['MAC'] for router in nearby_routers])
+        rssi = np.array([router['RSSI'] for router in nearby_routers], dtype=float)
+        same = routers.floor[rows] == fix['floor']
+        rows, rssi = rows[same][:config.lsq_max_aps], rssi[same][:config.lsq_max_aps]
+        ax = routers.x[rows].astype(float)
+        ay = routers.y[rows].astype(float)
+        power, path_loss, _ = locator.router_model(routers, config)
+        power, path_loss = power[rows], path_loss[rows]
+
+        if self.px is None or fix['floor'] != self.floor:
+            self.init_particles(fix['x'], fix['y'])
+        else:
+            self.predict(t - self.last_t)
+
+        logw = self.log_likelihood(ax, ay, rssi, power, path_loss)
+
+        # Lost track: even the best particle does not explain the scan
+        if logw.max() < -0.5 * (LOST_SIGMA ** 2) * len(rssi):
+            self.init_particles(fix['x'], fix['y'])
+            logw = self.log_likelihood(ax, ay, rssi, power, path_loss)
+
+        logw += np.log(self.weights)
+        w = np.exp(logw - logw.max())
+        self.weights = w / w.sum()
+        self.floor = fix['floor']
+        self.last_t = t
+
+        # Estimate before resampling, which only adds noise
+        x = float(np.dot(self.weights, self.px))
+        y = float(np.dot(self.weights, self.py))
+        var = np.dot(self.weights, (self.px - x)**2 + (self.py - y)**2)
+        radius = float(np.sqrt(var)) / config.px_scale
+
+        # Resample when the effective number of particles is low
+        if 1.0 / np.dot(self.weights, self.weights) < self.n / 2:
+            self.resample()
+
+        return {
+            'x': x,
+            'y': y,
+            'floor': self.floor,
+            'radius': min(radius, config.rad_threshold)
+        }
@@ -1,5 +1,11 @@
-from PySide6.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QDialogButtonBox, QGraphicsScene, QLabel, QLineEdit, QRadioButton, QPushButton
-from PySide6.QtCore import Qt, QPointF, Signal
+from PySide6.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QDialogButtonBox, QGraphicsScene, QGraphicsPixmapItem, QLabel, QLineEdit, QRadioButton, QPushButton
+from PySide6.QtCore import Qt, QPointF, QEvent, Signal, Slot, QObject, QRunnable, QThreadPool
+from PySide6.QtGui import QImage, QPixmap
+from collections import OrderedDict
+import metrics
+import routerdb
+import json
+import os
 
 
 
@@ -18,6 +24,293 @@ class CGraphicsScene(QGraphicsScene):
 
 
 
+class MapCache(QObject):
+    # LRU cache of decoded and scaled floor map images, keyed by
+    # (floor, variant, scale) where variant is the file suffix:
+    # '' for the full map, '-c' for the clean map, '-overlay' for overlays.
+    # Images are QImages so they can be decoded in worker threads;
+    # the cache itself is only touched from the UI thread.
+
+    loaded = Signal(object, QImage)
+
+    def __init__(self, img_w, img_h, budget_mb, parent=None):
+        super(MapCache, self).__init__(parent)
+        self.img_w = img_w
+        self.img_h = img_h
+        self.budget = budget_mb * 1024 * 1024
+        self.size = 0
+        self.images = OrderedDict()
+        self.loading = {}
+        self.pool = QThreadPool()
+        self.loaded.connect(self.on_loaded)
+
+
+    def path(self, floor, variant):
+        return f'map/korrus-{floor}{variant}.png'
+
+
+    def load(self, key):
+        # Decode and scale a map image, safe to call from any thread
+        floor, variant, scale = key
+        with metrics.stage('map_load'):
+            img = QImage(self.path(floor, variant))
+        if img.isNull():
+            return img
+
+        with metrics.stage('map_scale'):
+            return img.scaled(int(self.img_w / scale), int(self.img_h / scale),
+                              Qt.AspectRatioMode.KeepAspectRatio,
+                              Qt.TransformationMode.SmoothTransformation)
+
+
+    def get(self, floor, variant, scale):
+        # Scaled map image, loaded synchronously on a cache miss
+        key = (floor, variant, scale)
+        if key in self.images:
+            self.images.move_to_end(key)
+            return self.images[key]
+
+        img = self.load(key)
+        self.put(key, img)
+        return img
+
+
+    def put(self, key, img):
+        # Insert an image and evict the least recently used ones
+        if key in self.images:
+            return
+
+        self.images[key] = img
+        self.size += img.sizeInBytes()
+        while self.size > self.budget and len(self.images) > 1:
+            _, old = self.images.popitem(last=False)
+            self.size -= old.sizeInBytes()
+
+
+    def estimate(self, scale):
+        # Approximate size of a scaled 32-bit image in bytes
+        return int(self.img_w / scale) * int(self.img_h / scale) * 4
+
+
+    def prewarm(self, keys):
+        # Load images in the background, as long as they fit into
+        # the budget next to what is already cached or loading
+        for key in keys:
+            if key in self.images or key in self.loading:
+                continue
+            if not os.path.exists(self.path(key[0], key[1])):
+                continue
+
+            est = self.estimate(key[2])
+            if self.size + sum(self.loading.values()) + est > self.budget:
+                continue
+
+            self.loading[key] = est
+            self.pool.start(MapLoader(self, key))
+
+
+    @Slot(object, QImage)
+    def on_loaded(self, key, img):
+        # Called in the UI thread when a background load is done
+        self.loading.pop(key, None)
+        self.put(key, img)
+
+
+
+class MapLoader(QRunnable):
+    # Background task decoding a single map image for MapCache
+
+    def __init__(self, cache, key):
+        super(MapLoader, self).__init__()
+        self.cache = cache
+        self.key = key
+
+    def run(self):
+        self.cache.loaded.emit(self.key, self.cache.load(self.key))
+
+
+
+class TileCache(QObject):
+    # LRU cache of map tiles made by make_tiles.py, keyed by
+    # (name, scale, col, row). Tiles are decoded in worker threads
+    # and announced with the loaded signal.
+
+    loaded = Signal(object, QImage)
+
+    def __init__(self, tiles_dir, budget_mb, parent=None):
+        super(TileCache, self).__init__(parent)
+        self.tiles_dir = tiles_dir
+        self.budget = budget_mb * 1024 * 1024
+        self.size = 0
+        self.tiles = OrderedDict()
+        self.loading = set()
+        self.meta = {}
+        self.pool = QThreadPool()
+        self.loaded.connect(self.on_loaded)
+
+
+    def info(self, name):
+        # Tile metadata of a map, None if it has not been tiled
+        if name not in self.meta:
+            path = os.path.join(self.tiles_dir, name, 'tiles.json')
+            try:
+                with open(path, 'r') as f:
+                    self.meta[name] = json.load(f)
+            except (OSError, ValueError):
+                self.meta[name] = None
+
+        return self.meta[name]
+
+
+    def path(self, key):
+        name, scale, col, row = key
+        return os.path.join(self.tiles_dir, name, str(scale), f'{col}_{row}.png')
+
+
+    def get(self, key):
+        # Cached tile or None, loading it in the background on a miss
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+
+        if key not in self.loading:
+            self.loading.add(key)
+            self.pool.start(TileLoader(self, key))
+        return None
+
+
+    @Slot(object, QImage)
+    def on_loaded(self, key, img):
+        # Called in the UI thread when a tile is decoded
+        self.loading.discard(key)
+        if key in self.tiles:
+            return
+
+        self.tiles[key] = img
+        self.size += img.sizeInBytes()
+        while self.size > self.budget and len(self.tiles) > 1:
+            _, old = self.tiles.popitem(last=False)
+            self.size -= old.sizeInBytes()
+
+
+
+class TileLoader(QRunnable):
+    # Background task decoding a single tile for TileCache
+
+    def __init__(self, cache, key):
+        super(TileLoader, self).__init__()
+        self.cache = cache
+        self.key = key
+
+    def run(self):
+        self.cache.loaded.emit(self.key, QImage(self.cache.path(self.key)))
+
+
+
+class PaintTimer(QObject):
+    # Event filter timing the paint events of a graphics view
+    # as the 'paint' stage of the metrics
+
+    def __init__(self, view, parent=None):
+        super(PaintTimer, self).__init__(parent)
+        self.view = view
+        view.viewport().installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if event.type() != QEvent.Paint or not metrics.enabled:
+            return False
+
+        # Paint now, inside the timed block
+        with metrics.stage('paint'):
+            self.view.viewportEvent(event)
+        return True
+
+
+
+class TileLayer(object):
+    # Scene layer showing the tiles of one map that intersect the
+    # visible area. Items of tiles that scroll out of view are removed,
+    # so memory depends on the viewport size, not on the image size.
+
+    def __init__(self, scene, cache, z):
+        self.scene = scene
+        self.cache = cache
+        self.z = z
+        self.name = None
+        self.scale = None
+        self.items = {} # (col, row) -> pixmap item
+        self.wanted = set()
+        cache.loaded.connect(self.on_loaded)
+
+
+    def size(self, name, scale):
+        # Size of the map at the given scale, None if not tiled
+        meta = self.cache.info(name)
+        if meta is None or str(scale) not in meta['levels']:
+            return None
+        return meta['levels'][str(scale)]
+
+
+    def clear(self):
+        for item in self.items.values():
+            self.scene.removeItem(item)
+        self.items = {}
+        self.wanted = set()
+
+
+    def show(self, name, scale, rect):
+        # Show the tiles of map `name` at `scale` inside the scene rect,
+        # plus a margin of one tile. name None hides the layer.
+
+        if (name, scale) != (self.name, self.scale):
+            self.clear()
+            self.name = name
+            self.scale = scale
+
+        size = self.size(name, scale) if name else None
+        if size is None:
+            self.clear()
+            return
+
+        tile = self.cache.info(name)['tile']
+        w, h = size
+        c0 = max(int(rect.left()) // tile - 1, 0)
+        r0 = max(int(rect.top()) // tile - 1, 0)
+        c1 = min(int(rect.right()) // tile + 1, (w - 1) // tile)
+        r1 = min(int(rect.bottom()) // tile + 1, (h - 1) // tile)
+        self.wanted = {(c, r) for c in range(c0, c1 + 1) for r in range(r0, r1 + 1)}
+
+        # Drop tiles that are out of view
+        for cr in list(self.items):
+            if cr not in self.wanted:
+                self.scene.removeItem(self.items.pop(cr))
+
+        for cr in self.wanted:
+            if cr not in self.items:
+                img = self.cache.get((name, scale) + cr)
+                if img is not None:
+                    self.add(cr, img)
+
+
+    def add(self, cr, img):
+        tile = self.cache.info(self.name)['tile']
+        item = QGraphicsPixmapItem(QPixmap.fromImage(img))
+        item.setPos(cr[0] * tile, cr[1] * tile)
+        item.setZValue(self.z)
+        self.scene.addItem(item)
+        self.items[cr] = item
+
+
+    @Slot(object, QImage)
+    def on_loaded(self, key, img):
+        # Add a tile that finished loading if it is still wanted
+        name, scale, col, row = key
+        if (name, scale) == (self.name, self.scale) and (col, row) in self.wanted:
+            if (col, row) not in self.items:
+                self.add((col, row), img)
+
+
+
 class NewRouterDialog(QDialog):
     # Custom dialog window for new router details.
     # Collects inserted data into a dictionary
@@ -111,7 +404,7 @@ class NewRouterDialog(QDialog):
             window.status.showMessage('All new router fields must be filled in', 3000)
             status_ok = False
 
-        if len(data['MAC']) != 17:
+        if len(data['MAC']) != 17 or routerdb.mac_to_int(data['MAC']) < 0:
             window.status.showMessage('Malformed new router MAC address', 3000)
             status_ok = False
 